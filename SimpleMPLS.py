@@ -17,6 +17,8 @@ To launch the application just use:
     python SimpleMPLS.py --netfile=ExNetWithLoops1A.json
 If you don't want to use the telnet/python backdoor:
     python SimpleMPLS.py --netfile=ExNetWithLoops1A.json --notelnet
+To export the controller metrics for Prometheus on http://localhost:9100/
+    python SimpleMPLS.py --netfile=ExNetWithLoops1A.json --metricsport=9100
 
 To launch mininet using a custom topology and remote controller based on this
 code use:
@@ -43,13 +45,45 @@ myapp.remove_lsp("H3-S1-S2-S4-S5-H9")
 myapp.show_all_lsps()
 myapp.remove_lsp("H2-S1-S2-H5")
 ```
+
+The LSPs can also be driven by the SWAN allocator. Given a function returning
+the current (priority, source host, destination host, demand) tuples, e.g.
+```python
+myapp.start_control_loop(lambda: [("interactive", "H1", "H6", 10),
+                                  ("elastic", "H3", "H9", 30)], interval=60)
+```
+allocates the demands every interval seconds and installs the LSPs in use.
+
+An LSP can be given a weight with reconcile. LSPs between the same two hosts
+share one select group at their ingress switch, which splits the traffic
+between them in proportion to their weights:
+```python
+myapp.reconcile({"H1-S1-S2-S4-H6": 3, "H1-S1-S3-S5-S4-H6": 1})
+myapp.reconcile({"H1-S1-S2-S4-H6": 1, "H1-S1-S3-S5-S4-H6": 1})  # group update only
+```
+Each direction has a group of its own, at its own ingress switch, so the
+directions can be weighted apart (forward is the direction of the pathString):
+```python
+myapp.reconcile({"H1-S1-S2-S4-H6": {"fwd": 3, "rev": 1},
+                 "H1-S1-S3-S5-S4-H6": {"fwd": 1, "rev": 1}})
+```
+
+Packets are not sent to the controller unless tracing is turned on. To see
+1 in 10 packets of an LSP at every switch along it:
+```python
+myapp.set_trace(10)
+myapp.trace_lsp("H1-S1-S2-S4-H6")
+myapp.trace_log  # (switch, ethertype, label, ttl, ipv4 src, ipv4 dst) records
+myapp.set_trace(0)
+```
 """
 
-from builtins import hex
 from builtins import range
-import random
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, deque, OrderedDict
 import json
+import socket
+import struct
+import time
 from networkx.readwrite import json_graph
 from ryu.base import app_manager
 from ryu.controller import ofp_event
@@ -58,10 +92,15 @@ import sys  # For getting command line arguments and passing to Ryu
 import eventlet
 from eventlet import backdoor  # For telnet python access
 from ryu.ofproto import ofproto_v1_3  # This code is OpenFlow 1.0 specific
-from ryu.lib.packet.packet import Packet  # For packet parsing
-import ryu.lib.packet.ipv4
-import ryu.lib.packet.mpls
-from ryu.controller.handler import set_ev_cls
+from ryu.ofproto import ofproto_v1_3_parser
+from ryu.controller.handler import set_ev_cls, MAIN_DISPATCHER, DEAD_DISPATCHER
+from mpls_labels import LabelManager, LabelsExhausted
+from topoindex import TopologyIndex
+from mpls_control import ControlLoop
+from failover import link_failure, switch_failure
+from estimation import DemandEstimator
+from mpls_state import LspStore, encode_lsp, encode_delete, encode_group
+import metrics
 
 if __name__ == "__main__":  # Stuff to set additional command line options
     from ryu import cfg
@@ -70,9 +109,30 @@ if __name__ == "__main__":  # Stuff to set additional command line options
     CONF.register_cli_opts([
         cfg.StrOpt('netfile', default=None, help='network json file'),
         cfg.BoolOpt('notelnet', default=False,
-                    help='Telnet based debugger.')
+                    help='Telnet based debugger.'),
+        cfg.IntOpt('metricsport', default=0,
+                   help='port of the metrics HTTP endpoint, 0 for none'),
+        cfg.StrOpt('statefile', default=None,
+                   help='file the LSPs are saved to and restored from')
     ])
 
+# Total of the bucket weights of an ingress select group
+BUCKET_WEIGHT_SCALE = 1000
+# Group on every switch that mirrors sampled packets of traced LSPs
+TRACE_GROUP_ID = 0xfffffe00
+TRACE_BYTES = 128  # bytes of a mirrored packet sent to the controller
+TRACE_LOG_SIZE = 1000  # trace records kept in SimpleMPLS.trace_log
+STATS_INTERVAL = 60  # seconds between flow stats requests of measure_demands
+DEFAULT_CLASS = 'background'  # priority of host pairs measure_demands has no class for
+# Cookie of the flow entries of this app, to find them in flow stats
+FLOW_COOKIE = 0x4d504c53
+COOKIE_MASK = 0xffffffffffffffff
+# Phases of a batch, each sent once every switch has confirmed the one
+# before (make before break): entries of the new hops, then the ingress
+# groups and entries and the entries where a rerouted path parts from its
+# old hops, then the deletion of entries no LSP uses any more.
+INSTALL, SWITCHOVER, REMOVE = range(3)
+
 
 class SimpleMPLS(app_manager.RyuApp):
     """ This app can be used to setup and tear down MPLS LSPs.
@@ -89,16 +149,71 @@ class SimpleMPLS(app_manager.RyuApp):
         super(SimpleMPLS, self).__init__(*args, **kwargs)
         self.netfile = self.CONF.netfile
         self.switches = {}
+        # OpenFlow constants and parser of each switch, by switch name
+        self.protocols = {}
         # Reads in the topology file and creates a NetworkX graph
-        self.g = json_graph.node_link_graph(json.load(open(self.netfile)))
-        # Will store link labels in a dictionary index by a tuple containing
-        # node names such as ("S1", "S2"). We keep track of labels for each link
-        # direction, i.e., ("S1", "S2") and ("S2", "S1").
-        self.link_labels = defaultdict(list)  # Default to empty list of labels
+        self.g = read_network(self.netfile)
+        # Ports, addresses and adjacency of the graph as flat tables
+        self.topo = TopologyIndex(self.g)
+        # Label pools indexed by a tuple containing node names such as
+        # ("S1", "S2"). We keep track of labels for each link direction, i.e.,
+        # ("S1", "S2") and ("S2", "S1").
+        self.labels = LabelManager()
         self.lsps = {}  # Keep track of all the LSPs created
+        # Forwarding equivalence classes by (ingress switch, source host,
+        # destination host). Each has a select group with one bucket per LSP
+        # carrying it, its member LSPs (pathString -> "fwd" or "rev") and the
+        # match of its ingress entry. Group ids come from a pool per switch.
+        self.fecs = {}
+        self.group_ids = LabelManager(1, TRACE_GROUP_ID - 1)
+        self.pending_fecs = {}  # FECs whose group changes with the next batch
+        # Labels of removed hops, released once the batch deleting their
+        # entries is confirmed so that no new hop reuses them before
+        self.pending_labels = []
+        # Batches being sent one phase at a time, oldest first (see
+        # _send_batches); outstanding barriers, (datapath id, xid) -> batch
+        # and the time the barrier was sent; and per LSP the number of its
+        # batches not yet confirmed plus its callback.
+        self.transactions = deque()
+        self.barriers = {}
+        self.unconfirmed = {}
+        self.control = None  # ControlLoop, see start_control_loop
+        # Demand measurement, see measure_demands
+        self.estimator = None
+        self.flow_classes = {}
+        self.stats_thread = None
+        self.host_by_ip = {ip: n for n, ip, switch in
+                           zip(self.topo.names, self.topo.ip, self.topo.is_switch)
+                           if ip and not switch}
+        # Tracing, off by default: 1 in trace_sample packets of the LSPs in
+        # traced are mirrored to the controller, 0 for none.
+        self.trace_sample = 0
+        self.trace_bytes = TRACE_BYTES
+        self.traced = set()
+        self.trace_groups = set()  # switches with the trace group installed
+        self.trace_log = deque(maxlen=TRACE_LOG_SIZE)
+        # Metrics looked up once, see metrics.py
+        registry = metrics.REGISTRY
+        self.m_barrier = registry.histogram(
+            'mpls_barrier_rtt_seconds', 'Round trip of a barrier after a batch')
+        self.m_labels = registry.histogram(
+            'mpls_label_reserve_seconds', 'Time to reserve the labels of one path')
+        self.m_packet_in = registry.counter(
+            'mpls_packet_in_total', 'Packets received by packet_in')
+        self.m_sent = {}  # message type -> counter of messages sent
         if not self.CONF.notelnet:
             eventlet.spawn(backdoor.backdoor_server,
                            eventlet.listen(('localhost', 3000)))
+        if self.CONF.metricsport:
+            metrics.serve(self.CONF.metricsport)
+        # Persisted state, see restore_state: LSPs changed since the last
+        # batch, and the flow stats and group desc requests of _sync
+        self.store = None
+        self.dirty = set()
+        self.syncs = {}  # (datapath id, xid) -> switch
+        self.sync_replies = {}  # switch -> [flow stats, group descs, requests open]
+        if self.CONF.statefile:
+            self.restore_state(self.CONF.statefile)
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures)
     def switch_features(self, event):
@@ -111,36 +226,512 @@ class SimpleMPLS(app_manager.RyuApp):
         switchName = dpidDecode(dp.id)
         self.logger.info("Switch {} came up".format(switchName))
         self.switches[switchName] = dp  # Save switch information
+        self.protocols[switchName] = (dp.ofproto, dp.ofproto_parser)
+        self.trace_groups.discard(switchName)  # a reconnected switch starts empty
+        if self.trace_sample:
+            self._send_trace_group(switchName)
+        if self.lsps:
+            self._request_sync(switchName)
+        if self.control is not None:
+            self.control.restore(switch_failure(switchName))
+
+    @set_ev_cls(ofp_event.EventOFPStateChange, [MAIN_DISPATCHER, DEAD_DISPATCHER])
+    def state_change(self, event):
+        """ A switch that disconnects is taken as failed: it is not sent
+            anything any more and the control loop fails over around it."""
+        if event.state != DEAD_DISPATCHER or event.datapath.id is None:
+            return
+        switchName = dpidDecode(event.datapath.id)
+        if self.switches.get(switchName) is not event.datapath:
+            return
+        self.logger.info("Switch {} went down".format(switchName))
+        del self.switches[switchName]
+        for key in [k for k in self.barriers if k[0] == event.datapath.id]:
+            self._barrier_done(key)  # it has nothing left to confirm
+        if self.control is not None:
+            self.control.fail(switch_failure(switchName))
 
-    def make_lsp(self, pathString):
+    @set_ev_cls(ofp_event.EventOFPPortStatus)
+    def port_status(self, event):
+        """ A port between two switches went down or came back up. The
+            control loop fails over to the precomputed allocation of that
+            link, or allocates over it again."""
+        msg = event.msg
+        ofproto = msg.datapath.ofproto
+        switchName = dpidDecode(msg.datapath.id)
+        peer = self.topo.neighbor(switchName, msg.desc.port_no)
+        if peer is None or self.control is None:
+            return
+        down = (msg.reason == ofproto.OFPPR_DELETE
+                or msg.desc.state & ofproto.OFPPS_LINK_DOWN
+                or msg.desc.config & ofproto.OFPPC_PORT_DOWN)
+        self.logger.info("Link {}-{} {}".format(switchName, peer, "down" if down else "up"))
+        if down:
+            self.control.fail(link_failure(switchName, peer))
+        else:
+            self.control.restore(link_failure(switchName, peer))
+
+    def make_lsp(self, pathString, callback=None):
         """ Use this to create two uni-directional LSPs (forward and reverse)
         between two hosts systems along a specified path.
         :param pathString: A string of text with node names separated by dashes,
         the first and last nodes must be hosts, and all other nodes switches.
         Example: "H2-S1-S2-H5".
+        :param callback: called with pathString once every switch on the path
+        has confirmed its flow entries.
+        """
+        self.make_lsps([pathString], callback)
+
+    @metrics.timed('mpls_batch_seconds', 'Time to build and send a batch of LSP changes',
+                   op='make')
+    def make_lsps(self, pathStrings, callback=None):
+        """ Creates many bidirectional LSPs at once. The flow mods of all the
+        LSPs are grouped per switch and sent back to back, and each switch's
+        batch is closed by a barrier request, so the number of round trips is
+        bounded by the number of switches rather than the number of LSPs.
+        :param pathStrings: paths in the format taken by make_lsp.
+        :param callback: called with each pathString once every switch on its
+        path has answered the barrier that follows its flow entries.
+        """
+        batches = new_batches()
+        for pathString in pathStrings:
+            if pathString in self.lsps:
+                self.logger.info("The path {} already exists.".format(pathString))
+                continue
+            self.logger.info("make_path called with path {}".format(pathString))
+            self._program_lsp(pathString, batches)
+        self._send_batches(batches, callback)
+
+    @metrics.timed('mpls_batch_seconds', op='reconcile')
+    def reconcile(self, desired, callback=None):
+        """ Brings the LSPs in line with a desired set using as few flow mods
+        as possible. LSPs in both are left alone apart from their weight, LSPs
+        no longer desired are removed and new ones installed. A new LSP
+        between the same two hosts as a removed one replaces it in place (see
+        _program_lsp), so the hops both paths share are not touched.
+        The weights set the share of each LSP in the select group at its
+        ingress switch (see _update_fecs), so changing only weights touches
+        nothing but those groups.
+        :param desired: dict of pathString to weight, either one for both
+        directions or a dict of "fwd" and "rev" to the weight of each (see
+        direction_weights).
+        :param callback: as for make_lsps, called for the LSPs sent to switches.
+        :return: the number of flow and group mods sent.
+        """
+        gone = [p for p in self.lsps if p not in desired]
+        by_hosts = defaultdict(list)
+        for pathString in gone:
+            by_hosts[lsp_hosts(pathString)].append(pathString)
+        # pair every new LSP with the removed one between its hosts that
+        # shares the most hops with it
+        pairs = []
+        for pathString in desired:
+            if pathString in self.lsps:
+                continue
+            olds = by_hosts.get(lsp_hosts(pathString))
+            old = None
+            if olds:
+                node_list = pathString.split("-")
+                old = max(olds, key=lambda o: shared_hops(node_list, o.split("-")))
+                olds.remove(old)
+            pairs.append((pathString, old))
+        batches = new_batches()
+        for olds in by_hosts.values():
+            for old in olds:
+                self._unprogram_lsp(old, batches)
+        for pathString, old in pairs:
+            if not self._program_lsp(pathString, batches, old) and old is not None:
+                self._unprogram_lsp(old, batches)
+        for pathString, weight in desired.items():
+            lsp = self.lsps.get(pathString)
+            if lsp is None:
+                continue
+            for d, w in direction_weights(weight).items():
+                if lsp["weight"][d] != w:
+                    lsp["weight"][d] = w  # only the ingress group changes
+                    self.dirty.add(pathString)
+                    self._touch_fec(fec_key(pathString, d), pathString)
+        return self._send_batches(batches, callback)
+
+    def _program_lsp(self, pathString, batches, old=None):
+        """ Computes the flows of both directions of an LSP, records it in
+        self.lsps and queues its flow mods in batches. If old is the pathString
+        of an installed LSP between the same hosts, the new LSP replaces it:
+        in each direction the switches before the two paths part keep their
+        labels and flow entries, the switch where they part has its entry
+        modified, and only the remaining hops are added or deleted. The
+        ingress switch has no entry of its own: the LSP is a bucket of the
+        select group of its FEC. New hops are added before traffic is moved
+        onto them and old hops deleted after, see INSTALL.
+        Returns False if the LSP cannot be created.
         """
-        self.logger.info("make_path called with path {}".format(pathString))
         node_list = pathString.split("-")
-        if not path_valid(self.g, node_list):
+        if self.topo.path(node_list) is None:
             self.logger.info("Invalid path, cannot create!")
-            return
+            return False
         if len(node_list) < 4:
             self.logger.info("No hop and single hops paths not supported")
-            return;
-        src = node_list[0]
-        dst = node_list[-1]
-        fwd_path, fwd_labels = self._get_path_am(node_list)
-        node_list.reverse()
-        rev_path, rev_labels = self._get_path_am(node_list)
-        self._setup_path(fwd_path)
-        self._setup_path(rev_path)
-        self.logger.info("Forward flows: {}".format(fwd_path))
-        self.logger.info("Reverse flows: {}".format(rev_path))
+            return False
+        lsp = self.lsps.get(old) if old is not None else None
+        trace = self.trace_sample > 0 and (pathString in self.traced or old in self.traced)
+        old_list = old.split("-") if lsp else []
+        directions = []
+        for d, nodes, old_nodes in (("fwd", node_list, old_list),
+                                    ("rev", node_list[::-1], old_list[::-1])):
+            p = common_prefix(nodes, old_nodes)
+            # labels of the links between switches both paths start with
+            held = {link: lsp[d + "_labels"][link]
+                    for link in zip(nodes[1:p - 1], nodes[2:p])}
+            try:
+                ma_path, labels = self._get_path_am(nodes, held)
+            except LabelsExhausted as e:
+                for _, _, _, _, taken, kept in directions:
+                    self.labels.release_path({link: label for link, label in taken.items()
+                                              if link not in kept})
+                self.logger.info("{}, cannot create!".format(e))
+                return False
+            directions.append((d, nodes, old_nodes, ma_path, labels, held))
+
+        for d, nodes, old_nodes, ma_path, labels, held in directions:
+            p = common_prefix(nodes, old_nodes)
+            for i in range(max(p - 1, 2), len(nodes) - 1):
+                switch = nodes[i]
+                phase = SWITCHOVER if i == p - 1 else INSTALL
+                batches[phase][switch].append((pathString, self._flow_mod(
+                    switch, ma_path[switch], modify=(i == p - 1), trace=trace)))
+            key = fec_key(pathString, d)
+            fec = self.fecs.get(key)
+            if fec is None:
+                fec = self.fecs[key] = {"group": None, "members": {},
+                                        "match_fields": ma_path[nodes[1]]["match_fields"]}
+            if lsp:
+                # the old LSP leaves its FEC, which differs if the ingress moved
+                old_key = fec_key(old, d)
+                self.fecs[old_key]["members"].pop(old)
+                if old_key != key:
+                    self._touch_fec(old_key, pathString)
+            fec["members"][pathString] = d
+            if p < 3:  # the first label or link differs, so does the bucket
+                self._touch_fec(key, pathString)
+            if lsp:
+                for switch in old_nodes[max(p, 2):-1]:
+                    batches[REMOVE][switch].append((pathString, self._flow_mod(
+                        switch, lsp[d][switch], delete=True)))
+                self.pending_labels.append({link: label for link, label
+                                            in lsp[d + "_labels"].items() if link not in held})
+            self.logger.info("{} flows: {}".format(
+                "Forward" if d == "fwd" else "Reverse", ma_path))
+        if lsp:
+            del self.lsps[old]
+            if old in self.traced:
+                self.traced.discard(old)
+                self.traced.add(pathString)
+        fwd, rev = directions
         # Need to keep enough information about messages sent to switch to
         # create LSP so that we can remove the flow entries latter if asked.
-        self.lsps[pathString] = {"fwd": fwd_path, "rev": rev_path,
-                                 "fwd_labels": fwd_labels,
-                                 "rev_labels": rev_labels}
+        self.lsps[pathString] = {"fwd": fwd[3], "rev": rev[3],
+                                 "fwd_labels": fwd[4],
+                                 "rev_labels": rev[4],
+                                 "weight": lsp["weight"] if lsp else direction_weights(None)}
+        self.dirty.add(pathString)
+        if lsp:
+            self.dirty.add(old)
+        return True
+
+    def start_control_loop(self, demands, **kwargs):
+        """ Starts allocating demands periodically and keeping the LSPs in
+        line with the allocation, see mpls_control.ControlLoop for the
+        arguments."""
+        self.stop_control_loop()
+        self.control = ControlLoop(self, demands, **kwargs)
+        self.control.start()
+        return self.control
+
+    def stop_control_loop(self):
+        """ Stops the control loop; installed LSPs stay as they are."""
+        if self.control is not None:
+            self.control.stop()
+            self.control = None
+
+    def measure_demands(self, estimator=None, classes=None, interval=STATS_INTERVAL):
+        """ Starts polling every switch for the byte counters of its FEC
+        entries and feeding them to a demand estimator, keyed by (priority,
+        source host, destination host). Its records() can be given as the
+        demands of start_control_loop.
+        :param estimator: an estimation.DemandEstimator, a new one if None.
+        :param classes: dict of (source host, destination host) to priority
+        class, DEFAULT_CLASS for the pairs not in it.
+        :param interval: seconds between polls; 0 stops polling.
+        :return: the estimator.
+        """
+        if self.stats_thread is not None:
+            self.stats_thread.kill()
+            self.stats_thread = None
+        self.estimator = estimator or self.estimator or DemandEstimator()
+        self.flow_classes = dict(classes or {})
+        if interval:
+            self.stats_thread = eventlet.spawn(self._poll_stats, interval)
+        return self.estimator
+
+    def _poll_stats(self, interval):
+        while True:
+            for datapath in list(self.switches.values()):
+                ofproto, parser = datapath.ofproto, datapath.ofproto_parser
+                # FEC entries are the only ones matching IPv4
+                datapath.send_msg(parser.OFPFlowStatsRequest(
+                    datapath, 0, ofproto.OFPTT_ALL, ofproto.OFPP_ANY, ofproto.OFPG_ANY,
+                    0, 0, parser.OFPMatch(eth_type=0x800)))
+            eventlet.sleep(interval)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply)
+    def flow_stats_reply(self, event):
+        """ Byte counters of FEC entries, see measure_demands, or the entries
+            of a switch being synced."""
+        if (event.msg.datapath.id, event.msg.xid) in self.syncs:
+            self._sync_reply(event.msg, 0)
+            return
+        if self.estimator is None:
+            return
+        now = time.time()
+        counters = {}
+        for stat in event.msg.body:
+            src = self.host_by_ip.get(stat.match.get('ipv4_src'))
+            dst = self.host_by_ip.get(stat.match.get('ipv4_dst'))
+            if src is None or dst is None:
+                continue
+            key = (self.flow_classes.get((src, dst), DEFAULT_CLASS), src, dst)
+            counters[key] = stat.byte_count
+        if counters:
+            self.estimator.observe(list(counters), list(counters.values()), now)
+
+    def restore_state(self, path):
+        """ Loads the LSPs saved in a state file (see mpls_state.LspStore)
+        and saves every later change to it, before the change is sent to the
+        switches. The entries of the loaded LSPs are rebuilt with their saved
+        labels; each switch is compared with them when it connects and sent
+        only what differs (see _sync), instead of having everything
+        reinstalled.
+        """
+        self.store = LspStore(path)
+        lsps, groups = self.store.load()
+        for switch, is_switch in zip(self.topo.names, self.topo.is_switch):
+            if is_switch:  # until the switch connects
+                self.protocols.setdefault(switch, (ofproto_v1_3, ofproto_v1_3_parser))
+        used = defaultdict(list)
+        for pathString, (weights, fwd_labels, rev_labels) in lsps.items():
+            node_list = pathString.split("-")
+            if self.topo.path(node_list) is None:
+                self.logger.info("Saved LSP {} is not in the topology".format(pathString))
+                continue
+            lsp = {"weight": dict(zip(("fwd", "rev"), weights))}
+            for d, nodes, labels in (("fwd", node_list, fwd_labels),
+                                     ("rev", node_list[::-1], rev_labels)):
+                held = dict(zip(zip(nodes[1:-2], nodes[2:-1]), labels))
+                lsp[d], lsp[d + "_labels"] = self._get_path_am(nodes, held)
+                for link, label in held.items():
+                    used[link].append(label)
+                key = fec_key(pathString, d)
+                fec = self.fecs.get(key)
+                if fec is None:
+                    fec = self.fecs[key] = {"group": groups.get(key), "members": {},
+                                            "match_fields": lsp[d][nodes[1]]["match_fields"]}
+                if fec["group"] is None:
+                    self._touch_fec(key, pathString)
+                fec["members"][pathString] = d
+            self.lsps[pathString] = lsp
+        self.labels.restore(used)
+        group_ids = defaultdict(list)
+        for key, fec in self.fecs.items():
+            if fec["group"] is not None:
+                group_ids[key[0]].append(fec["group"])
+        self.group_ids.restore(group_ids)
+        self.store.snapshot(self._state_records())
+        self.logger.info("Restored {} LSPs from {}".format(len(self.lsps), path))
+
+    def _state_records(self):
+        records = [lsp_record(p, lsp) for p, lsp in self.lsps.items()]
+        records += [encode_group(key, fec["group"]) for key, fec in self.fecs.items()]
+        return records
+
+    def _journal(self, fec_keys):
+        """ Saves the LSPs changed since the last batch and the groups of
+            the FECs in fec_keys."""
+        if self.store is None:
+            self.dirty.clear()
+            return
+        records = []
+        for pathString in self.dirty:
+            lsp = self.lsps.get(pathString)
+            if lsp is None:
+                records.append(encode_delete(pathString))
+            else:
+                records.append(lsp_record(pathString, lsp))
+        for key in fec_keys:
+            fec = self.fecs.get(key)
+            records.append(encode_group(key, fec and fec["group"]))
+        self.dirty.clear()
+        self.store.append(records)
+        if self.store.needs_compaction():
+            self.store.snapshot(self._state_records())
+
+    def _request_sync(self, switch):
+        """ Asks a switch for the flow entries of this app (by cookie) and
+            its groups, see _sync."""
+        datapath = self.switches[switch]
+        ofproto, parser = self.protocols[switch]
+        requests = [parser.OFPFlowStatsRequest(
+                        datapath, 0, ofproto.OFPTT_ALL, ofproto.OFPP_ANY, ofproto.OFPG_ANY,
+                        FLOW_COOKIE, COOKIE_MASK, parser.OFPMatch()),
+                    parser.OFPGroupDescStatsRequest(datapath, 0)]
+        self.sync_replies[switch] = [[], [], len(requests)]
+        for request in requests:
+            datapath.set_xid(request)
+            self.syncs[(datapath.id, request.xid)] = switch
+            datapath.send_msg(request)
+
+    @set_ev_cls(ofp_event.EventOFPGroupDescStatsReply)
+    def group_desc_reply(self, event):
+        if (event.msg.datapath.id, event.msg.xid) in self.syncs:
+            self._sync_reply(event.msg, 1)
+
+    def _sync_reply(self, msg, i):
+        key = (msg.datapath.id, msg.xid)
+        switch = self.syncs[key]
+        replies = self.sync_replies.get(switch)
+        if replies is None:
+            del self.syncs[key]
+            return
+        replies[i].extend(msg.body)
+        if msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return
+        del self.syncs[key]
+        replies[2] -= 1
+        if replies[2] == 0:
+            del self.sync_replies[switch]
+            self._sync(switch, replies[0], replies[1])
+
+    def _sync(self, switch, flow_stats, group_descs):
+        """ Brings the entries and groups of a switch in line with the LSPs
+            by sending only the differences: groups and entries that are
+            missing or differ are added or modified, those no LSP needs any
+            more are deleted.
+            :param flow_stats: the flow stats of the entries of this app.
+            :param group_descs: the group descriptions of the switch.
+        """
+        if switch not in self.switches:
+            return
+        ofproto, parser = self.protocols[switch]
+        datapath = self.switches[switch]
+        present = {match_key(stat.match.items()):
+                   packed(stat.instructions[0].actions if stat.instructions else [])
+                   for stat in flow_stats}
+        present_groups = {desc.group_id: packed_buckets(desc.buckets) for desc in group_descs}
+        groups = {}
+        flows = {}
+        for key, fec in self.fecs.items():
+            if key[0] == switch and fec["group"] is not None and fec["members"]:
+                groups[fec["group"]] = self._fec_buckets(key)
+                flows[match_key(fec["match_fields"].items())] = (
+                    {"match_fields": fec["match_fields"],
+                     "actions": [parser.OFPActionGroup(fec["group"])]}, False)
+        for pathString, lsp in self.lsps.items():
+            trace = self.trace_sample > 0 and pathString in self.traced
+            for d in ("fwd", "rev"):
+                flow = lsp[d].get(switch)
+                if flow is not None and switch != next(iter(lsp[d])):
+                    flows[match_key(flow["match_fields"].items())] = (flow, trace)
+        mods = []
+        for group, buckets in groups.items():
+            if present_groups.get(group) != packed_buckets(buckets):
+                command = ofproto.OFPGC_MODIFY if group in present_groups else ofproto.OFPGC_ADD
+                mods.append((None, parser.OFPGroupMod(
+                    datapath, command, ofproto.OFPGT_SELECT, group, buckets)))
+        for key, (flow, trace) in flows.items():
+            actions = flow["actions"]
+            if trace:
+                actions = [parser.OFPActionGroup(TRACE_GROUP_ID)] + actions
+            if present.get(key) != packed(actions):
+                mods.append((None, self._flow_mod(switch, flow, trace=trace)))
+        for key in present:
+            if key not in flows:
+                mods.append((None, self._flow_mod(
+                    switch, {"match_fields": dict(key), "actions": []}, delete=True)))
+        for group in present_groups:
+            if group not in groups and group != TRACE_GROUP_ID:
+                mods.append((None, parser.OFPGroupMod(
+                    datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_SELECT, group)))
+        self.logger.info("Switch {} synced: {} messages for {} entries and {} groups".format(
+            switch, len(mods), len(flows), len(groups)))
+        if mods:
+            batches = new_batches()
+            batches[SWITCHOVER][switch] = mods
+            self._send_batches(batches)
+
+    def set_trace(self, sample=0, max_len=TRACE_BYTES):
+        """ Turns tracing on or off at runtime. With tracing on, every switch
+        along a traced LSP mirrors 1 in sample of its packets to the controller
+        through a select group (weights 1 and sample - 1), truncated to
+        max_len bytes. Switches pick a bucket per flow hash, so the sampling
+        is over flows rather than single packets on most of them.
+        :param sample: sampling ratio N, 0 turns tracing off.
+        :param max_len: bytes of each mirrored packet sent to the controller.
+        """
+        was_on = self.trace_sample > 0
+        self.trace_sample = sample
+        self.trace_bytes = max_len
+        if sample:
+            for switch in self.switches:
+                self._send_trace_group(switch)
+        if was_on != (sample > 0):
+            self._retrace(self.traced)
+        if was_on and not sample:
+            # Deleting the group would delete the flows using it, so it is
+            # emptied instead once the flows no longer point at it.
+            for switch in list(self.trace_groups):
+                self._send_trace_group(switch)
+
+    def trace_lsp(self, pathString, enable=True):
+        """ Includes (or excludes) an LSP in tracing, see set_trace."""
+        if pathString not in self.lsps:
+            self.logger.info("The path {} does not exist.".format(pathString))
+            return
+        if enable:
+            self.traced.add(pathString)
+        else:
+            self.traced.discard(pathString)
+        if self.trace_sample:
+            self._retrace([pathString])
+
+    def _retrace(self, pathStrings):
+        """ Rewrites the entries of LSPs with or without the trace action."""
+        batches = new_batches()
+        for pathString in pathStrings:
+            trace = self.trace_sample > 0 and pathString in self.traced
+            lsp = self.lsps[pathString]
+            for d in ("fwd", "rev"):
+                self._touch_fec(fec_key(pathString, d), pathString)
+                for switch, flow in list(lsp[d].items())[1:]:
+                    batches[SWITCHOVER][switch].append((pathString, self._flow_mod(
+                        switch, flow, modify=True, trace=trace)))
+        self._send_batches(batches)
+
+    def _send_trace_group(self, switch):
+        """ Installs or updates the trace group of a switch for the current
+            sampling, followed by a barrier so that flows sent afterwards can
+            refer to it."""
+        datapath = self.switches[switch]
+        ofproto, parser = self.protocols[switch]
+        buckets = []
+        if self.trace_sample:
+            mirror = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, self.trace_bytes)]
+            buckets.append(parser.OFPBucket(weight=1, actions=mirror))
+            if self.trace_sample > 1:
+                buckets.append(parser.OFPBucket(weight=self.trace_sample - 1, actions=[]))
+        command = ofproto.OFPGC_MODIFY if switch in self.trace_groups else ofproto.OFPGC_ADD
+        datapath.send_msg(parser.OFPGroupMod(datapath, command, ofproto.OFPGT_SELECT,
+                                             TRACE_GROUP_ID, buckets))
+        datapath.send_msg(parser.OFPBarrierRequest(datapath))
+        self.trace_groups.add(switch)
 
     def show_all_lsps(self):
         """Displays a list of current LSPs in the network."""
@@ -148,59 +739,216 @@ class SimpleMPLS(app_manager.RyuApp):
         for pathString in list(self.lsps.keys()):
             self.logger.info("\t {}".format(pathString))
 
-    def _setup_path(self, ma_path):
-        """ Sends flow mod messages to each switch along a unidirectional path.
-            Given a dictionary of matches and action for each switch. """
-        for switch, flow in ma_path.items():
-            datapath = self.switches[switch]
-            ofproto = datapath.ofproto
-            parser = datapath.ofproto_parser
-            # construct flow_mod message and send it.
-            inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
-                                                 flow["actions"])]
-            match = parser.OFPMatch(**flow["match_fields"])
-            mod = parser.OFPFlowMod(datapath=datapath, priority=20,
-                                    flags=ofproto.OFPFF_SEND_FLOW_REM,
-                                    match=match, instructions=inst)
-            datapath.send_msg(mod)  # Sends the actual message (finally!)
-
-    def remove_lsp(self, pathString):
-        """ Removes forward and reverse LSP for a previously setup path."""
-        if pathString not in list(self.lsps.keys()):
-            self.logger.info("The path {} does not exist.".format(pathString))
+    def _flow_mod(self, switch, flow, delete=False, modify=False, trace=False):
+        """ Builds the flow mod adding (or deleting, or modifying the actions
+            of) one entry of a path. A traced entry first hands a copy of
+            each packet to the trace group."""
+        datapath = self.switches.get(switch)  # None while it is down
+        ofproto, parser = self.protocols[switch]
+        actions = flow["actions"]
+        if trace:
+            actions = [parser.OFPActionGroup(TRACE_GROUP_ID)] + actions
+        # construct flow_mod message
+        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
+                                             actions)]
+        match = parser.OFPMatch(**flow["match_fields"])
+        if delete:
+            return parser.OFPFlowMod(datapath=datapath,
+                                     command=ofproto.OFPFC_DELETE,
+                                     table_id=ofproto.OFPTT_ALL,
+                                     out_port=ofproto.OFPP_ANY,
+                                     out_group=ofproto.OFPG_ANY,
+                                     priority=20, match=match, instructions=inst)
+        if modify:
+            return parser.OFPFlowMod(datapath=datapath, cookie=FLOW_COOKIE,
+                                     command=ofproto.OFPFC_MODIFY,
+                                     priority=20, match=match, instructions=inst)
+        return parser.OFPFlowMod(datapath=datapath, cookie=FLOW_COOKIE, priority=20,
+                                 flags=ofproto.OFPFF_SEND_FLOW_REM,
+                                 match=match, instructions=inst)
+
+    def _send_batches(self, batches, callback=None):
+        """ Sends a batch of changes (see new_batches) one phase at a time:
+            each switch gets its flow mods of the phase pipelined, followed
+            by one barrier, and the next phase goes out once every switch
+            has answered. The group changes of the FECs touched since the
+            last batch join the SWITCHOVER phase. A message of None only
+            makes pathString wait for the barrier of that switch. Batches
+            are sent in order, one at a time, so a later one cannot overtake
+            the phases of an earlier one, and the labels a batch frees are
+            released once it is confirmed. Switches that are down are skipped.
+            Returns the number of messages queued, barriers excluded."""
+        touched = list(self.pending_fecs)
+        self._update_fecs(batches)
+        self._journal(touched)
+        phases = deque(batch for batch in batches if batch)
+        lsps = set(pathString for batch in phases for mods in batch.values()
+                   for pathString, _ in mods if pathString is not None)
+        for pathString in lsps:
+            waiting = self.unconfirmed.setdefault(pathString, [0, callback])
+            waiting[0] += 1
+        queued = sum(mod is not None for batch in phases for switch, mods in batch.items()
+                     if switch in self.switches for _, mod in mods)
+        self.transactions.append({"phases": phases, "lsps": lsps, "waiting": 0,
+                                  "labels": self.pending_labels})
+        self.pending_labels = []
+        if len(self.transactions) == 1:
+            self._send_phase()
+        return queued
+
+    def _send_phase(self):
+        """ Sends the next phase of the oldest batch, or confirms the batch
+            if it has none left and goes on with the next one."""
+        while self.transactions:
+            transaction = self.transactions[0]
+            phases = transaction["phases"]
+            while phases and not transaction["waiting"]:
+                kinds = defaultdict(int)
+                for switch, mods in phases.popleft().items():
+                    datapath = self.switches.get(switch)
+                    if datapath is None:
+                        continue
+                    for _, mod in mods:
+                        if mod is not None:
+                            datapath.send_msg(mod)  # Sends the actual message (finally!)
+                            kinds[type(mod).__name__] += 1
+                    barrier = datapath.ofproto_parser.OFPBarrierRequest(datapath)
+                    datapath.set_xid(barrier)
+                    self.barriers[(datapath.id, barrier.xid)] = (transaction, time.perf_counter())
+                    transaction["waiting"] += 1
+                    datapath.send_msg(barrier)
+                    kinds['OFPBarrierRequest'] += 1
+                for kind, n in kinds.items():
+                    counter = self.m_sent.get(kind)
+                    if counter is None:
+                        counter = self.m_sent[kind] = metrics.REGISTRY.counter(
+                            'mpls_messages_sent_total', 'OpenFlow messages sent', type=kind)
+                    counter.inc(n)
+            if transaction["waiting"]:
+                return
+            self.transactions.popleft()
+            for labels in transaction["labels"]:
+                self.labels.release_path(labels)
+            for pathString in transaction["lsps"]:
+                waiting = self.unconfirmed[pathString]
+                waiting[0] -= 1
+                if waiting[0] == 0:
+                    del self.unconfirmed[pathString]
+                    self.logger.info("LSP {} confirmed by all switches".format(pathString))
+                    if waiting[1] is not None:
+                        waiting[1](pathString)
+
+    def _touch_fec(self, key, pathString):
+        """ Marks the group of a FEC for update, on behalf of an LSP."""
+        self.pending_fecs.setdefault(key, set()).add(pathString)
+
+    def _update_fecs(self, batches):
+        """ Queues the ingress changes of the touched FECs after the other
+            messages of their switch: the select group gets one bucket per
+            member LSP, weighted by the weights of the LSPs in the direction
+            of the FEC, and is added together with the entry pointing the FEC
+            at it, modified in place, or deleted with that entry once no LSP
+            is left."""
+        for key, pathStrings in self.pending_fecs.items():
+            switch = key[0]
+            fec = self.fecs[key]
+            datapath = self.switches.get(switch)
+            ofproto, parser = self.protocols[switch]
+            entry = {"match_fields": fec["match_fields"],
+                     "actions": [parser.OFPActionGroup(fec["group"])]}
+            mods = batches[SWITCHOVER][switch]
+            if not fec["members"]:
+                if fec["group"] is not None:
+                    mods.append((None, self._flow_mod(switch, entry, delete=True)))
+                    mods.append((None, parser.OFPGroupMod(
+                        datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_SELECT, fec["group"])))
+                    self.group_ids.release(switch, fec["group"])
+                del self.fecs[key]
+            else:
+                buckets = self._fec_buckets(key)
+                if fec["group"] is None:
+                    fec["group"] = self.group_ids.allocate(switch)
+                    entry["actions"] = [parser.OFPActionGroup(fec["group"])]
+                    mods.append((None, parser.OFPGroupMod(
+                        datapath, ofproto.OFPGC_ADD, ofproto.OFPGT_SELECT, fec["group"], buckets)))
+                    mods.append((None, self._flow_mod(switch, entry)))
+                else:
+                    mods.append((None, parser.OFPGroupMod(
+                        datapath, ofproto.OFPGC_MODIFY, ofproto.OFPGT_SELECT, fec["group"], buckets)))
+            mods.extend((pathString, None) for pathString in pathStrings)
+        self.pending_fecs = {}
+
+    def _fec_buckets(self, key):
+        """ The select group buckets of a FEC, one per member LSP."""
+        fec = self.fecs[key]
+        switch = key[0]
+        parser = self.protocols[switch][1]
+        members = list(fec["members"].items())
+        weights = bucket_weights([self.lsps[p]["weight"][d] for p, d in members])
+        buckets = []
+        for (pathString, d), weight in zip(members, weights):
+            actions = self.lsps[pathString][d][switch]["actions"]
+            if self.trace_sample > 0 and pathString in self.traced:
+                actions = [parser.OFPActionGroup(TRACE_GROUP_ID)] + actions
+            buckets.append(parser.OFPBucket(weight=weight, actions=actions))
+        return buckets
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply)
+    def barrier_reply(self, event):
+        """ A switch has processed every flow mod sent before the barrier.
+            Once every switch of a phase has, the next phase is sent; LSPs
+            whose batches have all been sent and answered are reported
+            complete."""
+        msg = event.msg
+        self._barrier_done((msg.datapath.id, msg.xid))
+
+    def _barrier_done(self, key):
+        transaction, sent = self.barriers.pop(key, (None, None))
+        if transaction is None:
             return
-        lsp = self.lsps[pathString]
-        self._remove_path(lsp["fwd"])  # Remove flow table entries forward
-        self._remove_path(lsp["rev"])  # Remove flow table entries reverse
-        #  Remove link labels from our internal network state
-        for link, label in lsp["fwd_labels"].items():
-            self.link_labels[link].remove(label)
-        for link, label in lsp["rev_labels"].items():
-            self.link_labels[link].remove(label)
-        del self.lsps[pathString]
-
-    def _remove_path(self, ma_path):
-        """Creates and send messages to remove flow table entries along a path.
-            Given matches and actions for each switch (ma_path)"""
-        self.logger.info("Remove path: {}".format(ma_path))
-        for switch, flow in ma_path.items():
-            datapath = self.switches[switch]
-            ofproto = datapath.ofproto
-            parser = datapath.ofproto_parser
-            # construct flow_mod message and send it.
-            inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
-                                                 flow["actions"])]
-            match = parser.OFPMatch(**flow["match_fields"])
-            mod = parser.OFPFlowMod(datapath=datapath,
-                                    command=ofproto.OFPFC_DELETE,
-                                    table_id=ofproto.OFPTT_ALL,
-                                    out_port=ofproto.OFPP_ANY,
-                                    out_group=ofproto.OFPG_ANY,
-                                    priority=20, match=match, instructions=inst)
-            self.logger.info("sending fwd del to switch {} match {} inst {}".format(switch, match, inst))
-            datapath.send_msg(mod)
-
-    def _get_path_am(self, node_list):
+        self.m_barrier.observe(time.perf_counter() - sent)
+        transaction["waiting"] -= 1
+        if not transaction["waiting"]:
+            self._send_phase()
+
+    def remove_lsp(self, pathString, callback=None):
+        """ Removes forward and reverse LSP for a previously setup path."""
+        self.remove_lsps([pathString], callback)
+
+    @metrics.timed('mpls_batch_seconds', op='remove')
+    def remove_lsps(self, pathStrings, callback=None):
+        """ Removes many LSPs at once, batched per switch like make_lsps. The
+            callback gets each pathString once its entries are gone from every
+            switch."""
+        batches = new_batches()
+        for pathString in pathStrings:
+            if pathString not in self.lsps:
+                self.logger.info("The path {} does not exist.".format(pathString))
+                continue
+            self._unprogram_lsp(pathString, batches)
+        self._send_batches(batches, callback)
+
+    def _unprogram_lsp(self, pathString, batches):
+        """ Forgets an LSP and queues the deletion of its flow entries, after
+            its buckets have left the groups at its ingress switches."""
+        lsp = self.lsps.pop(pathString)
+        self.dirty.add(pathString)
+        self.traced.discard(pathString)
+        # Remove flow table entries forward and reverse, and the buckets of
+        # the LSP from the groups at its ingress switches
+        for d in ("fwd", "rev"):
+            ma_path = lsp[d]
+            self.logger.info("Remove path: {}".format(ma_path))
+            key = fec_key(pathString, d)
+            self.fecs[key]["members"].pop(pathString)
+            self._touch_fec(key, pathString)
+            for switch, flow in list(ma_path.items())[1:]:
+                batches[REMOVE][switch].append((pathString, self._flow_mod(
+                    switch, flow, delete=True)))
+        #  Remove link labels from our internal network state, see pending_labels
+        self.pending_labels += [lsp["fwd_labels"], lsp["rev_labels"]]
+
+    def _get_path_am(self, node_list, held=None):
         """ Figures out the OpenFlow actions and matches needed for each MPLS
             switch along the path including label push, swap, and pop. This
             applies to a valid unidirectional path where the first and last
@@ -208,124 +956,192 @@ class SimpleMPLS(app_manager.RyuApp):
 
             Returns structure (python dictionary) of the matches and actions
             needed for each flow mod message to be sent to each switch along the
-            path. Also returns the labels used on each link along the path.
+            path. Also returns the labels used on each link along the path;
+            the links in held keep the label given there.
             """
-        src = node_list[0]
-        dst = node_list[-1]
-        labels_used = {}
+        topo = self.topo
+        # Node numbers along the path, and the edge number of each hop:
+        # hop i goes from node_list[i] to node_list[i + 1].
+        ids, edges = topo.path(node_list)
+        # One label per link between switches, all taken up front
+        with self.m_labels.time():
+            labels_used = self.labels.reserve_path(node_list[1:-1], held)
         switch_flows = OrderedDict()
-        g = self.g
         # Prepare first switch here
-        datapath = self.switches[node_list[1]]
-        ofproto = datapath.ofproto  # Gets the OpenFlow constants
-        parser = datapath.ofproto_parser  # Gets the OpenFlow data structures
-        # Get the list of labels used on the first MPLS link
-        label_list = self.link_labels[(node_list[1], node_list[2])]
-        plabel = assign_label(label_list)
-        labels_used[(node_list[1], node_list[2])] = plabel
+        parser = self.protocols[node_list[1]][1]
+        plabel = labels_used[(node_list[1], node_list[2])]
         # Sets up the MPLS forwarding equivalence class for the LSP
-        match_fields = {"in_port": get_in_port(g, node_list[0], node_list[1]),
+        match_fields = {"in_port": topo.in_port[edges[0]],
                         "eth_type": 0x800,
-                        "ipv4_src": g.node[src]['ip'],
-                        "ipv4_dst": g.node[dst]['ip']}
-        # The first action is only for debugging purposes and sends the matched
-        # packet received to the controller for inspection.
-        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER),  # Debugging
-                   parser.OFPActionPushMpls(),
+                        "ipv4_src": topo.ip[ids[0]],
+                        "ipv4_dst": topo.ip[ids[-1]]}
+        actions = [parser.OFPActionPushMpls(),
                    parser.OFPActionSetField(mpls_label=plabel),
-                   parser.OFPActionOutput(
-                       get_out_port(g, node_list[1], node_list[2]))
+                   parser.OFPActionOutput(topo.out_port[edges[1]])
                    ]
         switch_flows[node_list[1]] = {"match_fields": match_fields,
                                       "actions": actions}
         # Now the rest of the switches
         for i in range(2, len(node_list) - 1):
-            datapath = self.switches[node_list[i]]
-            ofproto = datapath.ofproto
-            parser = datapath.ofproto_parser
+            parser = self.protocols[node_list[i]][1]
             match_fields = {
-                "in_port": get_in_port(g, node_list[i - 1], node_list[i]),
+                "in_port": topo.in_port[edges[i - 1]],
                 "eth_type": 0x8847,
                 "mpls_label": plabel
             }
             if i < len(node_list) - 2:
-                label_list = self.link_labels[(node_list[i], node_list[i + 1])]
-                olabel = assign_label(label_list)
-                labels_used[(node_list[i], node_list[i + 1])] = olabel
-                actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER),  # for debugging
-                           parser.OFPActionDecMplsTtl(),
+                olabel = labels_used[(node_list[i], node_list[i + 1])]
+                actions = [parser.OFPActionDecMplsTtl(),
                            parser.OFPActionSetField(mpls_label=olabel),
-                           parser.OFPActionOutput(get_out_port(g, node_list[i],
-                                                               node_list[
-                                                                   i + 1]))]
+                           parser.OFPActionOutput(topo.out_port[edges[i]])]
                 plabel = olabel  # output label becomes the next input label
             else:  # Last switch, we need to pop
-                actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER),  # for debugging
-                           parser.OFPActionPopMpls(),
-                           parser.OFPActionOutput(get_out_port(g, node_list[i],
-                                                               node_list[
-                                                                   i + 1]))]
+                actions = [parser.OFPActionPopMpls(),
+                           parser.OFPActionOutput(topo.out_port[edges[i]])]
             switch_flows[node_list[i]] = {"match_fields": match_fields,
                                           "actions": actions}
         return switch_flows, labels_used
 
     @set_ev_cls(ofp_event.EventOFPPacketIn)
     def packet_in(self, event):
-        """ Handles packets sent to the controller.
-            Used for debugging."""
+        """ Handles packets mirrored to the controller by tracing. Only the
+            headers needed for the trace record are decoded."""
+        self.m_packet_in.inc()
+        if not self.trace_sample:
+            return
         msg = event.msg
-        dp = msg.datapath
-        # Assumes that datapath ID represents an ascii name
-        switchName = dpidDecode(dp.id)
-        packet = Packet(msg.data)
-        # self.logger.info("packet: {}".format(msg))
-        ether = packet.get_protocol(ryu.lib.packet.ethernet.ethernet)
-        ethertype = ether.ethertype
-        self.logger.info(" Switch {} received packet with ethertype: {}".format(switchName, hex(ethertype)))
-        if ethertype == 0x8847:
-            mpls = packet.get_protocol(ryu.lib.packet.mpls.mpls)
-            self.logger.info("Label: {}, TTL: {}".format(mpls.label, mpls.ttl))
-        ipv4 = packet.get_protocol(ryu.lib.packet.ipv4.ipv4)
-        if ipv4:
-            self.logger.info("IPv4 src: {} dst: {}".format(
-                ipv4.src, ipv4.dst))
-
-
-def assign_label(label_list):
-    """Given the current label list finds a value not in the list,
-        adds the value to the list and returns it."""
-    # very simplistic algorithm, not good when lots of labels.
-    if not label_list:
-        new_label = random.randint(1, 1000)
+        try:
+            headers = trace_headers(msg.data)
+        except (struct.error, IndexError):
+            return
+        record = (dpidDecode(msg.datapath.id),) + headers
+        self.trace_log.append(record)
+        self.logger.info("Trace {}: ethertype {:#x} label {} ttl {} "
+                         "src {} dst {}".format(*record))
+
+
+def trace_headers(data):
+    """ Decodes just the ethertype, the top MPLS label and TTL (None if the
+        packet is not MPLS) and the IPv4 source and destination (None if it
+        does not carry IPv4) of an Ethernet frame."""
+    ethertype, = struct.unpack_from("!H", data, 12)
+    offset = 14
+    label = ttl = src = dst = None
+    if ethertype == 0x8847:
+        word, = struct.unpack_from("!I", data, offset)
+        label, ttl = word >> 12, word & 0xff
+        while not (word >> 8) & 1:  # walk to the bottom of the label stack
+            offset += 4
+            word, = struct.unpack_from("!I", data, offset)
+        offset += 4
+        is_ipv4 = data[offset] >> 4 == 4
     else:
-        new_label = random.randint(1, 1000)
-        while new_label in label_list:
-            new_label = random.randint(1, 1000)
-    label_list.append(new_label)
-    return new_label
-
-
-def path_valid(g, p):
-    """ Checks whether the list nodes p is a valid path in g."""
-    plen = len(p)
-    for i in range(plen - 1):
-        if not g.has_edge(p[i], p[i + 1]):  # nice NetworkX graph feature.
-            return False
-    return True
+        is_ipv4 = ethertype == 0x800
+    if is_ipv4:
+        src = socket.inet_ntoa(data[offset + 12:offset + 16])
+        dst = socket.inet_ntoa(data[offset + 16:offset + 20])
+    return ethertype, label, ttl, src, dst
+
+
+def new_batches():
+    """ Empty batches of the phases INSTALL, SWITCHOVER and REMOVE, each a
+        dict of switch name to (pathString, message) pairs."""
+    return [defaultdict(list) for _ in range(REMOVE + 1)]
+
+
+def lsp_hosts(pathString):
+    """ The two hosts an LSP connects."""
+    node_list = pathString.split("-")
+    return node_list[0], node_list[-1]
+
+
+def fec_key(pathString, d):
+    """ The FEC of one direction ("fwd" or "rev") of an LSP: its ingress
+        switch, source host and destination host."""
+    node_list = pathString.split("-")
+    if d == "rev":
+        node_list.reverse()
+    return node_list[1], node_list[0], node_list[-1]
+
+
+def direction_weights(weight):
+    """ The weight of each direction of an LSP, from one weight for both
+        or a dict of "fwd" and "rev" to a weight each (None if not given)."""
+    if isinstance(weight, dict):
+        return {"fwd": weight.get("fwd"), "rev": weight.get("rev")}
+    return {"fwd": weight, "rev": weight}
+
+
+def bucket_weights(weights):
+    """ Select group bucket weights in proportion to LSP weights, adding up
+        to about BUCKET_WEIGHT_SCALE. LSPs without a weight count as 1; if
+        no LSP has a positive weight, all get the same."""
+    weights = [1.0 if w is None else max(float(w), 0.0) for w in weights]
+    total = sum(weights)
+    if total <= 0:
+        return [1] * len(weights)
+    return [int(round(BUCKET_WEIGHT_SCALE * w / total)) or (1 if w > 0 else 0)
+            for w in weights]
 
 
-def get_out_port(g, n1, n2):
-    """ Get the output port for n1 to send to n2
-        assuming n1 and n2 are connected and ports are assigned to links."""
-    # Uses nifty NetworkX graph representation.
-    return g[n1][n2]["ports"][n1]
+def common_prefix(a, b):
+    """ Number of leading nodes two paths have in common."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
 
 
-def get_in_port(g, n1, n2):
-    """ Get the output port for n2 to receive from n1
-        assuming n1 and n2 are connected and ports are assigned to links."""
-    # Uses nifty NetworkX graph representation.
-    return g[n1][n2]["ports"][n2]
+def shared_hops(a, b):
+    """ Nodes two paths share from either end."""
+    return common_prefix(a, b) + common_prefix(a[::-1], b[::-1])
+
+
+def path_labels(pathString, lsp):
+    """ The labels of both directions of an LSP, each in path order."""
+    node_list = pathString.split("-")
+    out = []
+    for d, nodes in (("fwd", node_list), ("rev", node_list[::-1])):
+        out.append([lsp[d + "_labels"][link] for link in zip(nodes[1:-2], nodes[2:-1])])
+    return out
+
+
+def lsp_record(pathString, lsp):
+    """ The state record of an LSP, see mpls_state.encode_lsp."""
+    weights = (lsp["weight"]["fwd"], lsp["weight"]["rev"])
+    return encode_lsp(pathString, weights, *path_labels(pathString, lsp))
+
+
+def match_key(items):
+    """ A hashable form of the fields of a match."""
+    return tuple(sorted(items))
+
+
+def packed(objs):
+    """ The OpenFlow encoding of actions or buckets, to compare them."""
+    buf = bytearray()
+    for obj in objs:
+        obj.serialize(buf, len(buf))
+    return bytes(buf)
+
+
+def packed_buckets(buckets):
+    """ The buckets of a group in a form that compares equal whatever their
+        order."""
+    return tuple(sorted(packed([bucket]) for bucket in buckets))
+
+
+def read_network(netfile):
+    """ The NetworkX graph of a network file. The files keep their links
+        under "links", which networkx 3.6 no longer reads by default."""
+    with open(netfile) as f:
+        data = json.load(f)
+    try:
+        return json_graph.node_link_graph(data, edges="links")
+    except TypeError:  # networkx before 3.4 has no edges argument
+        return json_graph.node_link_graph(data)
 
 
 def dpidDecode(aLong):
@@ -0,0 +1,136 @@
+# Allocation benchmarks on synthetic topologies and demands
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import simulation_swan
+import tunnelgen
+from flowtable import FlowTable, PRIORITIES
+from swan_controller import Allocator
+
+# name -> (datacenters, bidirectional links, flows); gscale matches simulation_swan
+SCALES = {'gscale': (simulation_swan.NUM_DC, simulation_swan.NUM_LINKS, 1000),
+          'x4': (48, 80, 10000),
+          'x16': (200, 320, 100000)}
+ALPHA = 2  # appx_maxmin step factor, as in the SWAN paper
+
+
+def synthetic_topology(n_dc, n_links, seed=0):
+    """ A connected random topology: a random spanning tree plus random extra
+        links until there are n_links, each usable in both directions.
+        :return: ingress and egress name of every directed link.
+    """
+    rng = np.random.default_rng(seed)
+    names = np.array(['dc{}'.format(i) for i in range(n_dc)])
+    order = rng.permutation(n_dc)
+    edges = {tuple(sorted((order[i], order[rng.integers(i)]))) for i in range(1, n_dc)}
+    max_links = n_dc * (n_dc - 1) // 2
+    while len(edges) < min(n_links, max_links):
+        a, b = rng.choice(n_dc, 2, replace=False)
+        edges.add((min(a, b), max(a, b)))
+    a, b = np.array(sorted(edges)).T
+    return names[np.concatenate([a, b])], names[np.concatenate([b, a])]
+
+
+def synthetic_demands(nodes, n_flows, seed=0, max_demand=simulation_swan.MAX_DEMAND):
+    """ n_flows flows between random distinct node pairs, spread evenly over
+        the priority classes, with lognormal demands capped at max_demand."""
+    rng = np.random.default_rng(seed)
+    n = len(nodes)
+    src = rng.integers(n, size=n_flows)
+    dst = (src + rng.integers(1, n, size=n_flows)) % n
+    priority = rng.integers(len(PRIORITIES), size=n_flows)
+    demand = np.minimum(rng.lognormal(np.log(max_demand / 8), 1.0, size=n_flows), max_demand)
+    return FlowTable(priority, src, dst, demand, np.asarray(nodes))
+
+
+def scenario(scale, seed=0):
+    """ Topology and demands of one scale, with link capacities set so that the
+        total demand would fill every link once.
+        :param scale: a name in SCALES or a (datacenters, links, flows) tuple.
+        :return: flows, link ingress and egress, the (ingress, egress) pairs
+        with demand, and link capacities.
+    """
+    n_dc, n_links, n_flows = SCALES[scale] if isinstance(scale, str) else scale
+    ingress, egress = synthetic_topology(n_dc, n_links, seed)
+    nodes = np.unique(np.concatenate([ingress, egress]))
+    flows = synthetic_demands(nodes, n_flows, seed)
+    f_src, f_dst = flows.endpoints()
+    pairs = sorted(set(zip(f_src.tolist(), f_dst.tolist())))
+    capacity = np.full(len(ingress), flows.demand.sum() / len(ingress))
+    return flows, ingress, egress, pairs, capacity
+
+
+def run(scale, seed=0, repeat=3, k=simulation_swan.NUM_TUNNELS):
+    """ Benchmarks one scale: tunnel generation (for the pairs with demand,
+        bypassing the tunnel cache), swan_allocation, and appx_maxmin of every
+        class. Every phase is timed repeat times and reported as its best and
+        median wall time. Peak Python/NumPy memory of each phase is taken in a
+        separate run under tracemalloc, which slows the code down; memory
+        allocated inside the LP solver is not seen by it.
+        :return: dict of results, JSON serializable.
+    """
+    flows, ingress, egress, pairs, capacity = scenario(scale, seed)
+    links = list(zip(ingress.tolist(), egress.tolist()))
+    tunnels = tunnelgen.generate(ingress, egress, k=k, pairs=pairs)
+
+    def swan_allocation():
+        Allocator(flows, links, tunnels, capacity).swan_allocation()
+
+    def appx_maxmin():
+        alloc = Allocator(flows, links, tunnels, capacity)
+        for pri in PRIORITIES:
+            alloc.appx_maxmin(ALPHA, 1.0, pri, alloc.rem_c)
+
+    result = {'scale': scale if isinstance(scale, str) else list(scale), 'seed': seed,
+              'datacenters': len(np.unique(np.concatenate([ingress, egress]))),
+              'links': len(links), 'flows': len(flows), 'tunnels': len(tunnels)}
+    phases = {'tunnel_generation': lambda: tunnelgen.generate(ingress, egress, k=k, pairs=pairs),
+              'swan_allocation': swan_allocation,
+              'appx_maxmin': appx_maxmin}
+    for name, fn in phases.items():
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result[name] = {'best': min(times), 'median': statistics.median(times),
+                        'seconds': times, 'peak_bytes': peak}
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the SWAN allocator.")
+    parser.add_argument('--scale', nargs='+', default=['gscale', 'x4'],
+                        help="scales to run: {} or DCS,LINKS,FLOWS".format(', '.join(SCALES)))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help="JSON file to write, stdout if not given")
+    args = parser.parse_args(argv)
+
+    results = {'python': platform.python_version(), 'numpy': np.__version__,
+               'machine': platform.machine(), 'runs': []}
+    for scale in args.scale:
+        if scale not in SCALES:
+            scale = tuple(int(x) for x in scale.split(','))
+        results['runs'].append(run(scale, args.seed, args.repeat))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
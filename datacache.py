@@ -0,0 +1,81 @@
+# On-disk cache of parsed simulation inputs
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+CACHE_DIR = '.swan_cache'
+MANIFEST = 'manifest.json'
+# Part of every key; bump when the arrays stored for the same sources change
+FORMAT_VERSION = 1
+
+
+def load(sources, build, cache_dir=CACHE_DIR):
+    """ Returns the dict of arrays build() makes out of the source files, from
+        the cache when possible. Entries are keyed by a hash of the sources'
+        contents and FORMAT_VERSION and stored as one .npy file per array,
+        loaded memory-mapped (copy-on-write, so callers may still modify them
+        in memory). A source whose size and mtime match the manifest is not
+        re-hashed.
+    """
+    key = _key(sources, cache_dir)
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        names = [f[:-4] for f in os.listdir(entry) if f.endswith('.npy')]
+        return {n: np.load(os.path.join(entry, n + '.npy'), mmap_mode='c') for n in names}
+
+    arrays = build()
+    tmp = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.asarray(arr))
+        os.replace(tmp, entry)  # readers never see a half written entry
+    except OSError:
+        if not os.path.isdir(entry):
+            raise
+        # another process stored the same entry first
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return arrays
+
+
+def _key(sources, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, MANIFEST)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    digest = hashlib.sha1('format {}'.format(FORMAT_VERSION).encode())
+    changed = False
+    for src in sources:
+        st = os.stat(src)
+        known = manifest.get(os.path.abspath(src))
+        if known is None or known['mtime_ns'] != st.st_mtime_ns or known['size'] != st.st_size:
+            known = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'sha1': _hash_file(src)}
+            manifest[os.path.abspath(src)] = known
+            changed = True
+        digest.update(known['sha1'].encode())
+    if changed:
+        fd, tmp = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, path)
+    return digest.hexdigest()
+
+
+def _hash_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def clear(cache_dir=CACHE_DIR):
+    shutil.rmtree(cache_dir, ignore_errors=True)
@@ -0,0 +1,174 @@
+# Streaming demand estimation from flow byte counters
+import numpy as np
+
+import loadfiles
+from flowtable import PRIORITIES
+
+# Columns of a trace file: cumulative bytes of a flow at a time in seconds
+TRACE_COLUMNS = {'Time': np.float64, 'Priority': str, 'Source': str, 'Destination': str,
+                 'Bytes': np.float64}
+BITS_PER_MBIT = 1e6
+METHODS = ('ewma', 'mean', 'max', 'last')
+
+
+class DemandEstimator:
+    """ Rolling demand estimates of flows from their cumulative byte counters,
+        as reported by OpenFlow flow stats or read from a trace. A flow is a
+        key (priority, source, destination) with a row in flat arrays: its
+        last counter and time, an EWMA of its rates and a ring buffer of its
+        last window rates. Rows of expired flows are reused, so memory is
+        bounded by the flows alive at once and the window.
+        :param window: rates kept per flow.
+        :param method: how the next demand is estimated from them: 'ewma',
+        'mean' or 'max' of the window, or the 'last' rate.
+        :param alpha: EWMA weight of the newest rate.
+        :param headroom: factor the estimates are multiplied with.
+        :param scale: demand units per byte/s, Mbit/s by default.
+    """
+
+    def __init__(self, window=12, method='ewma', alpha=0.3, headroom=1.0,
+                 scale=8 / BITS_PER_MBIT, size=64):
+        if method not in METHODS:
+            raise ValueError("Unknown estimation method {}".format(method))
+        self.window = window
+        self.method = method
+        self.alpha = alpha
+        self.headroom = headroom
+        self.scale = scale
+        self.keys = []  # row -> key, None for a free row
+        self.rows = {}  # key -> row
+        self.free = []
+        self.counter = np.zeros(size)
+        self.time = np.full(size, np.nan)
+        self.count = np.zeros(size, dtype=np.int64)  # rates seen, the ring position is count % window
+        self.ewma = np.zeros(size)
+        self.ring = np.zeros((size, window))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _row(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+                self.keys[row] = key
+            else:
+                row = len(self.keys)
+                self.keys.append(key)
+                if row == len(self.counter):
+                    self._grow(2 * row)
+            self.rows[key] = row
+        return row
+
+    def _grow(self, size):
+        n = len(self.counter)
+        self.counter = np.concatenate([self.counter, np.zeros(size - n)])
+        self.time = np.concatenate([self.time, np.full(size - n, np.nan)])
+        self.count = np.concatenate([self.count, np.zeros(size - n, dtype=np.int64)])
+        self.ewma = np.concatenate([self.ewma, np.zeros(size - n)])
+        self.ring = np.concatenate([self.ring, np.zeros((size - n, self.window))])
+
+    def observe(self, keys, counters, times):
+        """ Takes one counter sample of each flow in keys. The first sample of
+            a flow only sets its baseline; a counter that went back (the entry
+            was reinstalled) restarts it.
+            :param keys: flow keys, each at most once.
+            :param counters: cumulative bytes of each flow.
+            :param times: time of the samples in seconds, one or per flow.
+        """
+        rows = np.fromiter((self._row(k) for k in keys), dtype=np.int64, count=len(keys))
+        counters = np.asarray(counters, dtype=float)
+        times = np.broadcast_to(np.asarray(times, dtype=float), rows.shape)
+        dt = times - self.time[rows]
+        db = counters - self.counter[rows]
+        ok = (dt > 0) & (db >= 0)  # False where time is nan, i.e. no baseline
+        r = rows[ok]
+        rate = db[ok] / dt[ok] * self.scale
+        self.ring[r, self.count[r] % self.window] = rate
+        self.ewma[r] = np.where(self.count[r] == 0, rate,
+                                self.alpha * rate + (1 - self.alpha) * self.ewma[r])
+        self.count[r] += 1
+        self.counter[rows] = counters
+        self.time[rows] = times
+
+    def estimate(self):
+        """ Estimated demand of every row; 0 for rows without a rate."""
+        n = np.minimum(self.count, self.window)
+        if self.method == 'ewma':
+            est = self.ewma
+        elif self.method == 'mean':
+            est = np.divide(self.ring.sum(axis=1), n, out=np.zeros(len(n)), where=n > 0)
+        elif self.method == 'max':
+            est = self.ring.max(axis=1)
+        else:
+            est = self.ring[np.arange(len(n)), (self.count - 1) % self.window] * (n > 0)
+        return est * self.headroom
+
+    def expire(self, before):
+        """ Forgets the flows last sampled before a time."""
+        for row in np.flatnonzero(self.time[:len(self.keys)] < before).tolist():
+            del self.rows[self.keys[row]]
+            self.keys[row] = None
+            self.free.append(row)
+            self.counter[row] = 0
+            self.time[row] = np.nan
+            self.count[row] = 0
+            self.ewma[row] = 0
+            self.ring[row] = 0
+
+    def records(self):
+        """ The estimates as (priority, source, destination, demand) tuples,
+            e.g. the demands of a ControlLoop or FlowTable.from_records."""
+        est = self.estimate()
+        return [key + (float(est[row]),) for key, row in self.rows.items() if self.count[row]]
+
+    def demand_vector(self, flows, default=None):
+        """ The estimates in the row order of a FlowTable, for set_demand.
+            :param default: demands of the flows without an estimate, their
+            current demand if None.
+        """
+        src, dst = flows.endpoints()
+        names = np.array(PRIORITIES)[flows.priority]
+        rows = np.fromiter((self.rows.get(k, -1) for k in zip(names.tolist(), src.tolist(),
+                                                              dst.tolist())),
+                           dtype=np.int64, count=len(flows))
+        known = rows >= 0
+        known[known] = self.count[rows[known]] > 0
+        out = np.array(flows.demand if default is None else default, dtype=float)
+        out[known] = self.estimate()[rows[known]]
+        return out
+
+
+def read_trace(file):
+    """ Reads a trace of flow byte counters (TRACE_COLUMNS, any format
+        loadfiles.read takes), sorted by time."""
+    cols = loadfiles.read(file, TRACE_COLUMNS)
+    order = np.argsort(cols['Time'], kind='stable')
+    return {c: v[order] for c, v in cols.items()}
+
+
+def replay(trace, estimator, interval, flows=None):
+    """ Feeds a trace into an estimator one interval at a time, as a
+        controller polling flow stats every interval would see it: only the
+        last sample of each flow in an interval is observed.
+        :param trace: columns as returned by read_trace.
+        :param flows: if given, a FlowTable whose demand vector is yielded
+        instead of the records; usable as the snapshots of
+        simulation_swan.simulate.
+        :return: generator of the estimates after every interval.
+    """
+    t = trace['Time']
+    keys = list(zip(trace['Priority'].tolist(), trace['Source'].tolist(),
+                    trace['Destination'].tolist()))
+    if not len(t):
+        return
+    bounds = np.searchsorted(t, np.arange(t[0], t[-1], interval)[1:])
+    start = 0
+    for end in bounds.tolist() + [len(t)]:
+        last = {keys[i]: i for i in range(start, end)}  # later samples win
+        if last:
+            index = np.fromiter(last.values(), dtype=np.int64, count=len(last))
+            estimator.observe(list(last), trace['Bytes'][index], t[index])
+        start = end
+        yield estimator.records() if flows is None else estimator.demand_vector(flows)
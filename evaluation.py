@@ -0,0 +1,148 @@
+# Link utilization and fairness of SWAN allocations
+import numpy as np
+
+from flowtable import FlowTable, PRIORITIES
+from swan_controller import Allocator, tunnel_loads
+
+REFERENCE_ALPHA = 1.1  # alpha of the max-min fair reference allocation
+
+
+class Evaluator:
+    """ Link loads, headroom, satisfied demand and fairness of the allocations
+        of one Allocator. What depends only on the tunnels and flows is built
+        once, so evaluating a step is one sparse matrix-vector product for the
+        link loads and a few vector operations over the flows. Every step also
+        updates running totals, see summary().
+        :param alloc: the Allocator whose allocations are evaluated.
+        :param fairness: whether to compare every step with the max-min fair
+        rates of the demands and capacities at that step (see
+        MaxminReference), which costs one more allocation per changed step.
+        :param alpha: alpha of the fair reference allocation.
+    """
+
+    def __init__(self, alloc, fairness=False, alpha=REFERENCE_ALPHA):
+        self.alloc = alloc
+        self.reference = MaxminReference(alloc, alpha) if fairness else None
+        self.link_tunnel = alloc.I_matrix.T.tocsr()  # link x tunnel
+        self.class_sizes = alloc.flows.class_sums(np.ones(len(alloc.flows)))
+        self.steps = 0
+        self.served = np.zeros(len(PRIORITIES))
+        self.demand = np.zeros(len(PRIORITIES))
+        self.jain = np.zeros(len(PRIORITIES))
+        self.max_utilization = 0.0
+        self.fair_steps = 0
+        self.fairness = 0.0
+        self.min_fairness = np.inf
+
+    def link_loads(self, allocation):
+        """ Load of every link under a swan_allocation result."""
+        return self.link_tunnel @ tunnel_loads(allocation)
+
+    def flow_rates(self, allocation):
+        """ Rate of every flow under a swan_allocation result, in row order."""
+        flows = self.alloc.flows
+        rates = np.zeros(len(flows))
+        for pri, (list_b, _) in allocation.items():
+            rows = flows.rows(pri)
+            rates[rows] = list_b[rows]
+        return rates
+
+    def evaluate(self, allocation, reference=None):
+        """ Evaluates one swan_allocation result against the current demands
+            and capacities of the Allocator.
+            :param reference: per-flow rates to measure fairness against at
+            this step; by default the max-min fair rates if the Evaluator was
+            built with fairness, otherwise fairness is not measured.
+            :return: dict with per link 'load', 'headroom' (capacity - load)
+            and 'utilization'; per class 'served', 'demand', 'satisfaction'
+            (served / demand) and 'jain' (Jain's index of the served fraction
+            of each flow's demand); and, with a reference, 'fairness' (the
+            smallest ratio of a flow's rate to its reference rate) and
+            'mean_fairness'.
+        """
+        flows = self.alloc.flows
+        capacity = self.alloc.capacity_links
+        load = self.link_loads(allocation)
+        step = {'load': load, 'headroom': capacity - load,
+                'utilization': np.divide(load, capacity, out=np.zeros(len(load)),
+                                         where=capacity > 0)}
+        rates = self.flow_rates(allocation)
+        served = flows.class_sums(rates)
+        demand = flows.class_sums(flows.demand)
+        step['served'] = served
+        step['demand'] = demand
+        step['satisfaction'] = np.divide(served, demand, out=np.ones(len(served)),
+                                         where=demand > 0)
+        x = np.divide(rates, flows.demand, out=np.ones(len(flows)),
+                      where=flows.demand > 0)
+        s1 = flows.class_sums(x)
+        s2 = flows.class_sums(x * x)
+        step['jain'] = np.divide(s1 * s1, self.class_sizes * s2, out=np.ones(len(s1)),
+                                 where=s2 > 0)
+
+        self.steps += 1
+        self.served += served
+        self.demand += demand
+        self.jain += step['jain']
+        if len(load):
+            self.max_utilization = max(self.max_utilization, float(step['utilization'].max()))
+        if reference is None and self.reference is not None:
+            reference = self.reference.rates()
+        if reference is not None:
+            fair = reference > 1e-9
+            ratio = rates[fair] / reference[fair]
+            step['fairness'] = float(ratio.min()) if len(ratio) else 1.0
+            step['mean_fairness'] = float(ratio.mean()) if len(ratio) else 1.0
+            self.fair_steps += 1
+            self.fairness += step['fairness']
+            self.min_fairness = min(self.min_fairness, step['fairness'])
+        return step
+
+    def summary(self):
+        """ Totals over the steps evaluated so far: the served fraction of
+            the total demand and the mean Jain's index of every class, the
+            highest link utilization, and the mean and lowest fairness of
+            the steps it was measured in."""
+        steps = max(self.steps, 1)
+        out = {'steps': self.steps, 'max_utilization': self.max_utilization}
+        for c, p in enumerate(PRIORITIES):
+            out[p + '_satisfaction'] = self.served[c] / self.demand[c] if self.demand[c] > 0 else 1.0
+            out[p + '_jain'] = self.jain[c] / steps
+        if self.fair_steps:
+            out['fairness'] = self.fairness / self.fair_steps
+            out['min_fairness'] = self.min_fairness
+        return out
+
+
+class MaxminReference:
+    """ Approximately max-min fair rates of the flows of an Allocator, over
+        the same tunnels and capacities, from appx_maxmin with a small alpha.
+        The reference runs on its own copy of the flow table, so the flows of
+        alloc keep their allocation. It shares the capacity array of alloc,
+        and rates() copies over the demands of the classes that changed, so
+        the reference follows both while the allocation stages of unchanged
+        inputs are reused.
+    """
+
+    def __init__(self, alloc, alpha=REFERENCE_ALPHA):
+        self.flows = alloc.flows
+        flows = self.flows
+        self.copy = FlowTable(flows.priority, flows.src, flows.dst, flows.demand.copy(),
+                              flows.nodes)
+        self.alloc = Allocator(self.copy, alloc.links, alloc.tunnels, alloc.capacity_links,
+                               scratch=alloc.scratch, alpha=alpha, U=alloc.U)
+
+    def rates(self):
+        """ The fair rates of the current demands and capacities."""
+        for p in PRIORITIES:
+            demand = self.flows.demands(p)
+            if not np.array_equal(demand, self.copy.demands(p)):
+                self.copy.set_demand(demand, p)
+        self.alloc.swan_allocation()
+        return self.copy.allocation
+
+
+def maxmin_reference(alloc, alpha=REFERENCE_ALPHA):
+    """ The max-min fair rates of the flows of alloc at their current
+        demands, see MaxminReference."""
+    return MaxminReference(alloc, alpha).rates()
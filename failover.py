@@ -0,0 +1,101 @@
+# Backup allocations for single link and switch failures
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def link_failure(a, b):
+    """ Failure id of the link between nodes a and b, both directions."""
+    return ('link',) + tuple(sorted((a, b)))
+
+
+def switch_failure(name):
+    """ Failure id of a switch, taking down every link it is on."""
+    return ('switch', name)
+
+
+def failure_scenarios(links):
+    """ Every single failure of a set of directed links: one per link between
+        two nodes and one per node.
+        :param links: directed links, one (ingress, egress) per link.
+        :return: list of (failure id, indexes of the links it takes down).
+    """
+    down = {}
+    for i, (a, b) in enumerate(links):
+        for failure in (link_failure(a, b), switch_failure(a), switch_failure(b)):
+            down.setdefault(failure, []).append(i)
+    return [(failure, np.array(down[failure])) for failure in sorted(down)]
+
+
+class FailureCache:
+    """ Allocations precomputed for every single link and switch failure, so
+        that a failure is answered by a lookup instead of an LP solve. The
+        allocation of a failure is the result of allocate over the capacities
+        with the failed links at 0. Results are dicts of a key (a directed path
+        in the controller) to a rate; keys are numbered once and the rates of all
+        failures kept as rows of one sparse failure x key matrix.
+        :param links: directed links the allocations run over.
+    """
+
+    def __init__(self, links):
+        self.scenarios = failure_scenarios(links)
+        self.index = {failure: i for i, (failure, _) in enumerate(self.scenarios)}
+        self.keys = []
+        self.rates = None  # csr matrix, failure x key
+
+    def __contains__(self, failure):
+        return failure in self.index
+
+    def build(self, allocate, capacity, workers=None, map=None):
+        """ Computes the allocation of every failure, in worker processes
+            unless map is given.
+            :param allocate: picklable callable taking link capacities and
+            returning a dict of key to rate.
+            :param capacity: capacity of every link with nothing failed.
+            :param workers: processes to run allocate in, by default one per
+            CPU; 1 runs them in this process.
+            :param map: used instead of the process pool if given, a callable
+            like the builtin map.
+        """
+        capacity = np.asarray(capacity, dtype=float)
+        capacities = []
+        for _, down in self.scenarios:
+            c = capacity.copy()
+            c[down] = 0
+            capacities.append(c)
+        workers = workers or os.cpu_count() or 1
+        if map is not None:
+            results = list(map(allocate, capacities))
+        elif workers > 1:
+            chunk = math.ceil(len(capacities) / workers)
+            with ProcessPoolExecutor(workers) as executor:
+                results = list(executor.map(allocate, capacities, chunksize=chunk))
+        else:
+            results = [allocate(c) for c in capacities]
+
+        columns = {}
+        indptr = [0]
+        indices = []
+        data = []
+        for rates in results:
+            for key, rate in rates.items():
+                indices.append(columns.setdefault(key, len(columns)))
+                data.append(rate)
+            indptr.append(len(indices))
+        self.keys = list(columns)
+        self.rates = sp.csr_matrix((data, indices, indptr),
+                                   shape=(len(results), len(self.keys)))
+
+    def lookup(self, failure):
+        """ The precomputed allocation of a failure as a dict of key to rate,
+            or None if there is none."""
+        i = self.index.get(failure)
+        if i is None or self.rates is None:
+            return None
+        start, end = self.rates.indptr[i], self.rates.indptr[i + 1]
+        keys = self.keys
+        return {keys[j]: float(rate) for j, rate in
+                zip(self.rates.indices[start:end], self.rates.data[start:end])}
@@ -0,0 +1,120 @@
+# Columnar flow table used by the SWAN allocator
+import numpy as np
+
+# Priority classes in allocation order; a flow's priority code indexes this tuple.
+PRIORITIES = ('interactive', 'elastic', 'background')
+
+
+class FlowTable:
+    """ Flows stored column-wise in contiguous NumPy arrays. Rows are kept sorted
+        by priority code, so every priority class is a contiguous slice and the
+        per-class columns are views, not copies. Source and destination are
+        codes into the node name array.
+    """
+
+    def __init__(self, priority, src, dst, demand, nodes, allocation=None):
+        priority = np.asarray(priority, dtype=np.int8)
+        if np.all(priority[:-1] <= priority[1:]):
+            order = slice(None)  # already grouped, keep the given arrays (e.g. memory-mapped)
+        else:
+            order = np.argsort(priority, kind='stable')
+        self.priority = np.ascontiguousarray(priority[order])
+        self.src = np.ascontiguousarray(np.asarray(src, dtype=np.int32)[order])
+        self.dst = np.ascontiguousarray(np.asarray(dst, dtype=np.int32)[order])
+        self.demand = np.ascontiguousarray(np.asarray(demand, dtype=np.float64)[order])
+        if allocation is None:
+            self.allocation = np.zeros(len(self.demand))
+        else:
+            self.allocation = np.ascontiguousarray(np.asarray(allocation, dtype=np.float64)[order])
+        self.nodes = np.asarray(nodes)
+        # row boundaries of each priority class
+        self._bounds = np.searchsorted(self.priority, np.arange(len(PRIORITIES) + 1))
+        self._max_demand = np.zeros(len(PRIORITIES))
+        self._refresh_max()
+        # bumped by set_demand, so results computed from a class can tell
+        # whether its demands changed since
+        self.versions = np.zeros(len(PRIORITIES), dtype=np.int64)
+
+    @classmethod
+    def from_records(cls, records, nodes=None):
+        """ Builds a table from (type, source, destination, demand) tuples, with
+            node names encoded against nodes (or the sorted names seen)."""
+        records = list(records)
+        types = [r[0] for r in records]
+        names = np.array([r[1] for r in records] + [r[2] for r in records], dtype=str)
+        demand = [r[3] for r in records]
+        return cls.from_columns(types, names[:len(records)], names[len(records):], demand, nodes)
+
+    @classmethod
+    def from_columns(cls, types, src, dst, demand, nodes=None):
+        """ Builds a table from priority names and source/destination names."""
+        types = np.asarray(types)
+        priority = types if types.dtype.kind in 'iu' else encode(np.array(PRIORITIES), types)
+        if len(priority) and priority.min() < 0:
+            raise ValueError("Unknown priority class in {}".format(np.unique(types)))
+        src, dst = np.asarray(src), np.asarray(dst)
+        if nodes is None:
+            nodes = np.unique(np.concatenate([src, dst]))
+        nodes = np.asarray(nodes)
+        return cls(priority, encode(nodes, src), encode(nodes, dst), demand, nodes)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype=str))
+
+    def __len__(self):
+        return len(self.demand)
+
+    def rows(self, priority):
+        """ The slice of rows holding one priority class."""
+        c = PRIORITIES.index(priority)
+        return slice(int(self._bounds[c]), int(self._bounds[c + 1]))
+
+    def demands(self, priority=None):
+        """ Demand column of one class (or all flows), as a view."""
+        return self.demand if priority is None else self.demand[self.rows(priority)]
+
+    def allocations(self, priority=None):
+        """ Allocation column of one class (or all flows), as a view."""
+        return self.allocation if priority is None else self.allocation[self.rows(priority)]
+
+    def class_sums(self, values):
+        """ Sums of a per-flow column (in row order) over each priority class."""
+        cs = np.concatenate([[0.0], np.cumsum(values, dtype=np.float64)])
+        return cs[self._bounds[1:]] - cs[self._bounds[:-1]]
+
+    def max_demand(self, priority=None):
+        """ Largest demand of one class (or of all flows), kept up to date by set_demand."""
+        if priority is None:
+            return float(self._max_demand.max())
+        return float(self._max_demand[PRIORITIES.index(priority)])
+
+    def set_demand(self, values, priority=None):
+        """ Overwrites the demands of one class (or all flows) in place."""
+        self.demands(priority)[:] = values
+        self._refresh_max(priority)
+        if priority is None:
+            self.versions += 1
+        else:
+            self.versions[PRIORITIES.index(priority)] += 1
+
+    def _refresh_max(self, priority=None):
+        for c, p in enumerate(PRIORITIES):
+            if priority is None or p == priority:
+                d = self.demand[self._bounds[c]:self._bounds[c + 1]]
+                self._max_demand[c] = d.max() if len(d) else 0.0
+
+    def endpoints(self):
+        """ Source and destination names of every flow."""
+        return self.nodes[self.src], self.nodes[self.dst]
+
+
+def encode(nodes, names):
+    """ Codes of names in nodes, -1 for names that are not there."""
+    names = np.asarray(names)
+    if not len(nodes):
+        return np.full(len(names), -1, dtype=np.int32)
+    order = np.argsort(nodes)
+    pos = np.clip(np.searchsorted(nodes, names, sorter=order), 0, len(nodes) - 1)
+    codes = order[pos]
+    return np.where(nodes[codes] == names, codes, -1).astype(np.int32)
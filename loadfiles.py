@@ -1,28 +1,73 @@
-from pandas import *
-from xlrd import open_workbook
-from xlrd.timemachine import xrange
-
-
-def read(file):
-    book = open_workbook(file)
-    sheet = book.sheet_by_index(0)
-
-    # read header values into the list
-    keys = [sheet.cell(0, col_index).value for col_index in xrange(sheet.ncols)]
-    dict_list = []
-    for row_index in xrange(1, sheet.nrows):
-        d = {keys[col_index]: sheet.cell(row_index, col_index).value
-             for col_index in xrange(sheet.ncols)}
-        dict_list.append(d)
-    return dict_list
-
-def readLinks():
-    read('links.xlsx')
-
-def readFiles():
-    i = read('interactive.xlsx')
-    e = read('elastic.xlsx')
-    b = read('background.xlsx')
-    return i, e, b
-
-# readFiles()
\ No newline at end of file
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+from flowtable import FlowTable, PRIORITIES
+
+# Columns read from each kind of file, with the dtype they are stored as.
+FLOW_COLUMNS = {'Source': str, 'Destination': str, 'Demand': np.float64}
+LINK_COLUMNS = {'Ingress': str, 'Egress': str, 'Bidirectional': str}
+
+PRIORITY_FILES = {'interactive': 'interactive.xlsx',
+                  'elastic': 'elastic.xlsx',
+                  'background': 'background.xlsx'}
+
+
+def read(file, columns=FLOW_COLUMNS):
+    """ Reads the given columns of a .xlsx (first sheet), .csv or .parquet file
+        into a dict of typed NumPy arrays, one per column."""
+    ext = os.path.splitext(file)[1].lower()
+    if ext in ('.xlsx', '.xlsm'):
+        return read_xlsx(file, columns)
+    if ext == '.csv':
+        df = pd.read_csv(file, usecols=list(columns), dtype=columns, engine='c')
+    elif ext == '.parquet':
+        df = pd.read_parquet(file, columns=list(columns))
+    else:
+        raise ValueError("Unsupported file type: {}".format(file))
+    return {c: df[c].to_numpy(dtype=t) for c, t in columns.items()}
+
+
+def read_xlsx(file, columns):
+    # Streams the rows of the first sheet instead of loading the whole workbook.
+    book = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = book.worksheets[0].iter_rows(values_only=True)
+        header = next(rows)
+        index = [header.index(c) for c in columns]
+        values = [[] for _ in columns]
+        for row in rows:
+            if all(v is None for v in row):
+                continue
+            for col, i in zip(values, index):
+                col.append(row[i])
+    finally:
+        book.close()
+    return {c: np.asarray(v, dtype=t) for (c, t), v in zip(columns.items(), values)}
+
+
+def readLinks(file='links.xlsx'):
+    """ Returns the link columns, with Bidirectional as a boolean array."""
+    cols = read(file, LINK_COLUMNS)
+    cols['Bidirectional'] = np.char.lower(cols['Bidirectional']) == 'y'
+    return cols
+
+
+def readFiles(files=PRIORITY_FILES):
+    """ Reads the demand file of every priority class in parallel and returns
+        all flows in a single FlowTable."""
+    paths = [files[p] for p in PRIORITIES]
+    # openpyxl parses in pure Python, so workbooks need processes to overlap
+    xlsx = any(os.path.splitext(p)[1].lower() in ('.xlsx', '.xlsm') for p in paths)
+    pool = ProcessPoolExecutor if xlsx else ThreadPoolExecutor
+    with pool(max_workers=len(paths)) as executor:
+        parts = list(executor.map(read, paths))
+    types = np.concatenate([np.full(len(part['Demand']), code, dtype=np.int8)
+                            for code, part in enumerate(parts)])
+    return FlowTable.from_columns(types,
+                                  np.concatenate([part['Source'] for part in parts]),
+                                  np.concatenate([part['Destination'] for part in parts]),
+                                  np.concatenate([part['Demand'] for part in parts]))
@@ -0,0 +1,198 @@
+# Counters, latency histograms and their export for the SWAN controller
+import bisect
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (1e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+
+class Counter:
+    """ A monotonically increasing count.
+        :param lock: lock held while updating, shared with the registry.
+    """
+    kind = 'counter'
+
+    def __init__(self, lock=None):
+        self.lock = lock or threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+
+class Histogram:
+    """ Observations counted into fixed buckets, plus their count and sum.
+        Observing is a binary search over the bucket bounds and two adds."""
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS, lock=None):
+        self.lock = lock or threading.Lock()
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """ Observes the wall time of the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Registry:
+    """ Named metrics, each with optional labels. Asking for a metric that
+        exists returns it, so call sites can look metrics up once and keep
+        them. Metrics are updated from OS threads as well as the event loop
+        (allocations and backup builds run in eventlet's thread pool, the
+        HTTP endpoint serves from a thread of its own), so every update,
+        snapshot and rendering holds one lock of the registry.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}  # (name, labels) -> Counter or Histogram
+        self.help = {}
+
+    def counter(self, name, help='', **labels):
+        return self._get(lambda: Counter(self.lock), name, help, labels)
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS, **labels):
+        return self._get(lambda: Histogram(buckets, self.lock), name, help, labels)
+
+    def _get(self, make, name, help, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = make()
+                self.help.setdefault(name, help)
+        return metric
+
+    def snapshot(self):
+        """ Current values as a dict of 'name{labels}' to a count, or to
+            (count, sum) for histograms."""
+        out = {}
+        with self.lock:
+            for (name, labels), m in self.metrics.items():
+                key = name + _labels(labels)
+                out[key] = m.value if m.kind == 'counter' else (m.count, m.sum)
+        return out
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format."""
+        with self.lock:
+            return self._render()
+
+    def _render(self):
+        lines = []
+        for name in sorted(self.help):
+            family = [(labels, m) for (n, labels), m in self.metrics.items() if n == name]
+            lines.append('# HELP {} {}'.format(name, self.help[name]))
+            lines.append('# TYPE {} {}'.format(name, family[0][1].kind))
+            for labels, m in family:
+                if m.kind == 'counter':
+                    lines.append('{}{} {}'.format(name, _labels(labels), m.value))
+                    continue
+                cumulative = 0
+                for bound, n in zip(m.bounds + ('+Inf',), m.counts):
+                    cumulative += n
+                    le = labels + (('le', bound if bound == '+Inf' else repr(float(bound))),)
+                    lines.append('{}_bucket{} {}'.format(name, _labels(le), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), m.sum))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), m.count))
+        return '\n'.join(lines) + '\n'
+
+
+# The registry the controller modules report to
+REGISTRY = Registry()
+
+
+def timed(name, help='', **labels):
+    """ Decorator observing the wall time of every call in a histogram of
+        REGISTRY."""
+    def wrap(fn):
+        histogram = REGISTRY.histogram(name, help, **labels)
+
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return inner
+    return wrap
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+
+def serve(port=9100, address='127.0.0.1', registry=REGISTRY):
+    """ Serves registry.render() over HTTP on a background thread, for a
+        Prometheus scraper or curl. Returns the server; call shutdown() to stop.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class CycleLog:
+    """ Writes one JSON line per control cycle: the fields given to write
+        plus how much every counter and histogram moved during the cycle.
+        :param path: file appended to, or None to keep only the last record.
+    """
+
+    def __init__(self, path=None, registry=REGISTRY):
+        self.path = path
+        self.registry = registry
+        self.record = None
+        self._base = registry.snapshot()
+
+    def write(self, **fields):
+        now = self.registry.snapshot()
+        delta = {}
+        for key, value in now.items():
+            before = self._base.get(key)
+            if isinstance(value, tuple):
+                before = before or (0, 0.0)
+                if value[0] != before[0]:
+                    delta[key] = {'count': value[0] - before[0], 'sum': value[1] - before[1]}
+            elif value != (before or 0):
+                delta[key] = value - (before or 0)
+        self._base = now
+        self.record = dict(fields, time=time.time(), metrics=delta)
+        if self.path:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(self.record) + '\n')
+        return self.record
@@ -0,0 +1,264 @@
+# Control loop driving SWAN allocations into SimpleMPLS
+import functools
+import time
+from collections import defaultdict
+
+import eventlet
+import numpy as np
+from eventlet import semaphore, tpool
+
+import metrics
+import tunnelgen
+import update_planner
+from failover import FailureCache
+from flowtable import FlowTable, PRIORITIES
+from swan_controller import Allocator
+from tunnelgen import TunnelSet
+
+SWAN_INTERVAL = 300  # seconds between allocations, as in simulation_swan
+NUM_TUNNELS = 3  # tunnels per switch pair
+
+
+class ControlLoop:
+    """ Periodically allocates the current demands over the switches of a
+        SimpleMPLS app and installs the resulting LSPs. The loop is a green
+        thread of the app; the allocation itself runs in eventlet's native
+        thread pool, so packet_in and switch events are served while the LP
+        solves. Only LSPs that appear or disappear between cycles are sent
+        to the switches, see SimpleMPLS.reconcile. A new allocation is
+        reached through the congestion-free intermediate steps of
+        update_planner.plan_update, see apply. After each cycle the
+        allocation of every single link and switch failure is precomputed
+        (see failover.FailureCache), so that fail() switches to it without
+        solving.
+        :param app: the SimpleMPLS app.
+        :param demands: callable returning the current demands as
+        (priority, source host, destination host, demand) tuples.
+        :param interval: seconds between allocations.
+        :param k: tunnels per switch pair.
+        :param log_path: file the per-cycle JSON records are appended to (see
+        metrics.CycleLog), None to keep only the last one in self.log.record.
+        :param backups: whether to precompute the failure allocations.
+        :param kwargs: passed on to swan_controller.Allocator (scratch, alpha, U).
+    """
+
+    def __init__(self, app, demands, interval=SWAN_INTERVAL, k=NUM_TUNNELS, log_path=None,
+                 backups=True, **kwargs):
+        self.app = app
+        self.demands = demands
+        self.interval = interval
+        self.kwargs = kwargs
+        topo = app.topo
+        edges = topo.switch_links()
+        self.links = [(topo.names[topo.ends[e][0]], topo.names[topo.ends[e][1]]) for e in edges]
+        self.capacity = [topo.capacity[e] for e in edges]
+        ingress = [a for a, _ in self.links]
+        egress = [b for _, b in self.links]
+        self.tunnels = tunnelgen.tunnels_for(ingress, egress, [topo.weight[e] for e in edges], k)
+        # switch path of every tunnel, e.g. ['S1', 'S2', 'S4']
+        self.tunnel_paths = [self.tunnels.path(t, self.links) for t in range(len(self.tunnels))]
+        self.access = {n: topo.access_switch(n)
+                       for n, switch in zip(topo.names, topo.is_switch) if not switch}
+        self.rates = {}  # directed pathString -> rate of the last applied allocation
+        self.log = metrics.CycleLog(log_path)
+        self.backups = FailureCache(self.links) if backups else None
+        self.down = set()  # failure ids in effect
+        self.lock = semaphore.Semaphore()  # one cycle at a time
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = eventlet.spawn(self.run)
+
+    def stop(self):
+        if self.thread is not None:
+            self.thread.kill()
+            self.thread = None
+
+    def run(self):
+        while True:
+            try:
+                self.cycle()
+            except Exception:
+                self.app.logger.exception("Allocation cycle failed")
+            eventlet.sleep(self.interval)
+
+    def cycle(self):
+        """ One allocation: demands in, changed LSPs out, then the backups
+            of the new demands if no failure is in effect. Cycles run one at
+            a time; one whose failures changed while it solved is dropped,
+            fail() and restore() have already acted on the change."""
+        with self.lock:
+            start = time.perf_counter()
+            down = frozenset(self.down)
+            records = list(self.demands())
+            allocate = self.allocator(records)
+            rates = tpool.execute(allocate, self.residual_capacity())
+            allocated = time.perf_counter()
+            messages = self.apply(rates, down=down)
+            if messages is None:
+                self.app.logger.info("Failures changed during the allocation, dropping it")
+                return
+            applied = time.perf_counter()
+            if self.backups is not None and not self.down:
+                self.backups.build(allocate, self.capacity, map=green_map)
+            self.log.write(demands=len(records), lsps=len(rates), messages=messages,
+                           allocation_seconds=allocated - start,
+                           backup_seconds=time.perf_counter() - applied,
+                           seconds=time.perf_counter() - start)
+
+    def allocator(self, records):
+        """ The allocation of the demands as a picklable callable from link
+            capacities to the rates of the directed paths, see lsp_rates."""
+        records = [r for r in records
+                   if self.access.get(r[1]) and self.access.get(r[2])]
+        records.sort(key=lambda r: PRIORITIES.index(r[0]))  # keeps FlowTable order
+        hosts = [(r[1], r[2]) for r in records]
+        flows = FlowTable.from_records(
+            (r[0], self.access[r[1]], self.access[r[2]], r[3]) for r in records)
+        return functools.partial(lsp_rates, flows, hosts, self.links, self.tunnels,
+                                 self.tunnel_paths, **self.kwargs)
+
+    def allocate(self, records):
+        """ Runs the SWAN allocation of the demands and returns the rate of
+            every directed path it uses (see lsp_rates). Does not touch the
+            app, so it is safe to run outside the event loop.
+        """
+        return self.allocator(records)(self.residual_capacity())
+
+    def residual_capacity(self):
+        """ Link capacities with the links of the failures in effect at 0."""
+        capacity = np.array(self.capacity, dtype=float)
+        for failure in self.down:
+            i = self.backups.index.get(failure) if self.backups is not None else None
+            if i is not None:
+                capacity[self.backups.scenarios[i][1]] = 0
+        return capacity
+
+    def apply(self, rates, plan=True, down=None):
+        """ Reconciles the LSPs of the app with the directed path rates,
+            each direction of an LSP weighted by its own rate (see
+            lsp_weights). With plan, the LSPs move there from the rates
+            applied last through the steps of plan(), reconciled one after
+            the other; SimpleMPLS sends a batch only once the switches have
+            confirmed the one before, so no two steps mix. Without, e.g.
+            after a failure, the rates are applied at once.
+            :param down: the failures the rates were allocated for; if the
+            failures in effect are others by the time the rates would be
+            sent, nothing is sent.
+            Returns the number of messages sent to the switches, None if the
+            rates were dropped."""
+        steps = [rates]
+        if plan and self.rates:
+            try:
+                steps = tpool.execute(self.plan, self.rates, rates)
+            except RuntimeError as e:
+                self.app.logger.warning("{}, applying the allocation at once".format(e))
+        if down is not None and frozenset(self.down) != down:
+            return None
+        mods = 0
+        for step in steps:
+            mods += self.app.reconcile(lsp_weights(step))
+        self.rates = rates
+        self.app.logger.info("Allocation applied: {} LSPs in {} steps, {} flow mods".format(
+            len(lsp_weights(rates)), len(steps), mods))
+        return mods
+
+    def plan(self, old, new):
+        """ The congestion-free transition between two allocations over the
+            residual capacities, see update_planner.plan_update. Every
+            directed path is planned as a tunnel of its own and the host pairs
+            are the commodities.
+            :param old: dict of directed pathString to rate, as lsp_rates.
+            :param new: the same for the allocation to move to.
+            :return: list of such dicts, the intermediate steps and then new.
+            :raise RuntimeError: if no transition within the step limit
+            keeps every link within its capacity.
+        """
+        paths = list(dict.fromkeys(list(old) + list(new)))
+        index = {link: i for i, link in enumerate(self.links)}
+        tunnels = []
+        for path in paths:
+            nodes = path.split("-")
+            tunnels.append((nodes[0], nodes[-1],
+                            [index[link] for link in zip(nodes[1:-2], nodes[2:-1])]))
+        alloc = Allocator(None, self.links, TunnelSet.from_paths(tunnels),
+                          self.residual_capacity(), scratch=self.kwargs.get('scratch'))
+        plan = update_planner.plan_update([old.get(p, 0.0) for p in paths],
+                                          [new.get(p, 0.0) for p in paths], alloc)
+        return [{p: float(rate) for p, rate in zip(paths, state) if rate > 1e-9}
+                for state in plan.states[1:-1]] + [new]
+
+    def fail(self, failure):
+        """ A link or switch went down (see failover for the ids). As the
+            only failure, the LSPs are switched to its precomputed allocation;
+            otherwise a new cycle allocates around every failure in effect.
+            Failures of links the loop does not allocate over are ignored.
+        """
+        if self.backups is None or failure not in self.backups or failure in self.down:
+            return
+        self.down.add(failure)
+        rates = self.backups.lookup(failure) if len(self.down) == 1 else None
+        if rates is None:
+            eventlet.spawn(self.cycle)
+            return
+        self.app.logger.info("Failover to the backup allocation of {}".format(failure))
+        self.apply(rates, plan=False)  # the old allocation uses the failed links
+
+    def restore(self, failure):
+        """ A failed link or switch is back: a new cycle allocates over it."""
+        if failure in self.down:
+            self.down.discard(failure)
+            eventlet.spawn(self.cycle)
+
+
+def lsp_rates(flows, hosts, links, tunnels, tunnel_paths, capacity, **kwargs):
+    """ Runs the SWAN allocation of a FlowTable and returns the rate of every
+        path it uses, keyed by the pathString in the direction of the traffic
+        ("H1-S1-S2-H5" for flows from H1 to H5). The two directions of an LSP
+        are kept apart, as each is split over the LSPs at its own ingress.
+        :param hosts: (source host, destination host) of every flow.
+        :param tunnel_paths: switch names along every tunnel.
+        :param capacity: capacity of every link.
+        :param kwargs: passed on to swan_controller.Allocator.
+    """
+    alloc = Allocator(flows, links, tunnels, capacity, **kwargs)
+    allocation = alloc.swan_allocation()
+
+    rates = defaultdict(float)
+    for _, x in allocation.values():
+        x = x.tocoo()
+        for i, t, rate in zip(x.row, x.col, x.data):
+            if rate <= 0:
+                continue
+            src, dst = hosts[i]
+            rates["-".join([src] + tunnel_paths[t] + [dst])] += float(rate)
+    return dict(rates)
+
+
+def lsp_weights(rates):
+    """ The weights SimpleMPLS.reconcile takes from the rates of directed
+        paths: per LSP, the rate of its forward and of its reverse direction,
+        0 for a direction without traffic."""
+    weights = {}
+    for path, rate in rates.items():
+        name = lsp_name(path.split("-"))
+        w = weights.setdefault(name, {"fwd": 0.0, "rev": 0.0})
+        w["fwd" if name == path else "rev"] += rate
+    return weights
+
+
+def green_map(fn, items):
+    """ map running every call in eventlet's native thread pool, so the
+        event loop keeps serving the switches while they run. The calls
+        hold the GIL for most of the LP, so this is no faster than map."""
+    pool = eventlet.GreenPool()
+    return pool.imap(lambda item: tpool.execute(fn, item), items)
+
+
+def lsp_name(nodes):
+    """ The pathString of a path. LSPs are bidirectional, so a path and its
+        reverse share the name of whichever direction sorts first."""
+    fwd = "-".join(nodes)
+    rev = "-".join(reversed(nodes))
+    return min(fwd, rev)
@@ -0,0 +1,99 @@
+# MPLS label allocation for SimpleMPLS
+from collections import defaultdict
+
+# Labels 0-15 are reserved by RFC 3032, the label field is 20 bits wide
+MIN_LABEL = 16
+MAX_LABEL = (1 << 20) - 1
+
+
+class LabelPool:
+    """ The labels of one link. Labels never handed out are taken in order
+        from a counter and released ones are reused last released first, so
+        both allocate and release are O(1) and memory grows only with the
+        labels actually in use. Releasing a label that is not in use raises
+        ValueError, as a label released twice would be handed out twice.
+    """
+
+    def __init__(self, min_label=MIN_LABEL, max_label=MAX_LABEL):
+        self.min_label = min_label
+        self.next = min_label
+        self.max_label = max_label
+        self.free = {}  # released labels in release order, dict for membership
+
+    def __len__(self):
+        """ Number of labels still available."""
+        return self.max_label - self.next + 1 + len(self.free)
+
+    def allocate(self):
+        if self.free:
+            return self.free.popitem()[0]
+        if self.next > self.max_label:
+            raise LabelsExhausted("No free MPLS label")
+        label = self.next
+        self.next += 1
+        return label
+
+    def release(self, label):
+        if label in self.free or not self.min_label <= label < self.next:
+            raise ValueError("MPLS label {} is not in use".format(label))
+        self.free[label] = None
+
+    def restore(self, used):
+        """ Resets the pool to have exactly the labels in used taken."""
+        used = set(used)
+        self.next = max(used, default=self.min_label - 1) + 1
+        self.free = dict.fromkeys(label for label in range(self.next - 1, self.min_label - 1, -1)
+                                  if label not in used)
+
+
+class LabelsExhausted(Exception):
+    pass
+
+
+class LabelManager:
+    """ Label pools of every link direction, keyed by node names such as
+        ("S1", "S2"). Pools are created on first use.
+    """
+
+    def __init__(self, min_label=MIN_LABEL, max_label=MAX_LABEL):
+        self.pools = defaultdict(lambda: LabelPool(min_label, max_label))
+
+    def allocate(self, link):
+        return self.pools[link].allocate()
+
+    def release(self, link, label):
+        self.pools[link].release(label)
+
+    def reserve_path(self, switches, held=None):
+        """ Takes one label on every link between consecutive switches of a
+            path. Either all of them are reserved or, if a link has run out,
+            none are.
+            :param switches: switch names along the path, in order.
+            :param held: dict of link to a label already owned for it, which
+            is used instead of taking a new one.
+            :return: dict of link to label.
+        """
+        labels = dict(held or {})
+        taken = {}
+        try:
+            for link in zip(switches, switches[1:]):
+                if link not in labels:
+                    taken[link] = labels[link] = self.pools[link].allocate()
+        except LabelsExhausted:
+            self.release_path(taken)
+            raise LabelsExhausted("No free MPLS label on link {}".format(link))
+        return labels
+
+    def release_path(self, labels):
+        """ Returns the labels of a reserve_path result to their pools."""
+        for link, label in labels.items():
+            self.pools[link].release(label)
+
+    def restore(self, used):
+        """ Resets the pools to have exactly the given labels taken, e.g.
+            after loading saved LSPs.
+            :param used: dict of link to the labels in use on it.
+        """
+        self.pools.clear()
+        for link, labels in used.items():
+            self.pools[link].restore(labels)
@@ -0,0 +1,265 @@
+# Offline datapaths and allocation replay for SimpleMPLS
+import argparse
+import json
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+from ryu import cfg
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
+
+from flowtable import PRIORITIES
+
+
+class FakeDatapath:
+    """ Stands in for a connected OpenFlow 1.3 switch. Messages are
+        serialized as Ryu would before sending them, then applied to an
+        in-memory flow table and group table. Barrier, flow stats and group
+        description requests are answered from them by answer.
+        Flow entries are keyed by their match; a MODIFY or DELETE with the
+        exact match of an entry affects only that entry, otherwise a DELETE
+        removes every entry whose match includes the given fields.
+        :param name: switch name, turned into the datapath id SimpleMPLS decodes.
+        :param serialize: whether to serialize messages (part of the cost of
+        sending them in a real controller).
+    """
+    ofproto = ofproto_v1_3
+    ofproto_parser = ofproto_v1_3_parser
+
+    def __init__(self, name, serialize=True):
+        self.name = name
+        self.id = int(name.encode().hex(), 16)
+        self.serialize = serialize
+        self.xid = 0
+        self.flows = {}  # match items -> (priority, cookie, instructions)
+        self.groups = {}  # group id -> buckets
+        self.requests = []  # unanswered barrier and stats requests
+        self.sent = defaultdict(int)  # message type -> count
+        self.bytes = 0
+        self.misses = 0  # MODIFY or DELETE that found no entry
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg):
+        if msg.xid is None:
+            self.set_xid(msg)
+        if self.serialize:
+            msg.serialize()
+            self.bytes += len(msg.buf)
+        self.sent[type(msg).__name__] += 1
+        if isinstance(msg, ofproto_v1_3_parser.OFPFlowMod):
+            self._flow_mod(msg)
+        elif isinstance(msg, ofproto_v1_3_parser.OFPGroupMod):
+            self._group_mod(msg)
+        elif isinstance(msg, (ofproto_v1_3_parser.OFPBarrierRequest,
+                              ofproto_v1_3_parser.OFPFlowStatsRequest,
+                              ofproto_v1_3_parser.OFPGroupDescStatsRequest)):
+            self.requests.append(msg)
+
+    def _flow_mod(self, msg):
+        ofp = self.ofproto
+        key = tuple(msg.match.items())
+        if msg.command == ofp.OFPFC_ADD:
+            self.flows[key] = (msg.priority, msg.cookie, msg.instructions)
+        elif msg.command in (ofp.OFPFC_MODIFY, ofp.OFPFC_MODIFY_STRICT):
+            if key in self.flows:
+                self.flows[key] = self.flows[key][:2] + (msg.instructions,)
+            else:
+                self.misses += 1
+        elif key in self.flows:
+            del self.flows[key]
+        elif msg.command == ofp.OFPFC_DELETE:
+            fields = set(key)
+            covered = [k for k in self.flows if fields <= set(k)]
+            for k in covered:
+                del self.flows[k]
+            self.misses += not covered
+        else:
+            self.misses += 1
+
+    def _group_mod(self, msg):
+        ofp = self.ofproto
+        if msg.command == ofp.OFPGC_DELETE:
+            if self.groups.pop(msg.group_id, None) is None:
+                self.misses += 1
+        else:
+            self.groups[msg.group_id] = msg.buckets
+
+    def answer(self, app):
+        """ Delivers the replies of the outstanding requests to app, in the
+            order they were sent. Stats come in a single reply."""
+        parser = self.ofproto_parser
+        requests, self.requests = self.requests, []
+        for msg in requests:
+            if isinstance(msg, parser.OFPBarrierRequest):
+                reply = parser.OFPBarrierReply(self)
+                handler = app.barrier_reply
+            elif isinstance(msg, parser.OFPFlowStatsRequest):
+                fields = set(msg.match.items())
+                body = [parser.OFPFlowStats(
+                            table_id=0, duration_sec=0, duration_nsec=0, priority=priority,
+                            idle_timeout=0, hard_timeout=0, flags=0, cookie=cookie,
+                            packet_count=0, byte_count=0, match=parser.OFPMatch(**dict(key)),
+                            instructions=instructions)
+                        for key, (priority, cookie, instructions) in self.flows.items()
+                        if cookie & msg.cookie_mask == msg.cookie & msg.cookie_mask
+                        and fields <= set(key)]
+                reply = parser.OFPFlowStatsReply(self, body=body, flags=0)
+                handler = app.flow_stats_reply
+            else:
+                body = [parser.OFPGroupDescStats(self.ofproto.OFPGT_SELECT, group, buckets)
+                        for group, buckets in self.groups.items()]
+                reply = parser.OFPGroupDescStatsReply(self, body=body, flags=0)
+                handler = app.group_desc_reply
+            reply.xid = msg.xid
+            handler(_Event(reply))
+
+
+def answer_all(app):
+    """ Answers the requests of every switch of app until none are left.
+        Answers can lead to more requests, as the phases of a batch are only
+        sent once the previous one is confirmed."""
+    while True:
+        pending = [dp for dp in app.switches.values() if dp.requests]
+        if not pending:
+            return
+        for dp in pending:
+            dp.answer(app)
+
+
+class _Event:
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def make_app(netfile, serialize=True, statefile=None, datapaths=None):
+    """ A SimpleMPLS app over netfile with a FakeDatapath connected for every
+        switch, without running Ryu.
+        :param statefile: see SimpleMPLS.restore_state.
+        :param datapaths: dict of switch name to the datapath to connect,
+        e.g. the switches of a previous app to restart against; new ones for
+        the switches not in it.
+    """
+    import SimpleMPLS
+    opts = [cfg.StrOpt('netfile', default=None), cfg.BoolOpt('notelnet', default=False),
+            cfg.IntOpt('metricsport', default=0), cfg.StrOpt('statefile', default=None)]
+    cfg.CONF.clear()  # options can only be registered before parsing
+    cfg.CONF.register_cli_opts(opts)
+    args = ['--netfile', netfile, '--notelnet']
+    if statefile:
+        args += ['--statefile', statefile]
+    cfg.CONF(args=args, project='ryu')
+    app = SimpleMPLS.SimpleMPLS()
+    datapaths = datapaths or {}
+    for name, switch in zip(app.topo.names, app.topo.is_switch):
+        if switch:
+            datapath = datapaths.get(name) or FakeDatapath(name, serialize)
+            msg = type('SwitchFeatures', (), {'datapath': datapath})()
+            app.switch_features(_Event(msg))
+            answer_all(app)
+    return app
+
+
+def synthetic_trace(app, cycles=10, n_flows=50, seed=0, max_demand=20.0):
+    """ An allocation trace over the hosts of app: random host pairs and
+        classes with lognormal demands that change every cycle, allocated
+        and weighted like the control loop does.
+        :return: list of dicts of pathString to the weights of its two
+        directions (see mpls_control.lsp_weights), one per cycle.
+    """
+    from mpls_control import ControlLoop, lsp_weights
+    rng = np.random.default_rng(seed)
+    hosts = [n for n, switch in zip(app.topo.names, app.topo.is_switch) if not switch]
+    src = rng.integers(len(hosts), size=n_flows)
+    dst = (src + rng.integers(1, len(hosts), size=n_flows)) % len(hosts)
+    pri = rng.integers(len(PRIORITIES), size=n_flows)
+    base = rng.lognormal(np.log(max_demand / 4), 1.0, size=n_flows)
+    loop = ControlLoop(app, None, backups=False)
+    trace = []
+    for _ in range(cycles):
+        demand = np.minimum(base * rng.lognormal(0, 0.5, size=n_flows), max_demand)
+        trace.append(lsp_weights(loop.allocate([(PRIORITIES[p], hosts[s], hosts[d], float(x))
+                                                for p, s, d, x in zip(pri, src, dst, demand)])))
+    return trace
+
+
+def read_trace(file):
+    """ Reads an allocation trace: one JSON object per line, either a dict of
+        pathString to weight as SimpleMPLS.reconcile takes it, or {"lsps": ...}
+        with one or a list of pathStrings."""
+    trace = []
+    with open(file) as f:
+        for line in f:
+            if line.strip():
+                step = json.loads(line)
+                step = step.get('lsps', step) if isinstance(step, dict) else step
+                trace.append(step if isinstance(step, dict) else dict.fromkeys(step))
+    return trace
+
+
+def replay(app, trace):
+    """ Drives app through a trace with reconcile, answering every request
+        after each step (see answer_all), and measures each step.
+        :return: dict with per step 'lsps', 'changed' (LSPs added or
+        removed), 'messages' (by type), 'seconds', 'cpu_seconds',
+        'messages_per_second' and 'cpu_per_lsp'; and the final 'flows' and
+        'groups' of every switch. The times cover reconcile and the answers,
+        as the later phases of a step are only sent on the barrier replies.
+    """
+    steps = []
+    for desired in trace:
+        before = set(app.lsps)
+        sent = {name: dict(dp.sent) for name, dp in app.switches.items()}
+        wall, cpu = time.perf_counter(), time.process_time()
+        app.reconcile(desired)
+        answer_all(app)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        messages = defaultdict(int)
+        for name, dp in app.switches.items():
+            for kind, n in dp.sent.items():
+                messages[kind] += n - sent[name].get(kind, 0)
+        total = sum(messages.values())
+        changed = len(before ^ set(app.lsps))
+        steps.append({'lsps': len(app.lsps), 'changed': changed, 'messages': dict(messages),
+                      'seconds': wall, 'cpu_seconds': cpu,
+                      'messages_per_second': total / wall if wall > 0 else 0.0,
+                      'cpu_per_lsp': cpu / changed if changed else 0.0,
+                      'unconfirmed': len(app.unconfirmed)})
+    return {'steps': steps,
+            'flows': {name: len(dp.flows) for name, dp in app.switches.items()},
+            'groups': {name: len(dp.groups) for name, dp in app.switches.items()},
+            'misses': sum(dp.misses for dp in app.switches.values())}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replays allocations through SimpleMPLS "
+                                                 "without switches.")
+    parser.add_argument('--netfile', default='ExNet.json')
+    parser.add_argument('--trace', help="allocation trace (JSON lines), synthetic if not given")
+    parser.add_argument('--cycles', type=int, default=10)
+    parser.add_argument('--flows', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--statefile', help="save the LSPs there, see SimpleMPLS.restore_state")
+    parser.add_argument('--output', help="JSON file to write, stdout if not given")
+    args = parser.parse_args(argv)
+
+    app = make_app(args.netfile, statefile=args.statefile)
+    app.logger.disabled = True  # per flow mod logging would dominate the profile
+    if args.trace:
+        trace = read_trace(args.trace)
+    else:
+        trace = synthetic_trace(app, args.cycles, args.flows, args.seed)
+    text = json.dumps(replay(app, trace), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,146 @@
+# Persisted LSP state of SimpleMPLS
+import math
+import os
+import struct
+import zlib
+
+# Record framing: payload length and CRC-32, then the payload
+FRAME = struct.Struct('!II')
+LSP = struct.Struct('!cddH')  # b'A', forward and reverse weight (nan for None), pathString length
+DELETE = struct.Struct('!cH')  # b'D', pathString length
+GROUP = struct.Struct('!cIH')  # b'G', group id (0 for none), FEC key length
+
+
+class LspStore:
+    """ The LSPs of SimpleMPLS with their labels and weights, and the group
+        of every FEC, kept in a snapshot file plus an append-only journal of
+        the changes since (path + '.journal'). Records are small binary
+        structs with a CRC, so a record torn by a crash is detected and the
+        state loads up to the last complete one. Once the journal has more
+        records than compact_every, or than the snapshot, the state is
+        rewritten as a new snapshot and the journal emptied.
+        :param path: snapshot file.
+        :param sync: whether to fsync every append before the messages it
+        records are sent.
+    """
+
+    def __init__(self, path, compact_every=10000, sync=True):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.compact_every = compact_every
+        self.sync = sync
+        self.snapshot_records = 0
+        self.journal_records = 0
+        self.journal = None
+
+    def load(self):
+        """ The stored state.
+            :return: dict of pathString to ((forward weight, reverse weight),
+            forward labels, reverse labels), labels in path order; and dict of
+            FEC key to group id.
+        """
+        lsps, groups = {}, {}
+        self.snapshot_records, _, _ = _replay(self.path, lsps, groups)
+        self.journal_records, end, size = _replay(self.journal_path, lsps, groups)
+        if end < size:  # drop a torn tail, so later appends are readable
+            os.truncate(self.journal_path, end)
+        return lsps, groups
+
+    def append(self, records):
+        """ Appends encoded records to the journal."""
+        if not records:
+            return
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'ab')
+        self.journal.write(b''.join(records))
+        self.journal.flush()
+        if self.sync:
+            os.fsync(self.journal.fileno())
+        self.journal_records += len(records)
+
+    def needs_compaction(self):
+        return self.journal_records > max(self.compact_every, self.snapshot_records)
+
+    def snapshot(self, records):
+        """ Replaces the snapshot with the given records, the whole state, and
+            empties the journal."""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(b''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_path, 'wb')
+        self.snapshot_records = len(records)
+        self.journal_records = 0
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+
+def encode_lsp(pathString, weights, fwd_labels, rev_labels):
+    """ Record of an LSP; the (forward, reverse) weights and the labels of
+        each direction in path order."""
+    path = pathString.encode()
+    labels = list(fwd_labels) + list(rev_labels)
+    weights = [math.nan if w is None else w for w in weights]
+    payload = (LSP.pack(b'A', *weights, len(path)) + path
+               + struct.pack('!{}I'.format(len(labels)), *labels))
+    return _frame(payload)
+
+
+def encode_delete(pathString):
+    path = pathString.encode()
+    return _frame(DELETE.pack(b'D', len(path)) + path)
+
+
+def encode_group(key, group):
+    """ Record of the group of a FEC, None if it has none."""
+    name = '-'.join(key).encode()
+    return _frame(GROUP.pack(b'G', group or 0, len(name)) + name)
+
+
+def _frame(payload):
+    return FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _replay(file, lsps, groups):
+    """ Applies the records of a file to lsps and groups, up to the first
+        incomplete or corrupt one. Returns the number applied, the offset
+        after the last of them and the file size."""
+    try:
+        with open(file, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return 0, 0, 0
+    n = offset = 0
+    while offset + FRAME.size <= len(data):
+        size, crc = FRAME.unpack_from(data, offset)
+        payload = data[offset + FRAME.size:offset + FRAME.size + size]
+        if len(payload) < size or zlib.crc32(payload) != crc:
+            break
+        offset += FRAME.size + size
+        n += 1
+        kind = payload[:1]
+        if kind == b'A':
+            _, fwd_weight, rev_weight, length = LSP.unpack_from(payload)
+            pathString = payload[LSP.size:LSP.size + length].decode()
+            hops = len(pathString.split('-')) - 3
+            labels = struct.unpack_from('!{}I'.format(2 * hops), payload, LSP.size + length)
+            weights = tuple(None if math.isnan(w) else w for w in (fwd_weight, rev_weight))
+            lsps[pathString] = (weights, list(labels[:hops]), list(labels[hops:]))
+        elif kind == b'D':
+            _, length = DELETE.unpack_from(payload)
+            lsps.pop(payload[DELETE.size:DELETE.size + length].decode(), None)
+        elif kind == b'G':
+            _, group, length = GROUP.unpack_from(payload)
+            key = tuple(payload[GROUP.size:GROUP.size + length].decode().split('-'))
+            if group:
+                groups[key] = group
+            else:
+                groups.pop(key, None)
+    return n, offset, len(data)
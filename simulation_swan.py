@@ -1,39 +1,165 @@
 import simpy
+import numpy as np
 
+import math
 import os
 import time
+import datacache
+import evaluation
 import loadfiles
 import swan_controller
+import tunnelgen
+from flowtable import FlowTable, PRIORITIES, encode
 
 # This represents the G-Scale setup, without the actual network data. Max demand is for simulation purposes.
 MAX_DEMAND = 80 # from the paper
 NUM_DC = 12
 NUM_LINKS = 19
+SWAN_INTERVAL = 300  # seconds between allocations, 5 minutes in the paper
+LINK_CAPACITY = 20  # per direction, links.xlsx has no capacities
+NUM_TUNNELS = 3  # tunnels per DC pair
 
-flows = {}
+flows = None  # FlowTable of all priority classes
 datacenters = []
 links = {}
+allocator = None  # swan_controller.Allocator of the loaded scenario
 
-def load_data():
-    flow_int, flow_el, flow_bac = loadfiles.readFiles()
-    flows['interactive'] = flow_int
-    flows['elastic'] = flow_el
-    flows['background'] = flow_bac
+SOURCE_FILES = ['links.xlsx'] + [loadfiles.PRIORITY_FILES[p] for p in PRIORITIES]
 
-    links = loadfiles.readLinks()
-    lenLinks = len(links)
+def load_data(use_cache=True):
+    global flows, datacenters, links
+    data = datacache.load(SOURCE_FILES, read_data) if use_cache else read_data()
+    nodes = data['nodes']
+    flows = FlowTable(data['priority'], data['src'], data['dst'], data['demand'], nodes)
+    links = {'Ingress': nodes[data['link_src']], 'Egress': nodes[data['link_dst']],
+             'src': data['link_src'], 'dst': data['link_dst']}
+    datacenters = nodes.tolist()
+    return flows, links
+
+def read_data():
+    """ Parses the source files into the flat arrays kept in the cache. Flow and
+        link endpoints are coded against one shared node array."""
+    flow_table = loadfiles.readFiles()
+    link_cols = loadfiles.readLinks()
     # For each link pair, if bidirectional, we add the return link to list, too.
     # This can be skipped if the processing takes into account the bidirectional links.
-    for i in range(0,lenLinks):
-        link = links[i]
-        if link['Bidirectional'] == 'y':
-            tmp = {
-                'Ingress': link['Egress'],
-                'Egress': link['Ingress'],
-                'Bidirectional': 'y'
-            }
-            links.append(tmp)
+    bi = link_cols['Bidirectional']
+    ingress = np.concatenate([link_cols['Ingress'], link_cols['Egress'][bi]])
+    egress = np.concatenate([link_cols['Egress'], link_cols['Ingress'][bi]])
+
+    nodes = np.unique(np.concatenate([ingress, egress, flow_table.nodes]))
+    recode = encode(nodes, flow_table.nodes)
+    return {'priority': flow_table.priority,
+            'src': recode[flow_table.src],
+            'dst': recode[flow_table.dst],
+            'demand': flow_table.demand,
+            'nodes': nodes,
+            'link_src': encode(nodes, ingress),
+            'link_dst': encode(nodes, egress)}
+
+
+def setup_controller(capacity=LINK_CAPACITY, k=NUM_TUNNELS, **kwargs):
+    """ Builds the allocator of the loaded flows, links and their tunnels.
+        Extra keyword arguments go to swan_controller.Allocator."""
+    global allocator
+    allocator = swan_controller.Allocator(
+        flows, zip(links['Ingress'].tolist(), links['Egress'].tolist()),
+        tunnelgen.tunnels_for(links['Ingress'], links['Egress'], k=k),
+        np.full(len(links['Ingress']), capacity, dtype=float), **kwargs)
+    return allocator
+
+def diurnal_snapshots(base, days=1, interval=SWAN_INTERVAL, seed=0):
+    """ Demand snapshots every interval seconds: the base demand of each flow
+        follows a daily sine with random noise, capped at MAX_DEMAND."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(days * 86400 / interval)) * interval
+    factor = 1 + 0.5 * np.sin(2 * np.pi * t / 86400)
+    noise = rng.lognormal(0, 0.2, size=(len(t), len(base)))
+    return np.minimum(factor[:, None] * noise * np.asarray(base)[None, :], MAX_DEMAND)
+
+def simulate(snapshots, snapshot_interval=SWAN_INTERVAL, capacity_events=(),
+             interval=SWAN_INTERVAL, duration=None, alloc=None, fairness=False):
+    """ Replays demand snapshots through the controller in simulated time, with
+        an allocation every interval seconds. Cycles in which neither demand
+        nor capacity changed reuse the previous allocation.
+        :param snapshots: demands, one row per snapshot and one column per flow
+        in FlowTable order. Row i takes effect at i * snapshot_interval. With
+        duration given, any iterable of rows, e.g. estimation.replay.
+        :param capacity_events: (time, link index, capacity) tuples. The
+        capacities of alloc are back to their initial values on return.
+        :param duration: simulated seconds, until the last snapshot if None.
+        :param alloc: the Allocator to drive, the one of setup_controller if None.
+        :param fairness: whether to compare every allocation with the max-min
+        fair rates of its demands and capacities, see evaluation.Evaluator.
+        Off by default, as it solves the whole max-min reference every cycle.
+        :return: dict of arrays with one row per cycle: 'time', 'utilization'
+        (per link), 'throughput' and 'demand' (per priority class), and with
+        fairness 'fairness' (smallest ratio of a flow's rate to its fair rate).
+    """
+    if duration is None:
+        snapshots = np.asarray(snapshots, dtype=float)
+        duration = len(snapshots) * snapshot_interval
+    n_cycles = int(math.ceil(duration / interval))
+    alloc = alloc or allocator
+    table = alloc.flows
+    capacity = alloc.capacity_links  # changed in place by capacity events
+    initial_capacity = capacity.copy()
+    n_links = len(capacity)
+    result = {'time': np.zeros(n_cycles),
+              'utilization': np.zeros((n_cycles, n_links)),
+              'throughput': np.zeros((n_cycles, len(PRIORITIES))),
+              'demand': np.zeros((n_cycles, len(PRIORITIES)))}
+    if fairness:
+        result['fairness'] = np.zeros(n_cycles)
+    changed = [True]
+    evaluator = evaluation.Evaluator(alloc, fairness=fairness)
+    env = simpy.Environment()
+
+    def replay():
+        for row in snapshots:
+            table.set_demand(row)
+            changed[0] = True
+            yield env.timeout(snapshot_interval)
+
+    def capacity_changes():
+        for at, link, cap in sorted(capacity_events):
+            yield env.timeout(max(0, at - env.now))
+            capacity[link] = cap
+            changed[0] = True
+
+    def allocate():
+        current = None
+        for step in range(n_cycles):
+            if changed[0]:
+                current = evaluator.evaluate(alloc.swan_allocation())
+                changed[0] = False
+            result['time'][step] = env.now
+            result['utilization'][step] = current['utilization']
+            result['throughput'][step] = current['served']
+            result['demand'][step] = current['demand']
+            if fairness:
+                result['fairness'][step] = current['fairness']
+            yield env.timeout(interval)
+
+    # processes at the same instant run in this order: demand, capacity, controller
+    env.process(replay())
+    env.process(capacity_changes())
+    env.process(allocate())
+    try:
+        env.run(until=duration)
+    finally:
+        np.copyto(capacity, initial_capacity)
+    return result
 
 
 if __name__ == "__main__":
     load_data()
+    setup_controller()
+    snapshots = diurnal_snapshots(flows.demand, days=1)
+    start = time.time()
+    result = simulate(snapshots)
+    print("Simulated {} cycles in {:.2f}s".format(len(result['time']), time.time() - start))
+    for c, p in enumerate(PRIORITIES):
+        print("{}: {:.1f}% of demand served".format(
+            p, 100 * result['throughput'][:, c].sum() / max(result['demand'][:, c].sum(), 1e-9)))
+    print("Mean link utilization: {:.1f}%".format(100 * result['utilization'].mean()))
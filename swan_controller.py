@@ -2,91 +2,281 @@
 # Author: Sevval Simsek - Boston University
 import math
 import sys
-from dataclasses import dataclass
 
-@dataclass
-class Flow:
-    type: str
-    demand: float
-    allocation: float
+import numpy as np
+import scipy.sparse as sp
+from scipy.optimize import linprog
 
-class Tunnel:
-    ingress: str
-    egress: str
+import metrics
+from flowtable import FlowTable, PRIORITIES, encode
+from tunnelgen import TunnelSet
 
-# Global parameters
-priorities = {'interactive', 'elastic', 'background'}
+# Global parameters, defaults for every Allocator
+priorities = PRIORITIES  # allocation order, highest priority first
 scratch = {'interactive': 0.05, 'elastic': 0.05, 'background': 0.05}
-MAX_INT = sys.maxint
-tunnels = []  # todo: populate these two
-links = []
-I_matrix = [[0 for i in range(len(links))] for j in range(len(tunnels))]
+MAX_INT = sys.maxsize
 
-flows = [] # todo: call readFiles and load flows
-numFlows = len(flows)
 
-capacity_links = [5, 5, 5, 10, 5, 5]  # 5 links total, links not determined here
-rem_c = capacity_links.copy()
+# End - initializations
 
+class Allocator:
+    """ The allocation state of one SWAN scenario: flows, tunnels, link
+        capacities and the LP structures built from them. Nothing is shared
+        between instances, so several scenarios can run in one process.
+        :param flows: FlowTable of all priority classes.
+        :param links: directed links, one (ingress, egress) per link.
+        :param tunnels: TunnelSet over those links (see tunnelgen.tunnels_for).
+        :param capacity_links: capacity of every link.
+        :param scratch: fraction of capacity kept free, per priority or one
+        value for all.
+        :param alpha: if given, each class is allocated with appx_maxmin at
+        this alpha and unit U instead of plain throughput maximization.
+        After swan_allocation, rem_c holds the capacity left by all classes.
+    """
 
-# End - initializations
+    def __init__(self, flows=None, links=(), tunnels=None, capacity_links=(),
+                 scratch=None, alpha=None, U=1.0):
+        self.flows = FlowTable.empty() if flows is None else flows
+        self.links = list(links)
+        self.tunnels = TunnelSet.from_paths([]) if tunnels is None else tunnels
+        self.capacity_links = np.asarray(capacity_links, dtype=float)
+        self.rem_c = self.capacity_links.copy()
+        if scratch is None:
+            scratch = globals()['scratch']
+        self.scratch = dict(scratch) if isinstance(scratch, dict) else dict.fromkeys(priorities, scratch)
+        self.alpha = alpha
+        self.U = U
+        self.build_model()
+
+    def build_model(self):
+        # Called once the flows, tunnels and links are loaded; MCF reuses the result.
+        self.numFlows = len(self.flows)
+        self.I_matrix = self.tunnels.incidence(len(self.capacity_links))  # tunnel x link
+        # Flows and tunnels grouped by (ingress, egress) commodity, -1 if no tunnel serves a flow
+        self.flow_comm, self.tunnel_comm = build_commodities(self.flows, self.tunnels)
+        self.stages = {}  # priority -> Stage of the last swan_allocation
+
+    def swan_allocation(self):
+        """ Allocates the classes strictly in priority order. Every class
+            solves over the capacity the classes before it left, which is
+            consumed in place in rem_c (reset to capacity_links first). A
+            class whose demands and incoming residual capacity are the same
+            as in the previous call reuses its stage result, so when only
+            lower classes change only they are solved again.
+            :return: dict of priority to (per-flow rates, sparse flow x tunnel
+            allocation), as MCF.
+        """
+        allocation = {}
+        rem_c = self.rem_c
+        np.copyto(rem_c, self.capacity_links)
+        with metrics.REGISTRY.histogram('swan_allocation_seconds',
+                                        'Time of a whole swan_allocation').time():
+            for pri in priorities:
+                stage = self.stages.get(pri)
+                key = (int(self.flows.versions[PRIORITIES.index(pri)]), self.alpha, self.U,
+                       self.scratch.get(pri))
+                if stage is None or not stage.matches(key, rem_c):
+                    with metrics.REGISTRY.histogram('swan_class_seconds',
+                                                    'Time to allocate one class',
+                                                    priority=pri).time():
+                        if self.alpha:
+                            result = self.appx_maxmin(self.alpha, self.U, pri, rem_c)
+                        else:
+                            result = self.throughput_max(pri, rem_c)
+                    stage = self.stages[pri] = Stage(key, rem_c, result,
+                                                     self.I_matrix.T @ tunnel_loads({pri: result}))
+                allocation[pri] = stage.result
+                self.flows.allocations(pri)[:] = stage.result[0][self.flows.rows(pri)]
+                rem_c -= stage.load
+                np.maximum(rem_c, 0, out=rem_c)  # solver tolerance may overshoot
+        return allocation
+
+    def throughput_max(self, priority, rem_c):
+        return self.MCF(priority, rem_c, 0, MAX_INT, None)
+
+    def getmaxDemand(self, priority=None):
+        return self.flows.max_demand(priority)
+
+    def getDemandList(self, priority=None):
+        return self.flows.demands(priority)
+
+    def appx_maxmin(self, alpha, U, pri, rem_c):
+        """ Approximate max-min fairness from the SWAN paper: step k solves MCF with
+            every non-frozen flow between alpha^(k-1)*U and alpha^k*U, then freezes
+            the flows that could not reach their bound. The class LP is assembled
+            once and only the bounds of the still active flows move between steps.
+            :return: per-flow rates and the sparse flow x tunnel allocation, as MCF.
+        """
+        lp = ClassLP(self, pri, rem_c)
+        d = lp.demands
+        frozen = np.zeros(len(d), dtype=bool)  # bitmask over the class flows
+        lower = np.zeros(len(d))
+        upper = np.zeros(len(d))
+        b, y = np.zeros(len(d)), np.zeros(len(lp.tun))
+        d_max = d.max() if len(d) else 0
+        T = max(1, math.ceil(math.log(d_max / U, alpha))) if d_max > U else 1
+        for k in range(1, T + 1):
+            b_high = math.pow(alpha, k) * U
+            active = ~frozen
+            upper[active] = np.minimum(b_high, d[active])
+            lower[active] = np.minimum(math.pow(alpha, k - 1) * U, upper[active])
+            b, y = lp.solve(lower, upper, frozen)
+            # a flow held below its bound is bottlenecked, its rate will not grow;
+            # a flow at its demand is done. Both keep their rate from now on.
+            done = active & ((b < upper - 1e-9 * np.maximum(1, upper)) | (upper >= d))
+            lower[done] = upper[done] = b[done]
+            frozen |= done
+            if frozen.all():
+                break
+        return lp.expand(b, y)
+
+    # Multi-commodity flow problem
+    def MCF(self, priority: str, rem_c, b_low: float, b_high: float, F):
+        """ Maximizes the total throughput of one priority class as a single LP
+            over all of its flows and tunnels.
+            :param rem_c: remaining capacity per link.
+            :param b_low: lower bound on the rate of each non-frozen flow.
+            :param b_high: upper bound on the rate of each non-frozen flow.
+            :param F: frozen flows, a dict of flow index to fixed rate, or None.
+            :return: per-flow rates (numpy array of length numFlows) and the
+            per-flow, per-tunnel allocation as a sparse flow x tunnel matrix.
+        """
+        lp = ClassLP(self, priority, rem_c)
+        # constraint: min_b < b < max_b
+        upper = np.minimum(b_high, lp.demands)
+        lower = np.minimum(b_low, upper)
+        frozen = np.zeros(len(lp.cls), dtype=bool)
+        row_of = {i: r for r, i in enumerate(lp.cls)}
+        for i, b_i in (F or {}).items():
+            if i in row_of:
+                lower[row_of[i]] = upper[row_of[i]] = b_i
+                frozen[row_of[i]] = True
+        b, y = lp.solve(lower, upper, frozen)
+        return lp.expand(b, y)
+
+
+class Stage:
+    """ The result of one class in swan_allocation and what it was computed
+        from: a key of the class demand version and allocation parameters,
+        and the residual capacity it started from."""
+
+    def __init__(self, key, rem_c, result, load):
+        self.key = key
+        self.rem_c = rem_c.copy()
+        self.result = result
+        self.load = load  # per link
+
+    def matches(self, key, rem_c):
+        return key == self.key and np.array_equal(rem_c, self.rem_c)
+
+
+def tunnel_loads(allocation):
+    """ Total load of every tunnel over all classes of a swan_allocation result."""
+    return sum(np.bincount(x.indices, weights=x.data, minlength=x.shape[1])
+               for _, x in allocation.values())
+
+
+def build_commodities(flow_table, tunnel_set):
+    """Numbers the (ingress, egress) pairs served by tunnels and tags every flow
+        and tunnel with its pair. Flows between the same pair share the same
+        tunnels, so the LP only needs one column per tunnel."""
+    t_key = np.char.add(np.char.add(tunnel_set.ingress, '>'), tunnel_set.egress)
+    keys, t_comm = np.unique(t_key, return_inverse=True)
+    f_src, f_dst = flow_table.endpoints()
+    f_comm = encode(keys, np.char.add(np.char.add(f_src.astype(str), '>'), f_dst.astype(str)))
+    return f_comm.astype(np.int64), t_comm.astype(np.int64)
+
+
+class ClassLP:
+    """ The MCF linear program of one priority class. Columns are the rate of
+        every class flow plus the load of every tunnel its commodities use, tied
+        together by one conservation row per commodity. Flow bounds are column
+        bounds, so solve() only swaps two vectors and repeated solves (the alpha
+        steps of appx_maxmin) reuse the assembled constraint matrix.
+    """
+
+    def __init__(self, alloc, priority, rem_c):
+        rows = alloc.flows.rows(priority)
+        self.alloc = alloc
+        self.priority = priority
+        self.cls = np.arange(rows.start, rows.stop)
+        self.demands = alloc.flows.demands(priority)
+        self.comm = alloc.flow_comm[self.cls]
+        self.has_tunnel = self.comm >= 0
+        tunnel_comm = alloc.tunnel_comm
+        self.tun = np.flatnonzero(np.isin(tunnel_comm, self.comm[self.has_tunnel]))
+        n_f, n_t = len(self.cls), len(self.tun)
+        self.num_cols = n_t + n_f
+
+        self.A_ub = self.b_ub = self.A_eq = self.b_eq = None
+        if n_t:
+            # for each link, allocation sum must be less than remaining capacity;
+            # rem_c is what earlier classes left, so the scratch is kept out of it
+            s_cap = alloc.scratch.get(priority)
+            min_capacity = np.maximum(np.asarray(rem_c, dtype=float)
+                                      - s_cap * alloc.capacity_links, 0)
+            A_link = alloc.I_matrix[self.tun].T  # link x tunnel
+            self.A_ub = sp.hstack([A_link, sp.csr_matrix((A_link.shape[0], n_f))]).tocsr()
+            self.b_ub = min_capacity
+            # per commodity: sum of its tunnel loads == sum of its flow rates
+            n_c = int(tunnel_comm.max()) + 1
+            f_rows = np.flatnonzero(self.has_tunnel)
+            self.A_eq = sp.hstack([
+                sp.csr_matrix((np.ones(n_t), (tunnel_comm[self.tun], np.arange(n_t))), shape=(n_c, n_t)),
+                sp.csr_matrix((-np.ones(len(f_rows)), (self.comm[f_rows], f_rows)), shape=(n_c, n_f)),
+            ]).tocsr()
+            self.b_eq = np.zeros(n_c)
+        self.bounds = np.zeros((self.num_cols, 2))
+        self.bounds[:n_t, 1] = np.inf
+
+    def solve(self, lower, upper, frozen=None):
+        """ Maximizes the class throughput with lower <= b <= upper per class
+            flow. If the lower bounds cannot all be met, only the frozen flows
+            keep theirs. Returns class flow rates and per-tunnel loads.
+        """
+        n_t = len(self.tun)
+        if not n_t:
+            return np.zeros(len(self.cls)), np.zeros(0)
+        f_bounds = self.bounds[n_t:]
+        f_bounds[:, 1] = np.where(self.has_tunnel, upper, 0)
+        f_bounds[:, 0] = np.where(self.has_tunnel, lower, 0)
+        c = np.concatenate([np.zeros(n_t), -np.ones(len(self.cls))])
+        res = self._linprog(c)
+        if res.status == 2 and frozen is not None:
+            f_bounds[:, 0] = np.where(frozen & self.has_tunnel, lower, 0)
+            res = self._linprog(c)
+        if res.status != 0:
+            raise RuntimeError("MCF for {} failed: {}".format(self.priority, res.message))
+        return res.x[n_t:], res.x[:n_t]
+
+    def _linprog(self, c):
+        with metrics.REGISTRY.histogram('swan_lp_solve_seconds', 'Time of one LP solve',
+                                        priority=self.priority).time():
+            return linprog(c, A_ub=self.A_ub, b_ub=self.b_ub, A_eq=self.A_eq, b_eq=self.b_eq,
+                           bounds=self.bounds, method='highs')
+
+    def expand(self, b, y):
+        """ Maps class flow rates and tunnel loads back to all flows. A flow gets
+            the share of each of its tunnels that its rate has in the commodity."""
+        num_flows, num_tunnels = self.alloc.numFlows, len(self.alloc.tunnels)
+        tunnel_comm = self.alloc.tunnel_comm
+        list_b = np.zeros(num_flows)
+        list_b[self.cls] = b
+        if not len(self.tun):
+            return list_b, sp.csr_matrix((num_flows, num_tunnels))
+        f_rows = np.flatnonzero(self.has_tunnel)
+        comm_total = np.bincount(self.comm[f_rows], weights=b[f_rows],
+                                 minlength=int(tunnel_comm.max()) + 1)
+        share = np.divide(b[f_rows], comm_total[self.comm[f_rows]],
+                          out=np.zeros(len(f_rows)), where=comm_total[self.comm[f_rows]] > 0)
+        W = sp.csr_matrix((share, (self.cls[f_rows], self.comm[f_rows])),
+                          shape=(num_flows, len(comm_total)))
+        Y = sp.csr_matrix((y, (tunnel_comm[self.tun], self.tun)),
+                          shape=(len(comm_total), num_tunnels))
+        return list_b, (W @ Y).tocsr()
 
-def swan_allocation():
-    for pri in priorities:
-        tunnels.append(throughput_max(pri, rem_c))
-    return tunnels
-
-
-def throughput_max(priority, rem_c):
-    return MCF(priority, rem_c, 0, MAX_INT, None)
-
-def getmaxDemand():
-    max_d = 0
-    for f in flows:
-        if f.demand > max_d:
-            max_d = f.demand
-    return max_d
-
-def getDemandList():
-    demands = []
-    for f in flows:
-        demands.append(f.demand)
-    return demands
-
-def appx_maxmin(alpha, U, pri, rem_c):
-    F = [] # todo: learn what this is
-    d_max = getmaxDemand()
-    T = math.ceil(math.log(d_max / U, alpha))
-    f_list = []
-    for k in range(1, T):
-        list_b = MCF(pri, rem_c, math.pow(alpha, k - 1) * U, math.pow(alpha, k) * U, F)
-        for i in range(len(list_b)):
-            if i not in F and list_b[i] < min([k], math.pow(alpha,k)*U):
-                F.append(i)
-                f_list.append(list_b[i])
-    return f_list
-
-# Multi-commodity flow problem
-def MCF(priority: str, rem_c, b_low: float, b_high: float, F):
-    list_b = []
-    for i in range(numFlows):
-        if i in F:
-            b_i = F[i]
-            list_b[i] = b_i
-        else:
-            max_b = min(b_high, flows[i].demand)
-            min_b = b_low
-            # constraint: min_b < b < max_b
-            b_i = math.floor((min_b + max_b) / 2)  # average approach, todo: make sure this is true
-
-            # another constraint, for each link, allocation sum must be less than remaining capacity
-            for l in range(len(links)):
-                s_cap = scratch.get(priority)
-                min_capacity = min(rem_c[l], (1-s_cap)*capacity_links[l])
-
-
-            list_b[i] = b_i
-    return list_b
 
 if __name__ == '__main__':
-    allocation_map = swan_allocation()
+    import simulation_swan
+    simulation_swan.load_data()
+    allocation_map = simulation_swan.setup_controller().swan_allocation()
@@ -0,0 +1,160 @@
+# Parallel what-if sweeps over SWAN allocation scenarios
+import functools
+import itertools
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from evaluation import Evaluator
+from flowtable import FlowTable, PRIORITIES
+from swan_controller import Allocator
+from tunnelgen import TunnelSet
+
+# Arrays of the base scenario in this worker process, attached by _init_worker
+_blocks = []
+_arrays = {}
+
+
+class SharedArrays:
+    """ Copies read-only arrays into shared memory once. Workers attach to them
+        by name (see attach) instead of receiving a pickled copy per task."""
+
+    def __init__(self, arrays):
+        self.spec = {}
+        self._blocks = []
+        for name, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[...] = arr
+            self._blocks.append(shm)
+            self.spec[name] = (shm.name, arr.shape, arr.dtype.str)
+
+    def close(self):
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(spec):
+    """ Maps the arrays described by SharedArrays.spec, read-only. Returns the
+        shared memory blocks (keep them alive) and the arrays."""
+    blocks, arrays = [], {}
+    for name, (shm_name, shape, dtype) in spec.items():
+        shm = _open(shm_name)
+        arr = np.ndarray(shape, dtype, buffer=shm.buf)
+        arr.flags.writeable = False
+        blocks.append(shm)
+        arrays[name] = arr
+    return blocks, arrays
+
+
+def _open(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if multiprocessing.get_start_method() != 'fork':
+            # a spawned worker has its own resource tracker, which would unlink
+            # the block when the worker exits; the creating process owns it
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def scenario_arrays(alloc):
+    """ The arrays a worker needs to rebuild the scenario of an Allocator."""
+    flows, tunnels = alloc.flows, alloc.tunnels
+    return {'priority': flows.priority, 'src': flows.src, 'dst': flows.dst,
+            'demand': flows.demand, 'nodes': flows.nodes,
+            'tunnel_ingress': tunnels.ingress, 'tunnel_egress': tunnels.egress,
+            'tunnel_indptr': tunnels.indptr, 'tunnel_indices': tunnels.indices,
+            'capacity': alloc.capacity_links}
+
+
+def _init_worker(spec):
+    global _blocks, _arrays
+    _blocks, _arrays = attach(spec)
+
+
+def run_scenario(arrays, scenario, fairness=False):
+    """ Allocates one scenario over the base arrays and summarizes the result.
+        :param scenario: dict with 'scratch', 'alpha', 'U', 'demand_scale',
+        'max_demand' (None for no cap) and 'capacity_scale'.
+        :param fairness: whether to compare the allocation with the max-min
+        fair rates of the scenario ('fairness' and 'mean_fairness'), which
+        takes many times as long as the allocation itself.
+    """
+    a = arrays
+    demand = a['demand'] * scenario['demand_scale']
+    if scenario['max_demand'] is not None:
+        np.minimum(demand, scenario['max_demand'], out=demand)
+    flows = FlowTable(a['priority'], a['src'], a['dst'], demand, a['nodes'])
+    tunnels = TunnelSet(a['tunnel_ingress'], a['tunnel_egress'],
+                        a['tunnel_indptr'], a['tunnel_indices'])
+    alloc = Allocator(flows, (), tunnels, a['capacity'] * scenario['capacity_scale'],
+                      scratch=scenario['scratch'], alpha=scenario['alpha'], U=scenario['U'])
+    start = time.perf_counter()
+    allocation = alloc.swan_allocation()
+    seconds = time.perf_counter() - start
+
+    step = Evaluator(alloc, fairness=fairness).evaluate(allocation)
+    row = {k: v for k, v in scenario.items() if not isinstance(v, dict)}
+    for c, p in enumerate(PRIORITIES):
+        row[p + '_throughput'] = step['served'][c]
+        row[p + '_demand'] = step['demand'][c]
+        row[p + '_jain'] = step['jain'][c]
+    row['max_utilization'] = step['utilization'].max() if len(step['utilization']) else 0.0
+    if fairness:
+        row['fairness'] = step['fairness']
+        row['mean_fairness'] = step['mean_fairness']
+    row['seconds'] = seconds
+    return row
+
+
+def _run(scenario, fairness=False):
+    return run_scenario(_arrays, scenario, fairness)
+
+
+def sweep(alloc, grid, max_workers=None, fairness=False):
+    """ Runs the scenario of alloc under every combination of the grid values
+        across a process pool. The base flows, tunnels and capacities go to
+        shared memory once; each task only carries its parameters.
+        :param alloc: the base Allocator, e.g. simulation_swan.setup_controller().
+        :param grid: dict of parameter name to list of values; parameters not in
+        the grid keep the value of alloc (see run_scenario for the names).
+        :param fairness: see run_scenario.
+        :return: pandas DataFrame with one row per scenario.
+    """
+    base = {'scratch': alloc.scratch, 'alpha': alloc.alpha, 'U': alloc.U,
+            'demand_scale': 1.0, 'max_demand': None, 'capacity_scale': 1.0}
+    unknown = set(grid) - set(base)
+    if unknown:
+        raise ValueError("Unknown sweep parameters: {}".format(sorted(unknown)))
+    keys = list(grid)
+    scenarios = [dict(base, **dict(zip(keys, values)))
+                 for values in itertools.product(*(grid[k] for k in keys))]
+    with SharedArrays(scenario_arrays(alloc)) as shared:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(shared.spec,)) as pool:
+            rows = list(pool.map(functools.partial(_run, fairness=fairness), scenarios))
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    import simulation_swan
+    simulation_swan.load_data()
+    base = simulation_swan.setup_controller()
+    results = sweep(base, {'scratch': [0.0, 0.05, 0.1, 0.2],
+                           'alpha': [None, 2, 4],
+                           'demand_scale': [1, 2, 4]})
+    print(results.to_string())
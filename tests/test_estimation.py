@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from estimation import DemandEstimator
+from flowtable import FlowTable
+
+KEY = ('interactive', 'A', 'B')
+
+
+def feed(estimator, counters, key=KEY):
+    for t, counter in enumerate(counters):
+        estimator.observe([key], [counter], t)
+
+
+@pytest.mark.parametrize('method, expected', [('ewma', 31.25), ('mean', 30), ('max', 40),
+                                              ('last', 40)])
+def test_estimates_of_rates(method, expected):
+    # rates 10, 20, 30, 40; the window keeps the last three
+    estimator = DemandEstimator(window=3, method=method, alpha=0.5, headroom=2.0, scale=1.0)
+    feed(estimator, [0, 10, 30, 60, 100])
+    assert np.isclose(estimator.estimate()[estimator.rows[KEY]], 2 * expected)
+
+
+def test_first_sample_and_counter_reset():
+    estimator = DemandEstimator(method='last', scale=1.0)
+    feed(estimator, [100])
+    assert estimator.records() == []  # only a baseline
+    feed(estimator, [100, 150, 5, 25])
+    # 150 -> 5 restarts the counter, the next rate is 20 and not negative
+    assert estimator.records() == [KEY + (20.0,)]
+    assert estimator.count[estimator.rows[KEY]] == 2
+
+
+def test_expire_reuses_rows():
+    estimator = DemandEstimator(method='last', scale=1.0, size=2)
+    keys = [('elastic', 'A', n) for n in 'BCD']
+    estimator.observe(keys, [0, 0, 0], 0)
+    estimator.observe(keys[:2], [10, 20], 1)
+    assert len(estimator.counter) == 4  # grown past size
+    estimator.expire(1)
+    assert len(estimator) == 2 and estimator.free == [2]
+    estimator.observe([('background', 'X', 'Y')], [50], 2)
+    assert estimator.rows[('background', 'X', 'Y')] == 2
+    # the reused row starts over without the rates of the expired flow
+    assert estimator.count[2] == 0 and estimator.estimate()[2] == 0
+    assert sorted(estimator.records()) == [('elastic', 'A', 'B', 10.0), ('elastic', 'A', 'C', 20.0)]
+
+
+def test_demand_vector_follows_the_flow_table():
+    flows = FlowTable.from_records([('background', 'A', 'B', 1.0), ('interactive', 'A', 'C', 2.0),
+                                    ('elastic', 'B', 'C', 3.0), ('interactive', 'C', 'A', 4.0)])
+    estimator = DemandEstimator(method='last', scale=1.0)
+    keys = [('background', 'A', 'B'), ('elastic', 'B', 'C'), ('interactive', 'A', 'C')]
+    estimator.observe(keys, [0, 0, 0], 0)
+    estimator.observe(keys, [10, 30, 20], 1)
+    # flows are in priority order; C to A has no estimate and keeps its demand
+    assert [tuple(e) for e in zip(*flows.endpoints())] == [('A', 'C'), ('C', 'A'), ('B', 'C'),
+                                                           ('A', 'B')]
+    assert np.allclose(estimator.demand_vector(flows), [20, 4, 30, 10])
+    assert np.allclose(estimator.demand_vector(flows, default=np.zeros(4)), [20, 0, 30, 10])
@@ -0,0 +1,41 @@
+import numpy as np
+
+from evaluation import Evaluator
+from flowtable import FlowTable
+from swan_controller import Allocator
+from tunnelgen import TunnelSet
+
+
+def allocator(demands):
+    """ Two flows from A to B over one link of capacity 10."""
+    flows = FlowTable.from_records([('interactive', 'A', 'B', d) for d in demands])
+    tunnels = TunnelSet.from_paths([('A', 'B', [0])])
+    return Allocator(flows, [('A', 'B')], tunnels, [10.0], scratch=0.0)
+
+
+def test_fairness_reference_follows_demand():
+    alloc = allocator([8.0, 8.0])
+    evaluator = Evaluator(alloc, fairness=True)
+    step = evaluator.evaluate(alloc.swan_allocation())
+    assert np.allclose(evaluator.reference.rates(), [5, 5], atol=0.5)
+    assert step['fairness'] <= 1.0 + 1e-6
+
+    alloc.flows.set_demand(np.array([2.0, 8.0]))
+    step = evaluator.evaluate(alloc.swan_allocation())
+    # fair rates of the new demands, not of the first ones
+    assert np.allclose(evaluator.reference.rates(), [2, 8], atol=0.5)
+    assert np.isclose(step['fairness'], 1.0, atol=1e-6)
+    assert evaluator.summary()['fairness'] <= 1.0 + 1e-6
+
+
+def test_rates_come_from_the_evaluated_allocation():
+    alloc = allocator([2.0, 3.0])
+    evaluator = Evaluator(alloc)
+    first = alloc.swan_allocation()
+    alloc.flows.set_demand(np.array([1.0, 1.0]))
+    alloc.swan_allocation()  # overwrites the allocation column of the flows
+    assert np.allclose(evaluator.flow_rates(first), [2, 3])
+    assert np.isclose(evaluator.evaluate(first)['served'].sum(), 5)
+    assert 'fairness' not in evaluator.evaluate(first)
+    step = evaluator.evaluate(first, reference=np.array([4.0, 3.0]))
+    assert np.isclose(step['fairness'], 0.5)
@@ -0,0 +1,33 @@
+import numpy as np
+
+from failover import FailureCache, failure_scenarios, link_failure, switch_failure
+
+LINKS = [('S1', 'S2'), ('S2', 'S1'), ('S2', 'S3')]
+
+
+def up_links(capacity):
+    """ A stand-in allocation: every link left up carries its capacity."""
+    return {'-'.join(link): float(c) for link, c in zip(LINKS, capacity) if c > 0}
+
+
+def test_failure_scenarios():
+    scenarios = [(failure, down.tolist()) for failure, down in failure_scenarios(LINKS)]
+    assert scenarios == [(('link', 'S1', 'S2'), [0, 1]), (('link', 'S2', 'S3'), [2]),
+                         (('switch', 'S1'), [0, 1]), (('switch', 'S2'), [0, 1, 2]),
+                         (('switch', 'S3'), [2])]
+    assert link_failure('S2', 'S1') == link_failure('S1', 'S2')
+
+
+def test_build_and_lookup():
+    cache = FailureCache(LINKS)
+    assert cache.lookup(switch_failure('S1')) is None  # nothing built yet
+    for kwargs in ({'workers': 1}, {'map': map}):
+        cache.build(up_links, [10, 20, 30], **kwargs)
+        assert cache.rates.shape == (5, 3)
+        assert cache.lookup(link_failure('S3', 'S2')) == {'S1-S2': 10.0, 'S2-S1': 20.0}
+        assert cache.lookup(switch_failure('S3')) == {'S1-S2': 10.0, 'S2-S1': 20.0}
+        assert cache.lookup(switch_failure('S2')) == {}
+        assert cache.lookup(link_failure('S1', 'S2')) == {'S2-S3': 30.0}
+    assert switch_failure('S4') not in cache
+    assert cache.lookup(switch_failure('S4')) is None
+    assert np.allclose(cache.rates.sum(axis=1).A.ravel(), [30, 30, 30, 0, 30])
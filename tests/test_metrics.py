@@ -0,0 +1,26 @@
+import threading
+
+import metrics
+
+
+def test_updates_from_threads_are_not_lost():
+    registry = metrics.Registry()
+    counter = registry.counter('ops_total', 'Operations')
+    histogram = registry.histogram('op_seconds', 'Operation time')
+
+    def work():
+        for _ in range(20000):
+            counter.inc()
+            histogram.observe(1e-3)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for _ in range(20):
+        registry.render()
+    for t in threads:
+        t.join()
+    snapshot = registry.snapshot()
+    assert snapshot['ops_total'] == 80000
+    assert snapshot['op_seconds'][0] == 80000
+    assert 'op_seconds_count 80000' in registry.render()
@@ -0,0 +1,42 @@
+import pytest
+
+from mpls_labels import LabelManager, LabelPool, LabelsExhausted
+
+
+def test_pool_exhaustion_and_reuse():
+    pool = LabelPool(16, 18)
+    assert [pool.allocate() for _ in range(3)] == [16, 17, 18]
+    assert len(pool) == 0
+    with pytest.raises(LabelsExhausted):
+        pool.allocate()
+    pool.release(17)
+    assert len(pool) == 1
+    assert pool.allocate() == 17
+
+
+def test_release_twice_raises():
+    pool = LabelPool(16, 18)
+    label = pool.allocate()
+    pool.release(label)
+    with pytest.raises(ValueError):
+        pool.release(label)
+    with pytest.raises(ValueError):
+        pool.release(18)  # never handed out
+    assert len(pool) == 3
+
+
+def test_restore_frees_the_gaps():
+    pool = LabelPool(16, 20)
+    pool.restore([17, 19])
+    assert sorted(pool.allocate() for _ in range(3)) == [16, 18, 20]
+    with pytest.raises(ValueError):
+        pool.release(16 + 100)
+
+
+def test_reserve_path_is_all_or_nothing():
+    labels = LabelManager(16, 16)
+    labels.allocate(('S2', 'S3'))
+    with pytest.raises(LabelsExhausted):
+        labels.reserve_path(['S1', 'S2', 'S3'])
+    # the label taken on S1-S2 before S2-S3 ran out was given back
+    assert labels.reserve_path(['S1', 'S2']) == {('S1', 'S2'): 16}
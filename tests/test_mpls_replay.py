@@ -0,0 +1,17 @@
+import os
+
+import mpls_replay
+
+NETFILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ExNet.json')
+
+
+def test_replay_synthetic_trace():
+    app = mpls_replay.make_app(NETFILE)
+    trace = mpls_replay.synthetic_trace(app, cycles=3, n_flows=10)
+    result = mpls_replay.replay(app, trace)
+    assert len(result['steps']) == 3
+    assert result['misses'] == 0
+    assert all(step['unconfirmed'] == 0 for step in result['steps'])
+    assert result['steps'][0]['lsps'] > 0
+    assert sum(result['flows'].values()) > 0
+    assert sum(result['groups'].values()) > 0
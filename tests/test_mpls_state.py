@@ -0,0 +1,57 @@
+import os
+
+from mpls_state import LspStore, encode_delete, encode_group, encode_lsp
+
+
+def test_journal_and_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'lsps.state')
+    store = LspStore(path, sync=False)
+    assert store.load() == ({}, {})
+    store.append([encode_lsp('H1-S1-S2-H5', (3.0, None), [16], [17]),
+                  encode_lsp('H1-S1-S3-S2-H5', (1.0, 2.0), [16, 18], [19, 20]),
+                  encode_group(('S1', 'H1', 'H5'), 7)])
+    store.append([encode_delete('H1-S1-S2-H5'), encode_group(('S2', 'H5', 'H1'), 3)])
+    store.close()
+
+    lsps, groups = LspStore(path).load()
+    assert lsps == {'H1-S1-S3-S2-H5': ((1.0, 2.0), [16, 18], [19, 20])}
+    assert groups == {('S1', 'H1', 'H5'): 7, ('S2', 'H5', 'H1'): 3}
+
+    store = LspStore(path, sync=False)
+    store.load()
+    store.snapshot([encode_lsp('H1-S1-S2-H5', (None, None), [21], [22]),
+                    encode_group(('S1', 'H1', 'H5'), 0)])
+    assert os.path.getsize(store.journal_path) == 0
+    store.append([encode_group(('S2', 'H5', 'H1'), 4)])
+    store.close()
+    assert LspStore(path).load() == ({'H1-S1-S2-H5': ((None, None), [21], [22])},
+                                     {('S2', 'H5', 'H1'): 4})
+
+
+def test_torn_tail_is_dropped(tmp_path):
+    path = str(tmp_path / 'lsps.state')
+    store = LspStore(path, sync=False)
+    store.append([encode_lsp('H1-S1-S2-H5', (1.0, 1.0), [16], [17])])
+    store.close()
+    size = os.path.getsize(path + '.journal')
+    record = encode_lsp('H2-S1-S2-H5', (1.0, 1.0), [18], [19])
+    with open(path + '.journal', 'ab') as f:
+        f.write(record[:-3])  # a crash in the middle of a write
+
+    store = LspStore(path, sync=False)
+    lsps, _ = store.load()
+    assert list(lsps) == ['H1-S1-S2-H5']
+    assert os.path.getsize(path + '.journal') == size
+    store.append([record])
+    store.close()
+    assert sorted(LspStore(path).load()[0]) == ['H1-S1-S2-H5', 'H2-S1-S2-H5']
+
+
+def test_compaction_threshold(tmp_path):
+    store = LspStore(str(tmp_path / 'lsps.state'), compact_every=2, sync=False)
+    store.load()
+    store.append([encode_delete('H1-S1-S2-H5')] * 2)
+    assert not store.needs_compaction()
+    store.append([encode_delete('H1-S1-S2-H5')])
+    assert store.needs_compaction()
+    store.close()
@@ -0,0 +1,252 @@
+import os
+
+import pytest
+
+import mpls_replay
+from mpls_control import ControlLoop
+
+NETFILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ExNet.json')
+
+
+@pytest.fixture
+def app():
+    app = mpls_replay.make_app(NETFILE)
+    app.logger.disabled = True
+    return app
+
+
+def directed(pathString, d):
+    return pathString if d == "fwd" else "-".join(reversed(pathString.split("-")))
+
+
+def test_bucket_weights_follow_each_direction(app):
+    loop = ControlLoop(app, None, backups=False)
+    # far more traffic from H5 to H1 than back, over two paths each way
+    rates = loop.allocate([('interactive', 'H5', 'H1', 25.0), ('interactive', 'H1', 'H5', 5.0)])
+    loop.apply(rates)
+    mpls_replay.answer_all(app)
+    split = 0
+    for key, fec in app.fecs.items():
+        members = list(fec["members"].items())
+        buckets = app.switches[key[0]].groups[fec["group"]]
+        expected = [rates.get(directed(p, d), 0.0) for p, d in members]
+        installed = [b.weight for b in buckets]
+        for e, w in zip(expected, installed):
+            assert w / sum(installed) == pytest.approx(e / sum(expected), abs=2e-3)
+        split += len(members) > 1
+    assert split == 2  # each direction has a bucket per path, weighted apart
+
+
+def test_replacement_with_another_ingress_leaves_the_old_fec(tmp_path):
+    import topology_builder
+    nodes = [{'id': s, 'type': 'switch'} for s in ('S1', 'S2', 'S3')]
+    nodes += [{'id': 'H{}'.format(i), 'type': 'host', 'ip': topology_builder.host_ip(i),
+               'mac': topology_builder.host_mac(i)} for i in (1, 2)]
+    # H1 is attached to both S1 and S2
+    links = [('H1', 'S1', 0), ('H1', 'S2', 0), ('H2', 'S3', 0), ('S1', 'S3', 10), ('S2', 'S3', 10)]
+    netfile = str(tmp_path / 'net.json')
+    topology_builder.to_json(topology_builder.network(nodes, links), netfile)
+    app = mpls_replay.make_app(netfile)
+    app.reconcile({'H1-S1-S3-H2': 1})
+    mpls_replay.answer_all(app)
+    assert app.switches['S1'].groups
+    app.reconcile({'H1-S2-S3-H2': 1})
+    mpls_replay.answer_all(app)
+    assert ('S1', 'H1', 'H2') not in app.fecs
+    assert not app.switches['S1'].groups
+    assert not app.switches['S1'].flows
+    assert list(app.fecs[('S2', 'H1', 'H2')]['members']) == ['H1-S2-S3-H2']
+    # the reverse direction keeps its ingress at S3, now with the new LSP only
+    buckets = app.switches['S3'].groups[app.fecs[('S3', 'H2', 'H1')]['group']]
+    assert len(buckets) == 1
+    assert sum(dp.misses for dp in app.switches.values()) == 0
+
+
+def record(app):
+    """ Logs (switch, message) of everything sent to the switches of app."""
+    log = []
+    for dp in app.switches.values():
+        def send_msg(msg, dp=dp, send=dp.send_msg):
+            log.append((dp.name, msg))
+            send(msg)
+        dp.send_msg = send_msg
+    return log
+
+
+def answer_round(app):
+    """ Answers what every switch has been sent so far, once."""
+    for dp in list(app.switches.values()):
+        dp.answer(app)
+
+
+def mods(log):
+    ofp = mpls_replay.ofproto_v1_3
+    out = []
+    for switch, msg in log:
+        if isinstance(msg, mpls_replay.ofproto_v1_3_parser.OFPFlowMod):
+            kind = {ofp.OFPFC_ADD: 'add', ofp.OFPFC_MODIFY: 'modify'}.get(msg.command, 'delete')
+            out.append((switch, 'flow ' + kind))
+        elif isinstance(msg, mpls_replay.ofproto_v1_3_parser.OFPGroupMod):
+            kind = {ofp.OFPGC_ADD: 'add', ofp.OFPGC_MODIFY: 'modify'}.get(msg.command, 'delete')
+            out.append((switch, 'group ' + kind))
+    return out
+
+
+def test_reroute_is_made_before_broken(app):
+    app.reconcile({'H1-S1-S2-H5': 1})
+    mpls_replay.answer_all(app)
+    log = record(app)
+    confirmed = []
+    app.reconcile({'H1-S1-S3-S2-H5': 1}, callback=confirmed.append)
+    # new hops first, nothing moved onto them yet
+    assert sorted(mods(log)) == [('S1', 'flow add'), ('S2', 'flow add'),
+                                 ('S3', 'flow add'), ('S3', 'flow add')]
+    del log[:]
+    answer_round(app)
+    # then the ingress groups, in both directions
+    assert sorted(mods(log)) == [('S1', 'group modify'), ('S2', 'group modify')]
+    del log[:]
+    answer_round(app)
+    # and the old hops last
+    assert sorted(mods(log)) == [('S1', 'flow delete'), ('S2', 'flow delete')]
+    assert not confirmed
+    answer_round(app)
+    assert confirmed == ['H1-S1-S3-S2-H5']
+    assert not app.unconfirmed and not app.transactions
+    assert sum(dp.misses for dp in app.switches.values()) == 0
+
+
+def test_removal_leaves_the_groups_first(app):
+    app.reconcile({'H1-S1-S3-S2-H5': 1})
+    mpls_replay.answer_all(app)
+    log = record(app)
+    app.remove_lsp('H1-S1-S3-S2-H5')
+    assert sorted(mods(log)) == [('S1', 'flow delete'), ('S1', 'group delete'),
+                                 ('S2', 'flow delete'), ('S2', 'group delete')]
+    del log[:]
+    answer_round(app)
+    assert sorted(mods(log)) == [('S1', 'flow delete'), ('S2', 'flow delete'),
+                                 ('S3', 'flow delete'), ('S3', 'flow delete')]
+    mpls_replay.answer_all(app)
+    assert all(not dp.flows and not dp.groups for dp in app.switches.values())
+
+
+def test_control_loop_moves_through_congestion_free_steps(app):
+    loop = ControlLoop(app, None, backups=False)
+    old = {'H1-S1-S2-H5': 6.0, 'H2-S1-S3-S2-H5': 6.0}
+    new = {'H1-S1-S3-S2-H5': 6.0, 'H2-S1-S2-H5': 6.0}
+    loop.apply(old)
+    mpls_replay.answer_all(app)
+    # both at once would put 12 on S1-S3, which has 11
+    steps = loop.plan(old, new)
+    assert len(steps) > 1 and steps[-1] == new
+    capacity = dict(zip(loop.links, loop.capacity))
+    for before, after in zip([old] + steps, steps):
+        load = {}
+        for path in set(before) | set(after):
+            nodes = path.split('-')
+            for link in zip(nodes[1:-2], nodes[2:-1]):
+                load[link] = load.get(link, 0.0) + max(before.get(path, 0.0), after.get(path, 0.0))
+        assert all(load[link] <= capacity[link] * (1 + 1e-6) for link in load)
+
+    applied = []
+    reconcile = app.reconcile
+
+    def record(desired, callback=None):
+        applied.append(desired)
+        return reconcile(desired, callback)
+    app.reconcile = record
+    loop.apply(new)
+    assert len(applied) == len(steps)
+    mpls_replay.answer_all(app)
+    assert sorted(app.lsps) == ['H1-S1-S3-S2-H5', 'H2-S1-S2-H5']
+    assert not app.unconfirmed and not app.transactions
+
+
+def test_warm_restart_sends_no_flow_mods(tmp_path):
+    statefile = str(tmp_path / 'lsps.state')
+    app = mpls_replay.make_app(NETFILE, statefile=statefile)
+    app.logger.disabled = True
+    trace = mpls_replay.synthetic_trace(app, cycles=3, n_flows=20)
+    mpls_replay.replay(app, trace)
+    datapaths = dict(app.switches)
+    flows = {name: dict(dp.flows) for name, dp in datapaths.items()}
+    groups = {name: dict(dp.groups) for name, dp in datapaths.items()}
+    app.store.close()
+
+    sent = {name: dict(dp.sent) for name, dp in datapaths.items()}
+    restarted = mpls_replay.make_app(NETFILE, statefile=statefile, datapaths=datapaths)
+    assert sorted(restarted.lsps) == sorted(app.lsps)
+    for pathString, lsp in app.lsps.items():
+        for field in ('weight', 'fwd_labels', 'rev_labels'):
+            assert restarted.lsps[pathString][field] == lsp[field]
+    for name, dp in datapaths.items():
+        new = {kind: n - sent[name].get(kind, 0) for kind, n in dp.sent.items()}
+        # only the flow stats and group desc requests of the sync
+        assert {kind: n for kind, n in new.items() if n} == {
+            'OFPFlowStatsRequest': 1, 'OFPGroupDescStatsRequest': 1}
+        assert dp.flows == flows[name] and dp.groups == groups[name]
+
+    # the restored labels and groups are taken: the next step runs cleanly
+    result = mpls_replay.replay(restarted, trace[:1])
+    assert result['misses'] == 0
+    restarted.store.close()
+
+
+def test_reconcile_sends_only_the_differences(app):
+    desired = {'H1-S1-S2-H5': 1.0, 'H1-S1-S3-S2-H5': 1.0, 'H2-S1-S2-H5': 1.0}
+    app.reconcile(desired)
+    mpls_replay.answer_all(app)
+    log = record(app)
+    assert app.reconcile(dict(desired)) == 0
+    mpls_replay.answer_all(app)
+    assert not log
+
+    # a weight of one direction touches only the group of that direction
+    assert app.reconcile(dict(desired, **{'H1-S1-S2-H5': {'fwd': 3.0, 'rev': 1.0}})) == 1
+    mpls_replay.answer_all(app)
+    assert mods(log) == [('S1', 'group modify')]
+    del log[:]
+
+    # an LSP removed from a shared FEC: its buckets, then its other hops
+    del desired['H1-S1-S3-S2-H5']
+    app.reconcile(desired)
+    mpls_replay.answer_all(app)
+    assert sorted(mods(log)) == [('S1', 'flow delete'), ('S1', 'group modify'),
+                                 ('S2', 'flow delete'), ('S2', 'group modify'),
+                                 ('S3', 'flow delete'), ('S3', 'flow delete')]
+    assert sum(dp.misses for dp in app.switches.values()) == 0
+
+
+def test_label_exhaustion_and_release(app):
+    from mpls_labels import LabelManager
+    app.labels = LabelManager(16, 16)  # one label per link direction
+    app.reconcile({'H1-S1-S2-H5': 1.0})
+    mpls_replay.answer_all(app)
+    # no label is left on S1-S2 for a second LSP over it
+    app.reconcile({'H1-S1-S2-H5': 1.0, 'H2-S1-S2-H5': 1.0})
+    mpls_replay.answer_all(app)
+    assert list(app.lsps) == ['H1-S1-S2-H5']
+    assert len(app.labels.pools[('S1', 'S2')]) == 0
+    # the labels come back once the LSP holding them is gone
+    app.reconcile({})
+    assert len(app.labels.pools[('S1', 'S2')]) == 0  # until its entries are deleted
+    mpls_replay.answer_all(app)
+    assert len(app.labels.pools[('S1', 'S2')]) == 1
+    app.reconcile({'H2-S1-S2-H5': 1.0})
+    mpls_replay.answer_all(app)
+    assert list(app.lsps) == ['H2-S1-S2-H5']
+    assert app.lsps['H2-S1-S2-H5']['fwd_labels'] == {('S1', 'S2'): 16}
+
+
+def test_make_lsps_skips_existing_paths(app):
+    app.make_lsps(['H1-S1-S2-H5'])
+    mpls_replay.answer_all(app)
+    lsp = app.lsps['H1-S1-S2-H5']
+    free = {link: len(pool) for link, pool in app.labels.pools.items()}
+    log = record(app)
+    app.make_lsps(['H1-S1-S2-H5'])
+    mpls_replay.answer_all(app)
+    assert not mods(log)
+    assert app.lsps['H1-S1-S2-H5'] is lsp
+    assert {link: len(pool) for link, pool in app.labels.pools.items()} == free
@@ -0,0 +1,13 @@
+import numpy as np
+
+import simulation_swan
+from test_evaluation import allocator
+
+
+def test_capacity_events_end_with_the_simulation():
+    alloc = allocator([8.0, 8.0])
+    result = simulation_swan.simulate(np.array([[8.0, 8.0], [4.0, 4.0]]), 300,
+                                      capacity_events=[(300, 0, 4.0)], interval=300,
+                                      alloc=alloc)
+    assert np.allclose(result['throughput'][:, 0], [10, 4])
+    assert np.allclose(alloc.capacity_links, [10])
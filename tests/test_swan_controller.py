@@ -0,0 +1,110 @@
+import numpy as np
+
+from flowtable import FlowTable
+from swan_controller import Allocator, ClassLP, tunnel_loads
+from tunnelgen import TunnelSet
+
+LINKS = [('A', 'B'), ('A', 'C'), ('B', 'C')]
+CAPACITY = [10.0, 5.0, 4.0]
+
+
+def triangle(records):
+    """ Flows over A->B (10), A->C (5) and B->C (4); A to C also goes via B."""
+    flows = FlowTable.from_records(records)
+    tunnels = TunnelSet.from_paths([('A', 'B', [0]), ('A', 'C', [1]), ('A', 'C', [0, 2])])
+    return Allocator(flows, LINKS, tunnels, CAPACITY, scratch=0.0)
+
+
+def check(alloc, b, x):
+    load = alloc.I_matrix.T @ np.asarray(x.sum(axis=0)).ravel()
+    assert np.all(load <= alloc.capacity_links + 1e-6)
+    assert np.allclose(np.asarray(x.sum(axis=1)).ravel(), b)
+    assert np.all(b <= alloc.flows.demands() + 1e-6)
+
+
+def test_mcf_maximizes_throughput_within_capacity():
+    # D to E has no tunnel; the rest can use all 15 units leaving A
+    alloc = triangle([('interactive', 'A', 'B', 8.0), ('interactive', 'A', 'B', 2.0),
+                      ('interactive', 'A', 'C', 20.0), ('interactive', 'D', 'E', 5.0)])
+    b, x = alloc.MCF('interactive', alloc.capacity_links, 0, 1e9, None)
+    check(alloc, b, x)
+    assert np.isclose(b.sum(), 15)
+    assert b[3] == 0 and x[3].nnz == 0
+    # flows of one commodity split its tunnels by their share of its rate
+    assert np.allclose(x[0].toarray() * b[1], x[1].toarray() * b[0])
+
+
+def test_mcf_bounds_and_frozen_flows():
+    alloc = triangle([('interactive', 'A', 'B', 8.0), ('interactive', 'A', 'C', 20.0)])
+    b, x = alloc.MCF('interactive', alloc.capacity_links, 0, 3.0, None)
+    check(alloc, b, x)
+    assert np.allclose(b, [3, 3])
+    b, x = alloc.MCF('interactive', alloc.capacity_links, 0, 1e9, {0: 1.0})
+    check(alloc, b, x)
+    assert np.allclose(b, [1, 9])
+
+
+def test_class_lp_over_residual_capacity():
+    alloc = triangle([('elastic', 'A', 'B', 8.0), ('elastic', 'A', 'C', 20.0)])
+    rem_c = np.array([2.0, 5.0, 4.0])
+    lp = ClassLP(alloc, 'elastic', rem_c)
+    b, y = lp.solve(np.zeros(2), lp.demands.copy())
+    assert np.isclose(b.sum(), 7)
+    assert np.all(alloc.I_matrix[lp.tun].T @ y <= rem_c + 1e-6)
+    list_b, x = lp.expand(b, y)
+    check(alloc, list_b, x)
+
+
+def test_class_without_tunnels_gets_nothing():
+    alloc = triangle([('background', 'D', 'E', 5.0)])
+    b, x = alloc.MCF('background', alloc.capacity_links, 0, 1e9, None)
+    assert np.allclose(b, [0]) and x.nnz == 0 and x.shape == (1, 3)
+
+
+def test_scratch_is_kept_free_across_classes():
+    flows = FlowTable.from_records([(pri, 'A', 'B', 20.0)
+                                    for pri in ('interactive', 'elastic', 'background')])
+    tunnels = TunnelSet.from_paths([('A', 'B', [0])])
+    alloc = Allocator(flows, [('A', 'B')], tunnels, [10.0], scratch=0.1)
+    allocation = alloc.swan_allocation()
+    load = alloc.I_matrix.T @ tunnel_loads(allocation)
+    assert np.all(load <= 0.9 * alloc.capacity_links + 1e-6)
+    assert np.isclose(load[0], 9.0)
+    assert np.allclose(flows.allocations(), [9, 0, 0])
+
+
+def shared_link(alpha):
+    """ A->C and B->C meet on M->C (17); the small flow is done at once."""
+    flows = FlowTable.from_records([('interactive', 'A', 'C', 2.0), ('interactive', 'A', 'C', 20.0),
+                                    ('interactive', 'B', 'C', 20.0)])
+    tunnels = TunnelSet.from_paths([('A', 'C', [0, 2]), ('B', 'C', [1, 2])])
+    return Allocator(flows, [('A', 'M'), ('B', 'M'), ('M', 'C')], tunnels, [20.0, 20.0, 17.0],
+                     scratch=0.0, alpha=alpha, U=1.0)
+
+
+def test_appx_maxmin_keeps_frozen_rates(monkeypatch):
+    steps = []
+    solve = ClassLP.solve
+
+    def record(self, lower, upper, frozen=None):
+        b, y = solve(self, lower, upper, frozen)
+        steps.append((frozen.copy(), b.copy()))
+        return b, y
+
+    monkeypatch.setattr(ClassLP, 'solve', record)
+    alloc = shared_link(2.0)
+    b, x = alloc.swan_allocation()['interactive']
+    check(alloc, b, x)
+    assert len(steps) > 2
+    for (_, before), (frozen, after) in zip(steps, steps[1:]):
+        assert np.allclose(after[frozen], before[frozen])
+    # within a factor alpha of the max-min rates 2, 7.5, 7.5
+    assert np.isclose(b[0], 2) and np.isclose(b.sum(), 17)
+    assert np.all(b[1:] >= 7.5 / 2.0)
+
+
+def test_appx_maxmin_approaches_maxmin():
+    alloc = shared_link(1.05)
+    b, x = alloc.swan_allocation()['interactive']
+    check(alloc, b, x)
+    assert np.allclose(b, [2, 7.5, 7.5], atol=0.4)
@@ -0,0 +1,67 @@
+# Integer indexed view of a SimpleMPLS topology
+
+
+class TopologyIndex:
+    """ The topology graph of SimpleMPLS compiled once into flat tables, so
+        that programming a path is a handful of list lookups per hop instead
+        of nested NetworkX dictionary accesses.
+        Nodes are numbered in graph order; index maps a name to its number
+        and names, ip and is_switch are indexed by it. Every link direction
+        (i, j) has an edge number in edge, ends[e] = (i, j), and out_port[e] / in_port[e] are
+        the ports of i and j on that link, weight[e] and capacity[e] its
+        weight (1 if not given) and capacity (0 if not given). port maps
+        (i, port of i) to the edge leaving i through that port.
+        :param g: NetworkX graph as read from the JSON network file, links
+        carrying a "ports" dictionary of node name to port number.
+    """
+
+    def __init__(self, g):
+        self.names = list(g.nodes)
+        self.index = {n: i for i, n in enumerate(self.names)}
+        self.ip = [g.nodes[n].get('ip') for n in self.names]
+        self.is_switch = [g.nodes[n].get('type') == 'switch' for n in self.names]
+        self.edge = {}
+        self.ends = []
+        self.out_port = []
+        self.in_port = []
+        self.weight = []
+        self.capacity = []
+        self.port = {}
+        for u, v, data in g.edges(data=True):
+            ends = [(u, v)] if g.is_directed() else [(u, v), (v, u)]
+            for a, b in ends:
+                self.edge[(self.index[a], self.index[b])] = len(self.ends)
+                self.port[(self.index[a], data['ports'][a])] = len(self.ends)
+                self.ends.append((self.index[a], self.index[b]))
+                self.out_port.append(data['ports'][a])
+                self.in_port.append(data['ports'][b])
+                self.weight.append(data.get('weight', 1))
+                self.capacity.append(data.get('capacity', 0))
+
+    def path(self, node_list):
+        """ Node numbers and edge numbers along a path of node names, or None
+            if some hop is not a link of the topology."""
+        try:
+            ids = [self.index[n] for n in node_list]
+            edges = [self.edge[hop] for hop in zip(ids, ids[1:])]
+        except KeyError:
+            return None
+        return ids, edges
+
+    def switch_links(self):
+        """ Edge numbers of the links between two switches, in edge order."""
+        return [e for e, (i, j) in enumerate(self.ends)
+                if self.is_switch[i] and self.is_switch[j]]
+
+    def neighbor(self, name, port):
+        """ Name of the node on the other end of a port of a node, or None."""
+        e = self.port.get((self.index.get(name), port))
+        return None if e is None else self.names[self.ends[e][1]]
+
+    def access_switch(self, host):
+        """ Name of the switch a host is attached to, or None."""
+        i = self.index[host]
+        for a, b in self.ends:
+            if a == i and self.is_switch[b]:
+                return self.names[b]
+        return None
@@ -0,0 +1,179 @@
+# Mininet networks and SimpleMPLS network files from link lists
+import argparse
+import functools
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import loadfiles
+import simulation_swan
+
+MAX_NAME = 8  # SimpleMPLS reads switch names from the 8 byte datapath id
+HOST_CAPACITY = 0  # capacity of host links, 0 for unshaped
+
+
+def from_links(ingress, egress, capacity=simulation_swan.LINK_CAPACITY, hosts_per_switch=1,
+               host_capacity=HOST_CAPACITY):
+    """ A network of one switch per node of a link list, hosts_per_switch hosts
+        on every switch, and one link per pair of nodes with a link in either
+        direction.
+        :param ingress: ingress node name of every directed link.
+        :param egress: egress node name of every directed link.
+        :param capacity: capacity of every directed link (e.g. the
+        capacity_links of an Allocator) or one for all. A link carries the
+        smaller capacity of its two directions.
+        :return: the network as SimpleMPLS reads it, see to_json.
+    """
+    ingress, egress = np.asarray(ingress), np.asarray(egress)
+    capacity = np.broadcast_to(np.asarray(capacity, dtype=float), ingress.shape)
+    pairs = {}
+    for a, b, c in zip(ingress.tolist(), egress.tolist(), capacity.tolist()):
+        key = (a, b) if (b, a) not in pairs else (b, a)
+        pairs[key] = min(pairs.get(key, c), c)
+    switches = sorted(set(ingress.tolist()) | set(egress.tolist()),
+                      key=lambda n: (len(n), n))
+    for s in switches:
+        if len(s) > MAX_NAME or not s.isascii():
+            raise ValueError("Switch name {} is not a datapath id".format(s))
+    nodes = [{'id': s, 'type': 'switch'} for s in switches]
+    links = []
+    for s in switches:
+        for _ in range(hosts_per_switch):
+            i = len(nodes) - len(switches) + 1
+            nodes.append({'id': 'H{}'.format(i), 'type': 'host', 'ip': host_ip(i),
+                          'mac': host_mac(i)})
+            links.append(('H{}'.format(i), s, host_capacity))
+    links += [(a, b, c) for (a, b), c in pairs.items()]
+    return network(nodes, links)
+
+
+def from_json(file):
+    """ A SimpleMPLS network file such as ExNet.json."""
+    with open(file) as f:
+        return json.load(f)
+
+
+def synthetic(n_dc, n_links, seed=0, capacity=simulation_swan.LINK_CAPACITY, **kwargs):
+    """ A random connected network, see benchmark.synthetic_topology. Other
+        keyword arguments go to from_links."""
+    import benchmark
+    ingress, egress = benchmark.synthetic_topology(n_dc, n_links, seed)
+    return from_links(ingress, egress, capacity, **kwargs)
+
+
+def network(nodes, links):
+    """ The network file of nodes and (source, target, capacity) links.
+        Ports are numbered per node from 1 in link order."""
+    next_port = {n['id']: 1 for n in nodes}
+    out = []
+    for a, b, c in links:
+        ports = {a: next_port[a], b: next_port[b]}
+        next_port[a] += 1
+        next_port[b] += 1
+        out.append({'source': a, 'target': b, 'capacity': c, 'weight': 1, 'ports': ports})
+    return {'directed': False, 'multigraph': False, 'graph': {}, 'nodes': nodes, 'links': out}
+
+
+def to_json(net, file):
+    """ Writes a network for the --netfile option of SimpleMPLS."""
+    with open(file, 'w') as f:
+        json.dump(net, f, indent=1)
+
+
+def host_ip(i):
+    return '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255)
+
+
+def host_mac(i):
+    return ':'.join('{:02x}'.format(i >> s & 255) for s in (40, 32, 24, 16, 8, 0))
+
+
+def dpid(name):
+    """ The datapath id SimpleMPLS.dpidDecode turns back into name."""
+    return name.encode().hex().rjust(16, '0')
+
+
+def build(net, controller='127.0.0.1:6633', workers=16):
+    """ Creates the Mininet network of a network file: OpenFlow 1.3 switches
+        with the datapath ids SimpleMPLS expects, hosts with their addresses,
+        and links on the file's ports shaped to their capacity. SimpleMPLS
+        does not answer ARP, so every host gets static ARP entries of all
+        others, configured on workers hosts at a time.
+        :param controller: address:port of the remote controller.
+        :return: the Mininet object, built but not started.
+    """
+    from mininet.link import TCLink
+    from mininet.net import Mininet
+    from mininet.node import OVSSwitch, RemoteController
+
+    mn = Mininet(switch=functools.partial(OVSSwitch, protocols='OpenFlow13'), link=TCLink,
+                 controller=None, autoSetMacs=False, build=False)
+    address, port = controller.rsplit(':', 1)
+    mn.addController('c0', controller=RemoteController, ip=address, port=int(port))
+    for n in net['nodes']:
+        if n['type'] == 'switch':
+            mn.addSwitch(n['id'], dpid=dpid(n['id']))
+        else:
+            mn.addHost(n['id'], ip=n['ip'] + '/8', mac=n['mac'])
+    for l in net['links']:
+        a, b = l['source'], l['target']
+        params = {'bw': l['capacity']} if l.get('capacity') else {}
+        mn.addLink(a, b, port1=l['ports'][a], port2=l['ports'][b], **params)
+    mn.build()
+    static_arp(mn.hosts, workers)
+    return mn
+
+
+def static_arp(hosts, workers=16):
+    """ Gives every host an ARP entry of every other host, one shell command
+        per host, run on several hosts at once."""
+    entries = [(h, 'arp -s {} {}'.format(h.IP(), h.MAC())) for h in hosts]
+
+    def configure(host):
+        host.cmd('; '.join(cmd for h, cmd in entries if h is not host))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(configure, hosts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Builds SWAN test networks.")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--links', default='links.xlsx', help="link list to build from")
+    source.add_argument('--json', help="SimpleMPLS network file to build from")
+    source.add_argument('--synthetic', help="random network of DCS,LINKS")
+    parser.add_argument('--capacity', type=float, default=simulation_swan.LINK_CAPACITY,
+                        help="capacity of the links between switches")
+    parser.add_argument('--hosts-per-switch', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="network file to write for SimpleMPLS")
+    parser.add_argument('--mininet', action='store_true', help="start the network in Mininet")
+    parser.add_argument('--controller', default='127.0.0.1:6633')
+    args = parser.parse_args(argv)
+
+    if args.json:
+        net = from_json(args.json)
+    elif args.synthetic:
+        n_dc, n_links = (int(x) for x in args.synthetic.split(','))
+        net = synthetic(n_dc, n_links, args.seed, args.capacity,
+                        hosts_per_switch=args.hosts_per_switch)
+    else:
+        cols = loadfiles.readLinks(args.links)
+        bi = cols['Bidirectional']
+        net = from_links(np.concatenate([cols['Ingress'], cols['Egress'][bi]]),
+                         np.concatenate([cols['Egress'], cols['Ingress'][bi]]),
+                         args.capacity, args.hosts_per_switch)
+    if args.output:
+        to_json(net, args.output)
+    if args.mininet:
+        from mininet.cli import CLI
+        mn = build(net, args.controller)
+        mn.start()
+        CLI(mn)
+        mn.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,154 @@
+# Tunnel generation for the SWAN allocator
+import hashlib
+import itertools
+import os
+
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+
+import datacache
+
+# Tunnel sets computed in this process, keyed by topology_hash()
+_memo = {}
+
+
+class TunnelSet:
+    """ Tunnels in compressed sparse row form: tunnel t runs from ingress[t] to
+        egress[t] over the links indices[indptr[t]:indptr[t + 1]], in path order.
+    """
+
+    def __init__(self, ingress, egress, indptr, indices):
+        self.ingress = np.asarray(ingress, dtype=str)
+        self.egress = np.asarray(egress, dtype=str)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    @classmethod
+    def from_paths(cls, paths):
+        """ Builds a set from (ingress, egress, [link index, ...]) tuples."""
+        paths = list(paths)
+        lengths = [len(p[2]) for p in paths]
+        indptr = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        indices = list(itertools.chain.from_iterable(p[2] for p in paths))
+        return cls([p[0] for p in paths], [p[1] for p in paths], indptr, indices)
+
+    def __len__(self):
+        return len(self.ingress)
+
+    def links_of(self, t):
+        return self.indices[self.indptr[t]:self.indptr[t + 1]]
+
+    def path(self, t, links):
+        """ Node names along tunnel t, given the (ingress, egress) of every link."""
+        hops = self.links_of(t)
+        return [self.ingress[t]] + [links[l][1] for l in hops] if len(hops) else []
+
+    def incidence(self, num_links):
+        """ Sparse tunnel x link incidence matrix, I[t, l] = 1 if tunnel t crosses link l."""
+        return sp.csr_matrix((np.ones(len(self.indices)), self.indices, self.indptr),
+                             shape=(len(self), num_links))
+
+
+def links_from_graph(g):
+    """ Directed links of a NetworkX graph such as the one in ExNet.json. An
+        undirected edge gives a link each way. Returns (ingress, egress,
+        weights, capacities); missing weights are 1 and capacities 0."""
+    ingress, egress, weights, capacities = [], [], [], []
+    for u, v, data in g.edges(data=True):
+        ends = [(u, v)] if g.is_directed() else [(u, v), (v, u)]
+        for a, b in ends:
+            ingress.append(a)
+            egress.append(b)
+            weights.append(data.get('weight', 1))
+            capacities.append(data.get('capacity', 0))
+    return (np.array(ingress, dtype=str), np.array(egress, dtype=str),
+            np.array(weights, dtype=float), np.array(capacities, dtype=float))
+
+
+def topology_hash(ingress, egress, weights=None, k=3, method='shortest', pairs=None):
+    """ Hash of everything a tunnel set depends on."""
+    h = hashlib.sha1()
+    for arr in (ingress, egress):
+        h.update('\0'.join(map(str, arr)).encode())
+    if weights is not None:
+        h.update(np.asarray(weights, dtype=float).tobytes())
+    h.update('{}:{}'.format(k, method).encode())
+    if pairs is not None:
+        h.update('\0'.join('{}>{}'.format(a, b) for a, b in pairs).encode())
+    return h.hexdigest()
+
+
+def tunnels_for(ingress, egress, weights=None, k=3, method='shortest', pairs=None,
+                cache_dir=datacache.CACHE_DIR):
+    """ The tunnel set of a topology, computed once per topology hash. Sets are
+        memoized in the process and stored under cache_dir, so allocation runs
+        that only change demands reuse the same paths.
+        :param ingress: ingress node name of every directed link.
+        :param egress: egress node name of every directed link.
+        :param weights: link weights for the shortest paths, hop count if None.
+        :param k: tunnels per (ingress, egress) pair.
+        :param method: 'shortest' (k shortest simple paths) or 'disjoint'
+        (up to k edge-disjoint paths).
+        :param pairs: (ingress, egress) node pairs, all ordered pairs if None.
+    """
+    key = topology_hash(ingress, egress, weights, k, method, pairs)
+    if key in _memo:
+        return _memo[key]
+    path = os.path.join(cache_dir, 'tunnels-{}.npz'.format(key)) if cache_dir else None
+    if path and os.path.exists(path):
+        with np.load(path) as data:
+            tunnel_set = TunnelSet(data['ingress'], data['egress'], data['indptr'], data['indices'])
+    else:
+        tunnel_set = generate(ingress, egress, weights, k, method, pairs)
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(path + '.tmp.npz', ingress=tunnel_set.ingress, egress=tunnel_set.egress,
+                     indptr=tunnel_set.indptr, indices=tunnel_set.indices)
+            os.replace(path + '.tmp.npz', path)
+    _memo[key] = tunnel_set
+    return tunnel_set
+
+
+def generate(ingress, egress, weights=None, k=3, method='shortest', pairs=None):
+    """ Computes the tunnels of every pair, see tunnels_for."""
+    g = nx.DiGraph()
+    for l, (a, b) in enumerate(zip(ingress, egress)):
+        g.add_edge(a, b, id=l, weight=1 if weights is None else weights[l])
+    if pairs is None:
+        pairs = [(a, b) for a in g.nodes for b in g.nodes if a != b]
+    if method == 'shortest':
+        find = _k_shortest
+    elif method == 'disjoint':
+        find = _k_disjoint
+    else:
+        raise ValueError("Unknown tunnel method: {}".format(method))
+
+    paths = []
+    for a, b in pairs:
+        if a not in g or b not in g:
+            continue
+        for nodes in find(g, a, b, k):
+            paths.append((a, b, [g[u][v]['id'] for u, v in zip(nodes, nodes[1:])]))
+    return TunnelSet.from_paths(paths)
+
+
+def _k_shortest(g, a, b, k):
+    try:
+        return list(itertools.islice(nx.shortest_simple_paths(g, a, b, weight='weight'), k))
+    except nx.NetworkXNoPath:
+        return []
+
+
+def _k_disjoint(g, a, b, k):
+    # Greedy: take the shortest path, drop its links, repeat.
+    residual = g.copy()
+    found = []
+    for _ in range(k):
+        try:
+            nodes = nx.shortest_path(residual, a, b, weight='weight')
+        except nx.NetworkXNoPath:
+            break
+        found.append(nodes)
+        residual.remove_edges_from(zip(nodes, nodes[1:]))
+    return found
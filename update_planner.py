@@ -0,0 +1,112 @@
+# Congestion-free transitions between SWAN allocations
+import numpy as np
+import scipy.sparse as sp
+from scipy.optimize import linprog
+
+from swan_controller import tunnel_loads
+
+# Largest step count tried by default
+MAX_STEPS = 10
+
+
+class UpdatePlan:
+    """ Tunnel loads of every state from the old allocation (states[0]) to the
+        new one (states[-1]). Switches may apply each transition in any order
+        without any link carrying more than its capacity, even when some
+        tunnels still use the previous state and others the next one.
+    """
+
+    def __init__(self, states):
+        self.states = states
+
+    @property
+    def steps(self):
+        return len(self.states) - 1
+
+    def transitions(self, tol=1e-9):
+        """ Yields (step, {tunnel: load}) with the tunnels whose load changes in
+            each transition, which is what has to be pushed to the switches."""
+        for s in range(1, len(self.states)):
+            changed = np.flatnonzero(np.abs(self.states[s] - self.states[s - 1]) > tol)
+            yield s, {int(t): float(self.states[s][t]) for t in changed}
+
+    def path_steps(self, alloc):
+        """ The transitions keyed by tunnel path ("d1-d2-d5") instead of tunnel
+            index, for pushing to the data plane one step at a time."""
+        for s, loads in self.transitions():
+            yield s, {'-'.join(map(str, alloc.tunnels.path(t, alloc.links))): load
+                      for t, load in loads.items()}
+
+
+def plan_update(old, new, alloc, max_steps=None, tol=1e-6):
+    """ Finds the fewest intermediate allocations between two allocations such
+        that no transition congests a link, as in SWAN. In a transition a tunnel
+        may carry either its old or its new load, so the worst case per link is
+        the sum of max(old, new) over the tunnels crossing it. All intermediate
+        states of a step count are solved together as one LP; the step count is
+        found by binary search.
+        :param old: per-tunnel loads, or a swan_allocation result.
+        :param new: per-tunnel loads, or a swan_allocation result.
+        :param alloc: the Allocator, for the tunnels and capacities.
+        :param max_steps: largest step count tried, MAX_STEPS if None.
+        :return: an UpdatePlan.
+    """
+    old = tunnel_loads(old) if isinstance(old, dict) else np.asarray(old, dtype=float)
+    new = tunnel_loads(new) if isinstance(new, dict) else np.asarray(new, dtype=float)
+    capacity = alloc.capacity_links * (1 + tol)
+    if max_steps is None:
+        max_steps = MAX_STEPS
+
+    if np.all(alloc.I_matrix.T @ np.maximum(old, new) <= capacity):
+        return UpdatePlan([old, new])
+    # each commodity keeps at least the smaller of its old and new rate throughout
+    n_c = int(alloc.tunnel_comm.max()) + 1 if len(alloc.tunnel_comm) else 0
+    C = sp.csr_matrix((np.ones(len(old)), (alloc.tunnel_comm, np.arange(len(old)))),
+                      shape=(n_c, len(old)))
+    floor = np.minimum(C @ old, C @ new)
+
+    lo, hi, best = 2, max_steps, None
+    while lo <= hi:
+        q = (lo + hi) // 2
+        states = _solve_states(old, new, q, alloc.I_matrix, capacity, C, floor)
+        if states is None:
+            lo = q + 1
+        else:
+            best, hi = states, q - 1
+    if best is None:
+        raise RuntimeError("No congestion-free update within {} steps".format(max_steps))
+    return UpdatePlan(best)
+
+
+def _solve_states(old, new, q, I_matrix, capacity, C, floor):
+    """ The LP of q transitions: variables are the q - 1 intermediate states a
+        and, per transition s, u >= max(a^s, a^(s+1)) per tunnel. Returns the q + 1
+        states, or None if infeasible."""
+    n = len(old)
+    m = q - 1
+    eye = sp.identity(n, format='csr')
+    # u^s >= a^s and u^s >= a^(s+1); a^0 and a^q are constants on the right side
+    E1 = sp.csr_matrix((np.ones(m), (np.arange(1, q), np.arange(m))), shape=(q, m))
+    E2 = sp.csr_matrix((np.ones(m), (np.arange(m), np.arange(m))), shape=(q, m))
+    U = -sp.identity(q * n, format='csr')
+    rhs1 = np.zeros(q * n)
+    rhs1[:n] = -old
+    rhs2 = np.zeros(q * n)
+    rhs2[-n:] = -new
+    # link capacity for every transition, and the commodity floors for every state
+    link = sp.kron(sp.identity(q), I_matrix.T, format='csr')
+    comm = -sp.kron(sp.identity(m), C, format='csr')
+    A_ub = sp.vstack([
+        sp.hstack([sp.kron(E1, eye), U]),
+        sp.hstack([sp.kron(E2, eye), U]),
+        sp.hstack([sp.csr_matrix((link.shape[0], m * n)), link]),
+        sp.hstack([comm, sp.csr_matrix((comm.shape[0], q * n))]),
+    ]).tocsr()
+    b_ub = np.concatenate([rhs1, rhs2, np.tile(capacity, q), -np.tile(floor, m)])
+    # minimizing the transient load keeps the intermediate states close to the ends
+    c = np.concatenate([np.zeros(m * n), np.ones(q * n)])
+    res = linprog(c, A_ub=A_ub, b_ub=b_ub, bounds=(0, None), method='highs')
+    if res.status != 0:
+        return None
+    a = res.x[:m * n].reshape(m, n)
+    return [old] + list(a) + [new]